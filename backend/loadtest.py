@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Teste de carga local: sobe o app no próprio processo (ASGI, sem rede), troca o
+Gemini por um LLM falso configurável e dispara /api/chat, /api/progress,
+/api/streak e /api/sessions em paralelo contra um banco descartável.
+
+    python loadtest.py --concurrency 50 --duration 30 --out run.json
+    python loadtest.py --llm "latency_ms=1200,sigma=0.6,tokens_per_s=40,error_rate=0.02"
+    python loadtest.py --llm "latency_ms=300,slow_rate=0.05,slow_ms=8000"   # cauda lenta: hedge/modelo reserva
+    python loadtest.py --in-memory          # mongod temporário (pip install pymongo-inmemory)
+
+O banco é MONGO_URL/<DB_NAME>_loadtest (apagado no fim, a menos de --keep). O
+resultado é um JSON com p50/p95/p99, requisições/s e status por rota, para
+comparar execuções.
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import time
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import httpx
+import typer
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+from server import ChatMessage, ChatSession, GeminiClient, UserProfile, compute_progress_stats
+
+cli = typer.Typer(help="Teste de carga local do backend do REVISAHUB")
+
+SUBJECTS = ["Matemática", "Física", "Química", "Biologia", "História", "Português"]
+PROFILE = {
+    "canal_sensorial": "visual", "formato_explicacao": "analogias_historias", "abordagem": "pratica",
+    "interacao_social": "sozinho", "estrutura_estudo": "equilibrado", "duracao_sessao": "30_60",
+    "ambiente_estudo": "silencio", "motivador_principal": "desafios_metas",
+    "estrategia_dificuldade": "busca_exemplos", "planejamento_estudos": "semanal",
+    "interesse_cultural": "League of Legends",
+}
+DEFAULT_MIX = "chat=4,progress=2,streak=2,sessions=1,messages=1"
+
+
+# ------------ LLM falso ------------
+
+@dataclass
+class FakeLLMConfig:
+    latency_ms: float = 800.0   # mediana até o primeiro token (lognormal)
+    sigma: float = 0.5          # dispersão da lognormal: 0 = latência fixa
+    tokens: int = 150           # tamanho da resposta
+    tokens_per_s: float = 60.0  # ritmo de geração depois do primeiro token
+    error_rate: float = 0.0     # fração de chamadas que falham com 503
+    slow_rate: float = 0.0      # fração de chamadas travadas por slow_ms a mais (exercita hedge e prazo)
+    slow_ms: float = 10000.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "FakeLLMConfig":
+        """'latency_ms=800,sigma=0.5,...' -> FakeLLMConfig (campos omitidos ficam no padrão)."""
+        known = {f.name for f in fields(cls)}
+        values = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, value = item.partition("=")
+            if name not in known:
+                raise typer.BadParameter(f"parâmetro desconhecido do LLM falso: {name}")
+            values[name] = int(value) if name == "tokens" else float(value)
+        return cls(**values)
+
+
+class FakeGeminiTransport(httpx.AsyncBaseTransport):
+    """
+    Transporte httpx no lugar da API do Gemini: mesmo formato de resposta
+    (generateContent e streamGenerateContent/SSE), com latência, ritmo de tokens
+    e taxa de erro sorteados a partir de FakeLLMConfig.
+    """
+
+    def __init__(self, config: FakeLLMConfig, seed: Optional[int] = None):
+        self.config = config
+        self.random = random.Random(seed)
+
+    def _first_token_delay(self) -> float:
+        delay = self.config.latency_ms / 1000 * math.exp(self.random.gauss(0, self.config.sigma))
+        if self.random.random() < self.config.slow_rate:
+            delay += self.config.slow_ms / 1000
+        return delay
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self._first_token_delay())
+        if self.random.random() < self.config.error_rate:
+            return httpx.Response(503, json={"error": {"code": 503, "message": "fake overload"}})
+        words = [f"palavra{i}" for i in range(self.config.tokens)]
+        if "streamGenerateContent" in request.url.path:
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=self._sse(words))
+        await asyncio.sleep(self.config.tokens / self.config.tokens_per_s)
+        return httpx.Response(200, json=self._body(" ".join(words)))
+
+    @staticmethod
+    def _body(text: str) -> dict:
+        return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+    def _sse(self, words: List[str]) -> httpx.AsyncByteStream:
+        config = self.config
+        body = self._body
+
+        class Stream(httpx.AsyncByteStream):
+            async def __aiter__(self):
+                for start in range(0, len(words), 8):
+                    batch = words[start:start + 8]
+                    if start:
+                        await asyncio.sleep(len(batch) / config.tokens_per_s)
+                    yield f"data: {json.dumps(body(' '.join(batch) + ' '))}\r\n\r\n".encode()
+
+        return Stream()
+
+
+# ------------ Dados ------------
+
+async def seed(db, profiles: int, sessions: int, history: int, rng: random.Random) -> List[dict]:
+    """
+    Perfis com `sessions` sessões de `history` mensagens cada, espalhadas pelos
+    últimos dias, e stats recalculados como no rebuild-stats.
+    """
+    now = datetime.now(timezone.utc)
+    targets = []
+    for p in range(profiles):
+        profile = UserProfile(name=f"Carga {p}", **PROFILE).model_dump()
+        profile["last_activity_date"] = (now - timedelta(days=1)).date().isoformat()
+        profile["current_streak"] = profile["longest_streak"] = profile["total_study_days"] = 1
+        await db.profiles.insert_one(profile)
+        session_ids = []
+        for s in range(sessions):
+            subject = SUBJECTS[(p + s) % len(SUBJECTS)]
+            started = now - timedelta(days=sessions - s, minutes=history)
+            session = ChatSession(profile_id=profile["id"], title=f"Dúvida {s}", subject=subject,
+                                  created_at=started, updated_at=started + timedelta(minutes=history))
+            await db.sessions.insert_one(session.model_dump())
+            session_ids.append(session.id)
+            if history:
+                await db.messages.insert_many([
+                    ChatMessage(
+                        session_id=session.id, profile_id=profile["id"],
+                        role="user" if i % 2 == 0 else "assistant", subject=subject,
+                        content=f"mensagem {i} " + "texto de exemplo " * rng.randint(5, 60),
+                        timestamp=started + timedelta(minutes=i),
+                    ).model_dump()
+                    for i in range(history)
+                ])
+        await db.profiles.update_one({"id": profile["id"]}, {"$set": {"stats": await compute_progress_stats(profile["id"])}})
+        targets.append({"profile_id": profile["id"], "sessions": session_ids})
+    return targets
+
+
+# ------------ Carga ------------
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise typer.BadParameter(f"rota desconhecida no --mix: {name} (use {', '.join(OPERATIONS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def chat_request(target: dict, rng: random.Random) -> tuple:
+    session_id = rng.choice(target["sessions"])
+    body = {
+        "session_id": session_id, "profile_id": target["profile_id"], "subject": rng.choice(SUBJECTS),
+        "message": f"Pergunta {uuid.uuid4().hex[:8]}: pode explicar de outro jeito?",
+    }
+    return "POST", "/api/chat", body
+
+OPERATIONS = {
+    "chat": chat_request,
+    "progress": lambda target, rng: ("GET", f"/api/progress/{target['profile_id']}", None),
+    "streak": lambda target, rng: ("GET", f"/api/streak/{target['profile_id']}", None),
+    "sessions": lambda target, rng: ("GET", f"/api/sessions/{target['profile_id']}", None),
+    "messages": lambda target, rng: (
+        "GET", f"/api/sessions/{target['profile_id']}/{rng.choice(target['sessions'])}/messages", None,
+    ),
+}
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    stages = {}
+    for entry in filter(None, (part.strip() for part in header.split(","))):
+        name, _, dur = entry.partition(";dur=")
+        if dur:
+            stages[name] = stages.get(name, 0.0) + float(dur)
+    return stages
+
+
+@dataclass
+class Sample:
+    operation: str
+    status: int
+    ms: float
+    stages: Dict[str, float]
+
+
+async def worker(http: httpx.AsyncClient, targets: List[dict], mix: Dict[str, float],
+                 rng: random.Random, deadline: float, measure_from: float, samples: List[Sample]):
+    names, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        operation = rng.choices(names, weights)[0]
+        method, path, body = OPERATIONS[operation](rng.choice(targets), rng)
+        started = time.perf_counter()
+        try:
+            resp = await http.request(method, path, json=body)
+            status, stages = resp.status_code, parse_server_timing(resp.headers.get("server-timing", ""))
+        except httpx.HTTPError:
+            status, stages = 0, {}
+        if started >= measure_from:
+            samples.append(Sample(operation, status, (time.perf_counter() - started) * 1000, stages))
+
+
+def percentiles(values: List[float]) -> dict:
+    if len(values) < 2:
+        value = round(values[0], 2) if values else None
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50_ms": round(cuts[49], 2), "p95_ms": round(cuts[94], 2), "p99_ms": round(cuts[98], 2)}
+
+
+def summarize(samples: List[Sample], seconds: float) -> dict:
+    def block(group: List[Sample]) -> dict:
+        latencies = [s.ms for s in group]
+        stages = defaultdict(list)
+        for s in group:
+            for name, ms in s.stages.items():
+                stages[name].append(ms)
+        return {
+            "requests": len(group),
+            "rps": round(len(group) / seconds, 2),
+            "errors": sum(1 for s in group if s.status == 0 or s.status >= 400),
+            "status": dict(Counter(str(s.status) for s in group)),
+            **percentiles(latencies),
+            "mean_ms": round(statistics.fmean(latencies), 2) if latencies else None,
+            "max_ms": round(max(latencies), 2) if latencies else None,
+            # média por etapa, do Server-Timing
+            "stages_mean_ms": {name: round(statistics.fmean(v), 2) for name, v in sorted(stages.items())},
+        }
+
+    by_operation = defaultdict(list)
+    for s in samples:
+        by_operation[s.operation].append(s)
+    return {"overall": block(samples), "routes": {name: block(group) for name, group in sorted(by_operation.items())}}
+
+
+async def run_load(args: dict, mix: Dict[str, float], llm_config: FakeLLMConfig) -> dict:
+    transport = FakeGeminiTransport(llm_config, seed=args["seed"])
+    server.create_llm_client = lambda: GeminiClient(
+        "fake", pool_size=args["concurrency"], timeout=float(os.environ.get('LLM_TIMEOUT', '60')), transport=transport,
+    )
+
+    # banco próprio do teste; o cliente é recriado aqui para ficar neste event loop
+    server.client = AsyncIOMotorClient(args["mongo_url"], tz_aware=True, event_listeners=[server.MongoMetrics()])
+    server.db = server.client[args["db_name"]]
+    # os dois guardam a coleção do banco do import (ANSWER_CACHE=mongo, IMAGE_STORE=gridfs)
+    server.answer_cache = server.make_answer_cache()
+    server.image_store = server.make_image_store()
+    await server.client.drop_database(args["db_name"])
+
+    await server.app.router.startup()
+    try:
+        rng = random.Random(args["seed"])
+        targets = await seed(server.db, args["profiles"], args["sessions"], args["history"], rng)
+        samples: List[Sample] = []
+        started = time.perf_counter()
+        measure_from = started + args["warmup"]
+        deadline = measure_from + args["duration"]
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://loadtest",
+                                     timeout=None) as http:
+            await asyncio.gather(*(
+                worker(http, targets, mix, random.Random(rng.random()), deadline, measure_from, samples)
+                for _ in range(args["concurrency"])
+            ))
+            runtime_stats = (await http.get("/api/stats")).json()
+        # quem terminou depois do prazo também conta: divide pelo tempo real de medição
+        seconds = max(time.perf_counter() - measure_from, 1e-9)
+        return {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "config": {**{k: v for k, v in args.items() if k != "mongo_url"}, "llm": vars(llm_config)},
+            "seconds": round(seconds, 2),
+            **summarize(samples, seconds),
+            "server": runtime_stats,
+        }
+    finally:
+        if not args["keep"]:
+            await server.client.drop_database(args["db_name"])
+        await server.app.router.shutdown()
+
+
+@cli.command()
+def main(
+    concurrency: int = typer.Option(20, help="Clientes simultâneos"),
+    duration: float = typer.Option(20.0, help="Segundos medidos"),
+    warmup: float = typer.Option(3.0, help="Segundos iniciais descartados"),
+    mix: str = typer.Option(DEFAULT_MIX, help="Peso de cada rota: chat, progress, streak, sessions, messages"),
+    profiles: int = typer.Option(20, help="Perfis semeados"),
+    sessions: int = typer.Option(5, help="Sessões por perfil"),
+    history: int = typer.Option(40, help="Mensagens por sessão"),
+    llm: str = typer.Option("", help="LLM falso: latency_ms, sigma, tokens, tokens_per_s, error_rate, slow_rate, slow_ms"),
+    seed_value: int = typer.Option(1, "--seed", help="Semente (carga e LLM falso)"),
+    in_memory: bool = typer.Option(False, help="Sobe um mongod temporário em vez de usar MONGO_URL"),
+    keep: bool = typer.Option(False, help="Mantém o banco do teste no fim"),
+    out: Optional[str] = typer.Option(None, help="Grava o JSON também neste arquivo"),
+):
+    """Roda a carga e imprime o resultado em JSON."""
+    args = {
+        "concurrency": concurrency, "duration": duration, "warmup": warmup, "mix": mix,
+        "profiles": profiles, "sessions": sessions, "history": history, "llm": llm,
+        "seed": seed_value, "keep": keep,
+        "db_name": f"{os.environ.get('DB_NAME') or 'revisahub'}_loadtest",
+        "mongo_url": os.environ.get('MONGO_URL'),
+    }
+    # valida antes de semear o banco
+    operations, llm_config = parse_mix(mix), FakeLLMConfig.parse(llm)
+    if in_memory:
+        try:
+            from pymongo_inmemory import Mongod
+        except ImportError:
+            raise typer.BadParameter("--in-memory precisa do pacote pymongo-inmemory", param_hint="--in-memory")
+        with Mongod() as mongod:
+            result = asyncio.run(run_load({**args, "mongo_url": mongod.connection_string}, operations, llm_config))
+    else:
+        result = asyncio.run(run_load(args, operations, llm_config))
+
+    output = json.dumps(result, ensure_ascii=False, default=str)
+    if out:
+        with open(out, "w") as f:
+            f.write(output + "\n")
+    typer.echo(output)
+
+
+if __name__ == "__main__":
+    cli()
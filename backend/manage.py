@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Comandos administrativos do backend.
+
+    python manage.py ensure-indexes
+    python manage.py explain-indexes <profile_id> [--session-id ...]
+    python manage.py backfill-activity
+    python manage.py migrate-timestamps [--batch-size N] [--pause S] [--restart]
+    python manage.py rebuild-stats [--profile-id ...]
+    python manage.py bench-prompt [--iterations N]
+    python manage.py bench-persist [--turns N]
+    python manage.py chat-workers [--workers N]
+"""
+import asyncio
+import json
+import statistics
+import time
+import timeit
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import typer
+from pymongo import UpdateOne
+
+from server import (
+    INDEXES,
+    ChatMessage,
+    ChatRequest,
+    ChatSession,
+    activity_bit,
+    app,
+    build_system_prompt,
+    chat_jobs,
+    compute_progress_stats,
+    context_pipeline,
+    db,
+    empty_stats,
+    ensure_indexes,
+    fetch_context,
+    keyset_cond,
+    new_user_message,
+    persist_turn,
+    prompt_cache,
+    record_progress,
+    render_system_prompt,
+    update_streak,
+    write_behind,
+)
+
+cli = typer.Typer(help="Administração do banco do REVISAHUB")
+
+
+def route_queries(profile_id: str, session_id: str) -> dict:
+    """Consultas quentes de cada rota, no formato do comando `explain` do MongoDB."""
+    return {
+        "GET /profiles/{id}": {
+            "find": "profiles", "filter": {"id": profile_id}, "limit": 1,
+        },
+        "POST /chat (contexto: resumo)": {
+            "find": "sessions", "filter": {"id": session_id}, "limit": 1,
+        },
+        "POST /chat (contexto: mensagens recentes)": {
+            "aggregate": "messages", "cursor": {}, "pipeline": context_pipeline(session_id),
+        },
+        "GET /sessions/{profile_id}": {
+            "find": "sessions", "filter": {"profile_id": profile_id},
+            "sort": {"updated_at": -1, "id": -1}, "limit": 21,
+        },
+        "GET /sessions/{profile_id}/{session_id}/messages?before=": {
+            "find": "messages",
+            "filter": {
+                "session_id": session_id, "profile_id": profile_id,
+                **keyset_cond("timestamp", datetime.now(timezone.utc), "~", "$lt"),
+            },
+            "sort": {"timestamp": -1, "id": -1}, "limit": 51,
+        },
+        "rebuild-stats (sessões)": {
+            "count": "sessions", "query": {"profile_id": profile_id},
+        },
+        "rebuild-stats (mensagens)": {
+            "count": "messages", "query": {"profile_id": profile_id, "role": "user"},
+        },
+        "rebuild-stats (última atividade)": {
+            "find": "messages", "filter": {"profile_id": profile_id},
+            "sort": {"timestamp": -1}, "limit": 1,
+        },
+        "rebuild-stats (matérias)": {
+            "aggregate": "messages", "cursor": {},
+            "pipeline": [
+                {"$match": {"profile_id": profile_id, "role": "user", "subject": {"$exists": True, "$ne": None}}},
+                {"$group": {"_id": "$subject", "count": {"$sum": 1}}},
+            ],
+        },
+    }
+
+
+def plan_indexes(plan) -> list:
+    """Percorre a árvore do plano vencedor e devolve os índices usados (ou COLLSCAN)."""
+    found = []
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            found.append("COLLSCAN")
+        if "indexName" in plan:
+            found.append(plan["indexName"])
+        for value in plan.values():
+            found.extend(plan_indexes(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            found.extend(plan_indexes(item))
+    return found
+
+
+def winning_plan(explain: dict) -> dict:
+    if "queryPlanner" in explain:
+        return explain["queryPlanner"]["winningPlan"]
+    # aggregate: o plano fica no primeiro estágio ($cursor)
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    return explain
+
+
+@cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Cria (se necessário) o conjunto de índices declarado em server.INDEXES."""
+    asyncio.run(ensure_indexes())
+    for collection, indexes in INDEXES.items():
+        names = ", ".join(index.document["name"] for index in indexes)
+        typer.echo(f"{collection}: {names}")
+
+
+@cli.command("explain-indexes")
+def explain_indexes(
+    profile_id: str,
+    session_id: str = typer.Option("", help="Sessão usada nas consultas de mensagens"),
+    as_json: bool = typer.Option(False, "--json", help="Saída em JSON"),
+):
+    """Mostra, para cada consulta de rota, qual índice o MongoDB escolhe."""
+
+    async def run():
+        report = {}
+        for route, command in route_queries(profile_id, session_id).items():
+            explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+            report[route] = plan_indexes(winning_plan(explain)) or ["?"]
+        return report
+
+    report = asyncio.run(run())
+    if as_json:
+        typer.echo(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    for route, indexes in report.items():
+        typer.echo(f"{route:50} {', '.join(indexes)}")
+
+
+@cli.command("backfill-activity")
+def backfill_activity():
+    """Reconstrói o bitmap de atividade (activity_months) dos perfis a partir das mensagens."""
+
+    async def run():
+        pipeline = [
+            {"$match": {"role": "user"}},
+            {"$group": {"_id": {
+                "profile_id": "$profile_id",
+                # timestamp pode ainda ser string ISO (antes de migrate-timestamps)
+                "day": {"$cond": [
+                    {"$eq": [{"$type": "$timestamp"}, "string"]},
+                    {"$substrBytes": ["$timestamp", 0, 10]},
+                    {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+                ]},
+            }}},
+        ]
+        months = defaultdict(lambda: defaultdict(int))
+        async for row in db.messages.aggregate(pipeline):
+            day = datetime.strptime(row["_id"]["day"], "%Y-%m-%d")
+            field, mask = activity_bit(day)
+            months[row["_id"]["profile_id"]][field.split(".", 1)[1]] |= mask
+        for profile_id, bits in months.items():
+            await db.profiles.update_one({"id": profile_id}, {"$set": {"activity_months": dict(bits)}})
+        return len(months)
+
+    typer.echo(f"{asyncio.run(run())} perfis atualizados")
+
+
+TIMESTAMP_FIELDS = [
+    ("messages", "timestamp"),
+    ("sessions", "updated_at"),
+    ("sessions", "created_at"),
+    ("profiles", "created_at"),
+    ("profiles", "stats.last_activity"),
+]
+
+
+def parse_timestamp(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def nested(doc: dict, field: str):
+    for part in field.split("."):
+        doc = doc.get(part) if isinstance(doc, dict) else None
+    return doc
+
+
+async def migrate_field(collection: str, field: str, batch_size: int, pause: float) -> int:
+    """
+    Converte `field` de string ISO para datetime em lotes, do _id mais novo para o mais
+    antigo: durante a migração as datas (que no BSON ordenam depois das strings) são
+    sempre os documentos mais recentes, e a ordenação por data continua certa.
+    O progresso fica em `migrations`, então o comando pode ser interrompido e retomado.
+    """
+    checkpoint = f"timestamps:{collection}.{field}"
+    state = await db.migrations.find_one({"_id": checkpoint}) or {}
+    converted = state.get("converted", 0)
+    if state.get("done"):
+        return converted
+    last_id = state.get("last_id")
+    while True:
+        query = {field: {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$lt": last_id}
+        docs = await db[collection].find(query, {field: 1}).sort("_id", -1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            break
+        ops = []
+        for doc in docs:
+            value = nested(doc, field)
+            try:
+                # filtro com o valor lido: não sobrescreve uma gravação feita no meio tempo
+                ops.append(UpdateOne({"_id": doc["_id"], field: value}, {"$set": {field: parse_timestamp(value)}}))
+            except ValueError:
+                typer.echo(f"{collection} {doc['_id']}: {field} inválido ({value!r}), ignorado")
+        if ops:
+            result = await db[collection].bulk_write(ops, ordered=False)
+            converted += result.modified_count
+        last_id = docs[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": checkpoint}, {"$set": {"last_id": last_id, "converted": converted}}, upsert=True
+        )
+        if pause:
+            await asyncio.sleep(pause)
+    await db.migrations.update_one(
+        {"_id": checkpoint}, {"$set": {"done": True, "converted": converted}}, upsert=True
+    )
+    return converted
+
+
+@cli.command("migrate-timestamps")
+def migrate_timestamps(
+    batch_size: int = typer.Option(500, help="Documentos por lote"),
+    pause: float = typer.Option(0.0, help="Pausa entre lotes, em segundos (alivia o banco em produção)"),
+    restart: bool = typer.Option(False, help="Descarta o progresso salvo e recomeça"),
+):
+    """Converte datas gravadas como string ISO em datetime do BSON (online e retomável)."""
+
+    async def run():
+        if restart:
+            await db.migrations.delete_many({"_id": {"$regex": "^timestamps:"}})
+        return {
+            f"{collection}.{field}": await migrate_field(collection, field, batch_size, pause)
+            for collection, field in TIMESTAMP_FIELDS
+        }
+
+    for field, count in asyncio.run(run()).items():
+        typer.echo(f"{field:30} {count} convertidos")
+
+
+@cli.command("rebuild-stats")
+def rebuild_stats(
+    profile_id: str = typer.Option("", help="Recalcula só este perfil (padrão: todos)"),
+):
+    """Recalcula os contadores de progresso (profiles.stats) a partir das mensagens."""
+
+    async def run():
+        query = {"id": profile_id} if profile_id else {}
+        count = 0
+        async for profile in db.profiles.find(query, {"_id": 0, "id": 1}):
+            stats = await compute_progress_stats(profile["id"])
+            await db.profiles.update_one({"id": profile["id"]}, {"$set": {"stats": stats}})
+            count += 1
+        return count
+
+    typer.echo(f"{asyncio.run(run())} perfis recalculados")
+
+
+@cli.command("bench-prompt")
+def bench_prompt(iterations: int = typer.Option(10000, help="Montagens por medição")):
+    """Compara a montagem do prompt do sistema sem cache (cold) e com cache (cached)."""
+    profile = {
+        "name": "Estudante", "interesse_cultural": "League of Legends", "canal_sensorial": "visual",
+        "formato_explicacao": "analogias_historias", "abordagem": "pratica",
+        "motivador_principal": "desafios_metas",
+    }
+    prompt_cache.clear()
+    cold = timeit.timeit(lambda: render_system_prompt(profile, "Matemática"), number=iterations)
+    cached = timeit.timeit(lambda: build_system_prompt(profile, "Matemática"), number=iterations)
+    typer.echo(json.dumps({
+        "iterations": iterations,
+        "cold_us": round(cold / iterations * 1e6, 2),
+        "cached_us": round(cached / iterations * 1e6, 2),
+        "speedup": round(cold / cached, 1),
+        "cache": prompt_cache.stats(),
+    }))
+
+
+async def persist_turn_sequential(request: ChatRequest, user_msg: ChatMessage, response: str):
+    """Gravação do turno como era antes: uma ida ao banco de cada vez, sessão com find + insert/update."""
+    await db.messages.insert_one(user_msg.model_dump())
+    await db.profiles.find_one({"id": request.profile_id})  # leitura que o streak fazia antes do update
+    await update_streak(request.profile_id)
+    assistant_msg = ChatMessage(session_id=request.session_id, profile_id=request.profile_id,
+                                role="assistant", content=response, subject=request.subject)
+    await db.messages.insert_one(assistant_msg.model_dump())
+    session = await db.sessions.find_one({"id": request.session_id})
+    if not session:
+        doc = ChatSession(id=request.session_id, profile_id=request.profile_id,
+                          title=request.message, subject=request.subject).model_dump()
+        await db.sessions.insert_one(doc)
+    else:
+        await db.sessions.update_one({"id": request.session_id},
+                                     {"$set": {"updated_at": assistant_msg.timestamp}})
+    await record_progress(request.profile_id, request.subject, assistant_msg.timestamp, new_session=not session)
+
+
+@cli.command("bench-persist")
+def bench_persist(turns: int = typer.Option(200, help="Turnos gravados por modo")):
+    """
+    Mede a latência de banco por turno do chat (leituras + gravação) no MONGO_URL
+    configurado: sequencial (antigo) x paralelo/em lote (atual). Usa um perfil
+    descartável, removido no fim.
+    """
+    profile_id = f"bench-{uuid.uuid4()}"
+
+    async def run_mode(persist) -> dict:
+        samples = []
+        for i in range(turns):
+            request = ChatRequest(session_id=f"{profile_id}-{i // 10}", profile_id=profile_id,
+                                  message=f"pergunta {i}", subject="Matemática")
+            started = time.perf_counter()
+            if persist is persist_turn:
+                await asyncio.gather(db.profiles.find_one({"id": profile_id}), fetch_context(request.session_id))
+            else:
+                await db.profiles.find_one({"id": profile_id})
+                await fetch_context(request.session_id)
+            await persist(request, new_user_message(request), "resposta")
+            samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        return {
+            "mean_ms": round(statistics.fmean(samples), 2),
+            "p50_ms": round(samples[len(samples) // 2], 2),
+            "p95_ms": round(samples[int(len(samples) * 0.95)], 2),
+        }
+
+    async def run():
+        await db.profiles.insert_one({"id": profile_id, "name": "bench", "stats": empty_stats()})
+        try:
+            if write_behind:
+                write_behind.start()
+            sequential = await run_mode(persist_turn_sequential)
+            current = await run_mode(persist_turn)
+            if write_behind:
+                await write_behind.close()
+        finally:
+            await db.messages.delete_many({"profile_id": profile_id})
+            await db.sessions.delete_many({"profile_id": profile_id})
+            await db.profiles.delete_one({"id": profile_id})
+        return {
+            "turns": turns,
+            "write_behind": write_behind is not None,
+            "sequential": sequential,
+            "current": current,
+            "speedup": round(sequential["mean_ms"] / current["mean_ms"], 2),
+        }
+
+    typer.echo(json.dumps(asyncio.run(run())))
+
+
+@cli.command("chat-workers")
+def chat_workers(workers: int = typer.Option(4, help="Workers neste processo")):
+    """
+    Processa só a fila de jobs do chat (POST /chat com "job": true), sem servir HTTP.
+    Para separar a API dos workers, suba a API com CHAT_JOB_WORKERS=0.
+    """
+
+    async def run():
+        chat_jobs.workers = workers
+        await app.router.startup()
+        typer.echo(f"{workers} workers de chat rodando (Ctrl+C para parar)")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            # devolve à fila os jobs em andamento
+            await app.router.shutdown()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,29 +1,570 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import (
+    FastAPI, APIRouter, Depends, File, Form, Header, HTTPException, Query, Response, UploadFile, WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.routing import Match
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+import pymongo
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, PyMongoError
+import httpx
+import asyncio
+import base64
+import hashlib
+import hmac
+import io
+import json
+import math
 import os
+import re
+import sys
+import tempfile
+import threading
+import time
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from contextvars import Context, ContextVar
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 import uuid
 from datetime import datetime, timezone, timedelta
-from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContent
+from PIL import Image, ImageOps
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# o prometheus_client escolhe o modo multiprocesso no import, pelo ambiente:
+# importado só depois do .env, para ver o PROMETHEUS_MULTIPROC_DIR definido lá
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    values as prometheus_values,
+)
+
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR") and prometheus_values.ValueClass is prometheus_values.MutexValue:
+    raise RuntimeError(
+        "prometheus_client foi importado antes de PROMETHEUS_MULTIPROC_DIR ser definido; "
+        "defina a variável no ambiente do processo"
+    )
+
+# ------------ Metrics ------------
+# Métricas Prometheus em GET /metrics. Com vários workers do uvicorn, defina
+# PROMETHEUS_MULTIPROC_DIR (um diretório vazio, no ambiente antes de subir o
+# processo): cada worker grava seus valores ali e /metrics soma todos.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+SIZE_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requisições HTTP", ["method", "route", "status"])
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "Duração das requisições HTTP (streams: até o fim do stream)",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requisições HTTP em andamento", multiprocess_mode="livesum")
+MONGO_LATENCY = Histogram(
+    "mongo_operation_duration_seconds", "Duração dos comandos no MongoDB", ["collection", "operation"],
+    buckets=MONGO_BUCKETS,
+)
+MONGO_ERRORS = Counter("mongo_operation_errors_total", "Comandos do MongoDB que falharam", ["collection", "operation"])
+LLM_LATENCY = Histogram(
+    "llm_request_duration_seconds", "Duração das chamadas ao LLM (stream: até o último pedaço)",
+    ["kind"], buckets=LLM_BUCKETS,
+)
+LLM_ERRORS = Counter("llm_errors_total", "Chamadas ao LLM que falharam", ["kind", "reason"])
+LLM_FALLBACKS = Counter("llm_fallbacks_total", "Turnos respondidos com LLM_FALLBACK_RESPONSE", ["kind"])
+LLM_IN_FLIGHT = Gauge("llm_requests_in_flight", "Chamadas ao LLM em andamento", multiprocess_mode="livesum")
+LLM_PROMPT_CHARS = Histogram("llm_prompt_chars", "Tamanho do prompt (sistema + usuário), em caracteres", buckets=SIZE_BUCKETS)
+LLM_RESPONSE_CHARS = Histogram("llm_response_chars", "Tamanho da resposta do LLM, em caracteres", buckets=SIZE_BUCKETS)
+LLM_PATHS = Counter("llm_path_total", "Tentativa que respondeu: primary, hedge, fallback ou failed", ["kind", "path"])
+LLM_HEDGE_SAVED_EST = Histogram(
+    "llm_hedge_saved_estimate_seconds",
+    "Estimativa (pelo p99 recente) do tempo poupado quando o hedge respondeu antes da chamada original",
+    buckets=LLM_BUCKETS,
+)
+EVENT_LOOP_LAG = Gauge("event_loop_lag_seconds", "Atraso do event loop na última medição", multiprocess_mode="livemax")
+LLM_BREAKER_STATE = Gauge(
+    "llm_circuit_breaker_state", "Disjuntor do LLM: 0 fechado, 1 half-open, 2 aberto", multiprocess_mode="livemax",
+)
+LLM_BREAKER_TRANSITIONS = Counter("llm_circuit_breaker_transitions_total", "Mudanças de estado do disjuntor", ["state"])
+LLM_BREAKER_REJECTED = Counter("llm_circuit_breaker_rejected_total", "Turnos recusados com o disjuntor aberto")
+REQUEST_DEADLINE_EXCEEDED = Counter(
+    "request_deadline_exceeded_total", "Requisições que estouraram o prazo (stage: request, mongo ou llm)", ["route", "stage"],
+)
+REQUESTS_CANCELLED = Counter(
+    "requests_cancelled_total", "Requisições canceladas no meio (reason: deadline ou client_disconnect)", ["route", "reason"],
+)
+CHAT_JOB_QUEUE_LATENCY = Histogram(
+    "chat_job_queue_seconds", "Tempo de um job do chat na fila até um worker pegá-lo", buckets=LLM_BUCKETS,
+)
+CHAT_JOB_RUN_LATENCY = Histogram("chat_job_run_seconds", "Tempo de processamento de um job do chat", buckets=LLM_BUCKETS)
+CHAT_JOBS = Counter("chat_jobs_total", "Jobs do chat processados (outcome: done, failed, retried ou deferred)", ["outcome"])
+WS_CONNECTIONS = Gauge("websocket_connections", "Conexões WebSocket abertas", multiprocess_mode="livesum")
+WS_SLOW_CLOSED = Counter("websocket_slow_consumer_closed_total", "Conexões WebSocket derrubadas por cliente lento")
+ANSWER_CACHE_LOOKUPS = Counter("answer_cache_lookups_total", "Consultas ao cache de respostas (hit ou miss)", ["result"])
+
+class MongoMetrics(monitoring.CommandListener):
+    """Listener do driver: mede cada comando sem tocar nas chamadas ao banco."""
+    
+    def __init__(self):
+        self._pending = {}
+    
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else ""
+        self._pending[(event.connection_id, event.request_id)] = collection
+    
+    def succeeded(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            MONGO_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+    
+    def failed(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            MONGO_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+            MONGO_ERRORS.labels(collection, event.command_name).inc()
+
+class MetricsMiddleware:
+    """Middleware ASGI puro (não bufferiza o corpo, então funciona com SSE)."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # template da rota (sem ids), preenchido pelo roteamento do FastAPI
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            HTTP_REQUESTS.labels(scope["method"], route, str(status)).inc()
+            HTTP_LATENCY.labels(scope["method"], route).observe(time.perf_counter() - started)
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Mede quanto o sleep atrasa além do pedido: tempo em que o loop ficou bloqueado."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(loop.time() - started - interval, 0.0))
+
+def render_metrics() -> bytes:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+# ------------ Request Tracing ------------
+# Cada requisição acumula spans (etapa, duração) num contextvar. As etapas concluídas
+# até o início da resposta vão no cabeçalho Server-Timing; requisições acima de
+# SLOW_REQUEST_MS geram uma linha de log JSON com todas as etapas (inclusive as do
+# stream, que terminam depois do cabeçalho).
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '2000'))
+
+request_spans: ContextVar[Optional[list]] = ContextVar("request_spans", default=None)
+
+@contextmanager
+def span(name: str):
+    """Mede a etapa `name` da requisição atual (sem requisição, não faz nada)."""
+    spans = request_spans.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, time.perf_counter() - started))
+
+async def timed(name: str, awaitable):
+    with span(name):
+        return await awaitable
+
+def server_timing(spans: list, total: float) -> str:
+    entries = [f"{name};dur={duration * 1000:.1f}" for name, duration in spans]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+class TimingMiddleware:
+    """Middleware ASGI: abre a lista de spans, escreve o Server-Timing e o log de lentidão."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        spans = []
+        token = request_spans.set(spans)
+        status = 500
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = server_timing(spans, time.perf_counter() - started)
+                message["headers"] = [*message.get("headers", []), (b"server-timing", header.encode())]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_spans.reset(token)
+            total_ms = (time.perf_counter() - started) * 1000
+            if total_ms >= SLOW_REQUEST_MS:
+                route = scope.get("route")
+                logger.warning(json.dumps({
+                    "event": "slow_request",
+                    "method": scope["method"],
+                    "route": route.path if route is not None else scope["path"],
+                    "status": status,
+                    "total_ms": round(total_ms, 1),
+                    "stages": [{"name": name, "ms": round(duration * 1000, 1)} for name, duration in spans],
+                }, ensure_ascii=False))
+
+class SamplingProfiler:
+    """
+    Profiler por amostragem, ligado/desligado em tempo de execução (POST /api/debug/profiler).
+    Uma thread lê a pilha da thread do event loop a cada `interval` segundos e conta as
+    pilhas no formato "collapsed" (uma linha por pilha, pronta para flamegraph.pl/speedscope).
+    Desligado, não custa nada.
+    """
+    
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, interval: Optional[float] = None):
+        if self.running:
+            return
+        self.interval = interval or self.interval
+        self.samples = {}
+        self._stop.clear()
+        target = threading.get_ident()  # chamado de dentro do event loop
+        self._thread = threading.Thread(target=self._run, args=(target,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+    
+    def _run(self, target: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{Path(code.co_filename).name}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+    
+    def collapsed(self, limit: int = 200) -> str:
+        top = sorted(dict(self.samples).items(), key=lambda item: item[1], reverse=True)[:limit]
+        return "\n".join(f"{stack} {count}" for stack, count in top)
+
+profiler = SamplingProfiler()
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# ------------ Request Deadlines ------------
+# Cada rota tem um prazo total (REQUEST_DEADLINE; CHAT_DEADLINE e STREAM_DEADLINE
+# para o chat). Dentro dele, todo comando do MongoDB roda sob pymongo.timeout (o
+# driver manda maxTimeMS e limita a espera no socket) e o LLM recebe só o que
+# sobrou. Estourado o prazo, ou se o cliente desconectar, o trabalho é cancelado;
+# o estouro vira 504 com "error": "deadline_exceeded" e entra em
+# request_deadline_exceeded_total. Tarefas de spawn() ficam fora do prazo.
+
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '10'))
+CHAT_DEADLINE = float(os.environ.get('CHAT_DEADLINE', '45'))
+STREAM_DEADLINE = float(os.environ.get('STREAM_DEADLINE', '120'))
+ROUTE_DEADLINES = {
+    "/api/chat": CHAT_DEADLINE,
+    # o maior dos dois: sem stream=true o handler reduz para CHAT_DEADLINE
+    "/api/chat/upload": STREAM_DEADLINE,
+    "/api/chat/stream": STREAM_DEADLINE,
+    "/api/chat/jobs/{job_id}": CHAT_DEADLINE,
+    "/api/chat/jobs/{job_id}/events": STREAM_DEADLINE,
+}
+
+# parte do prazo que o LLM deixa livre para gravar o turno e responder
+LLM_BUDGET_MARGIN = 1.0
+
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+request_route: ContextVar[str] = ContextVar("request_route", default="unmatched")
+
+def budget_left() -> float:
+    """Segundos até o prazo da requisição atual (infinito fora de uma requisição)."""
+    deadline = request_deadline.get()
+    return math.inf if deadline is None else deadline - time.monotonic()
+
+@contextmanager
+def restrict_deadline(total: float):
+    """
+    Reduz o prazo da requisição atual para `total` segundos desde o início dela, para
+    rotas cujo prazo depende do corpo. O LLM e o MongoDB passam a respeitar o prazo menor.
+    """
+    deadline = request_deadline.get()
+    if deadline is None:
+        yield
+        return
+    deadline -= max(ROUTE_DEADLINES.get(request_route.get(), REQUEST_DEADLINE) - total, 0)
+    token = request_deadline.set(deadline)
+    try:
+        with pymongo.timeout(max(deadline - time.monotonic(), 0.001)):
+            yield
+    finally:
+        request_deadline.reset(token)
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self, stage: str):
+        REQUEST_DEADLINE_EXCEEDED.labels(request_route.get(), stage).inc()
+        super().__init__(status_code=504, detail={"error": "deadline_exceeded", "stage": stage})
+
+def detached_context() -> Context:
+    """
+    Contexto novo para tarefas em segundo plano: sem o prazo da requisição (nem o
+    do pymongo.timeout, que não dá para desfazer numa cópia), mas com os spans dela.
+    """
+    context = Context()
+    context.run(request_spans.set, request_spans.get())
+    return context
+
+def match_route(scope) -> str:
+    for route in app.router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return route.path
+    return "unmatched"
+
+def has_body(scope) -> bool:
+    for name, value in scope["headers"]:
+        if name == b"transfer-encoding" or (name == b"content-length" and value != b"0"):
+            return True
+    return False
+
+class DeadlineMiddleware:
+    """
+    Middleware ASGI: roda a requisição numa task com o prazo da rota e a cancela se
+    o prazo acabar ou o cliente desconectar antes da resposta terminar.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = match_route(scope)
+        budget = ROUTE_DEADLINES.get(route, REQUEST_DEADLINE)
+        started = finished = False
+        disconnected = asyncio.Event()
+        watcher: Optional[asyncio.Task] = None
+        empty_body = not has_body(scope)  # corpo vazio ainda não entregue ao app
+        
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+        
+        async def receive_wrapper():
+            nonlocal watcher, empty_body
+            if watcher is not None:
+                # o corpo já foi lido: daqui em diante só resta o aviso de desconexão
+                if empty_body:
+                    empty_body = False
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            elif not message.get("more_body"):
+                watcher = asyncio.ensure_future(watch_disconnect())
+            return message
+        
+        async def send_wrapper(message):
+            nonlocal started, finished
+            if message["type"] == "http.response.start":
+                started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                finished = True
+            await send(message)
+        
+        if empty_body:
+            # sem corpo para ler: já dá para vigiar a desconexão
+            watcher = asyncio.ensure_future(watch_disconnect())
+        
+        tokens = request_route.set(route), request_deadline.set(time.monotonic() + budget)
+        with pymongo.timeout(budget):
+            task = asyncio.ensure_future(self.app(scope, receive_wrapper, send_wrapper))
+        request_deadline.reset(tokens[1])
+        request_route.reset(tokens[0])
+        
+        gone = asyncio.ensure_future(disconnected.wait())
+        try:
+            await asyncio.wait({task, gone}, timeout=budget, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done() and not finished:
+                reason = "client_disconnect" if disconnected.is_set() else "deadline"
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                REQUESTS_CANCELLED.labels(route, reason).inc()
+                if reason == "deadline":
+                    REQUEST_DEADLINE_EXCEEDED.labels(route, "request").inc()
+                    if not started:
+                        await send_json(send, 504, {"detail": {"error": "deadline_exceeded", "stage": "request"}})
+                return
+            # resposta já enviada (ou terminando): deixa as tarefas de fundo da rota concluírem
+            await task
+        finally:
+            task.cancel()
+            gone.cancel()
+            if watcher is not None:
+                watcher.cancel()
+
+class BodyLimitMiddleware:
+    """
+    Middleware ASGI: recusa com 413 corpos acima do limite da rota antes que o parser
+    de multipart do Starlette grave o upload inteiro num arquivo temporário. Pelo
+    Content-Length na hora; sem ele, contando os bytes conforme chegam.
+    """
+    
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+    
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        too_large = HTTPException(status_code=413, detail="Imagem muito grande")
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            return await send_json(send, 413, {"detail": too_large.detail})
+        received = 0
+        
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # HTTPException passa pelo parser do FastAPI e vira a resposta 413
+                    raise too_large
+            return message
+        
+        await self.app(scope, receive_limited, send)
+
+async def send_json(send, status: int, content: dict):
+    body = json.dumps(content).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
 mongo_url = os.environ.get('MONGO_URL')
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware: datas do BSON voltam em UTC com fuso, como os datetimes dos modelos
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[MongoMetrics()])
 db = client[os.environ.get('DB_NAME')]
 
 GOOGLE_AI_API_KEY = os.environ.get('GOOGLE_AI_API_KEY')
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
+
+MAX_CALENDAR_DAYS = 731
+
+LLM_FALLBACK_RESPONSE = "Desculpe, tive um problema ao processar sua pergunta. Pode tentar novamente?"
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
+# ------------ Indexes ------------
+
+# Um índice por padrão de consulta das rotas (filtro + ordenação)
+INDEXES = {
+    "profiles": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        # histórico do chat e /sessions/{profile_id}/{session_id}/messages
+        # id desempata a paginação por cursor (timestamp, id)
+        IndexModel([("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], name="session_timestamp_id"),
+        # idempotência das retentativas (só mensagens com request_id)
+        IndexModel(
+            [("session_id", ASCENDING), ("request_id", ASCENDING), ("role", ASCENDING)],
+            unique=True, name="session_request_role",
+            partialFilterExpression={"request_id": {"$type": "string"}},
+        ),
+        # contagem de mensagens do aluno
+        IndexModel([("profile_id", ASCENDING), ("role", ASCENDING), ("timestamp", ASCENDING)], name="profile_role_timestamp"),
+        # última atividade e agregações por matéria (rebuild-stats)
+        IndexModel([("profile_id", ASCENDING), ("timestamp", DESCENDING)], name="profile_timestamp"),
+    ],
+    "sessions": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("profile_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)], name="profile_updated_id"),
+    ],
+    # usado só com IMAGE_ANALYSIS_CACHE=1
+    "image_analysis": [
+        IndexModel([("sha256", ASCENDING)], unique=True, name="sha256_unique"),
+    ],
+    # usado só com ANSWER_CACHE=mongo
+    "answer_cache": [
+        IndexModel([("key", ASCENDING)], unique=True, name="key_unique"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "chat_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("key", ASCENDING)], unique=True, name="key_unique"),
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease_until"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+}
+
+async def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except PyMongoError as e:
+            logging.error(f"Error creating indexes on {collection}: {e}")
+
 # ------------ Models ------------
+# Datas são gravadas como datetime do BSON. Documentos antigos podem ter strings ISO
+# até rodar `manage.py migrate-timestamps`; os modelos aceitam os dois formatos.
 
 class UserProfile(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -69,6 +610,7 @@ class ChatMessage(BaseModel):
     content: str
     subject: Optional[str] = None
     has_image: bool = False
+    request_id: Optional[str] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ChatRequest(BaseModel):
@@ -77,6 +619,12 @@ class ChatRequest(BaseModel):
     message: str
     subject: str
     image_base64: Optional[str] = None
+    # Devolve sessões/streak/progresso atualizados junto com a resposta
+    include_dashboard: bool = False
+    # Id gerado pelo cliente: retentativas com o mesmo id não duplicam o turno
+    request_id: Optional[str] = None
+    # Responde 202 com um job_id e processa o turno em segundo plano (ver Chat Jobs)
+    job: bool = False
 
 class ChatSession(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -104,7 +652,92 @@ class ProgressStats(BaseModel):
 
 # ------------ NOVO SISTEMA DE PROMPTS OTIMIZADO PARA ANALOGIAS ------------
 
+# Mapear canal VARK para instruções
+VARK_INSTRUCTIONS = {
+    "visual": "Use descrições visuais, diagramas mentais, cores e formas. Sugira que o aluno visualize ou desenhe.",
+    "auditivo": "Explique como se conversasse, use ritmo e repetição. Sugira explicar em voz alta.",
+    "leitura_escrita": "Use listas, definições claras e resumos estruturados. Sugira anotações.",
+    "cinestesico": "Use exemplos práticos, experimentos mentais e aplicações do dia a dia."
+}
+
+# Mapear formato para instruções
+FORMATO_INSTRUCTIONS = {
+    "curta_objetiva": "Respostas curtas com bullet points. Máximo 3-4 parágrafos.",
+    "detalhada_aprofundada": "Explicações completas com contexto.",
+    "exemplos_praticos": "Muitos exemplos práticos do cotidiano.",
+    "analogias_historias": "Use analogias criativas e storytelling."
+}
+
+# Campos do perfil que aparecem no prompt (junto com a matéria formam a chave do cache)
+PROMPT_FIELDS = (
+    'name', 'interesse_cultural', 'canal_sensorial',
+    'formato_explicacao', 'abordagem', 'motivador_principal',
+)
+
+class LRUCache:
+    """Cache LRU em memória, limitado em número de entradas, com TTL opcional."""
+    
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] < time.monotonic():
+            del self._data[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+    
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def discard_where(self, predicate) -> int:
+        keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+prompt_cache = LRUCache(int(os.environ.get('PROMPT_CACHE_SIZE', '512')))
+
+def prompt_shape(profile: dict) -> tuple:
+    return tuple(profile.get(field) for field in PROMPT_FIELDS)
+
 def build_system_prompt(profile: dict, subject: str) -> str:
+    """Prompt do sistema, memorizado por (campos de PROMPT_FIELDS, matéria)."""
+    key = prompt_shape(profile) + (subject,)
+    prompt = prompt_cache.get(key)
+    if prompt is None:
+        prompt = render_system_prompt(profile, subject)
+        prompt_cache.set(key, prompt)
+    return prompt
+
+def invalidate_system_prompts(profile: dict) -> int:
+    """Descarta os prompts gerados a partir dos valores (antigos) deste perfil."""
+    shape = prompt_shape(profile)
+    return prompt_cache.discard_where(lambda key: key[:-1] == shape)
+
+def render_system_prompt(profile: dict, subject: str) -> str:
     """
     Prompt otimizado para gerar analogias perfeitas baseadas nos interesses do aluno.
     Seguindo a metodologia: [ANALOGIA] → [EXPLICAÇÃO] → [VOLTA AO CONCEITO]
@@ -116,23 +749,6 @@ def build_system_prompt(profile: dict, subject: str) -> str:
     formato = profile.get('formato_explicacao', 'analogias_historias')
     abordagem = profile.get('abordagem', 'pratica')
     motivacao = profile.get('motivador_principal', 'desafios_metas')
-    estrategia = profile.get('estrategia_dificuldade', 'busca_exemplos')
-    
-    # Mapear canal VARK para instruções
-    vark_instructions = {
-        "visual": "Use descrições visuais, diagramas mentais, cores e formas. Sugira que o aluno visualize ou desenhe.",
-        "auditivo": "Explique como se conversasse, use ritmo e repetição. Sugira explicar em voz alta.",
-        "leitura_escrita": "Use listas, definições claras e resumos estruturados. Sugira anotações.",
-        "cinestesico": "Use exemplos práticos, experimentos mentais e aplicações do dia a dia."
-    }
-    
-    # Mapear formato para instruções
-    formato_instructions = {
-        "curta_objetiva": "Respostas curtas com bullet points. Máximo 3-4 parágrafos.",
-        "detalhada_aprofundada": "Explicações completas com contexto.",
-        "exemplos_praticos": "Muitos exemplos práticos do cotidiano.",
-        "analogias_historias": "Use analogias criativas e storytelling."
-    }
     
     return f"""Você é REVISAHUB, tutor de IA do ensino médio brasileiro.
 Seu ÚNICO foco nesta resposta: EXPLICAR USANDO ANALOGIA PERFEITA.
@@ -197,10 +813,10 @@ Use esta estrutura:
 ## INSTRUÇÕES DE PERSONALIZAÇÃO
 
 ### Canal Sensorial ({canal.upper()})
-{vark_instructions.get(canal, vark_instructions['visual'])}
+{VARK_INSTRUCTIONS.get(canal, VARK_INSTRUCTIONS['visual'])}
 
 ### Formato de Resposta
-{formato_instructions.get(formato, formato_instructions['analogias_historias'])}
+{FORMATO_INSTRUCTIONS.get(formato, FORMATO_INSTRUCTIONS['analogias_historias'])}
 
 ---
 
@@ -301,353 +917,2816 @@ Seja motivador, positivo e celebre o esforço do aluno {name}!"""
 
 
 # ------------ Streak Functions ------------
-
-async def update_streak(profile_id: str) -> dict:
-    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
-    if not profile:
-        return None
-    
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    last_activity = profile.get('last_activity_date')
-    current_streak = profile.get('current_streak', 0)
-    longest_streak = profile.get('longest_streak', 0)
-    total_study_days = profile.get('total_study_days', 0)
+# A transição do streak roda inteira no servidor (pipeline de update, MongoDB 4.2+):
+# uma ida ao banco por turno e sem corrida entre mensagens simultâneas. O dia só
+# conta uma vez porque "dia novo" = bit do dia ainda não marcado em activity_months.
+# streak_prev/streak_prev_date guardam a sequência anterior ao último dia novo, para
+# quando uma mensagem de antes da meia-noite é gravada depois de uma do dia seguinte.
+
+STREAK_FIELDS = {"_id": 0, "current_streak": 1, "longest_streak": 1, "total_study_days": 1, "activity_months": 1}
+
+def streak_update(profile_id: str, now: Optional[datetime] = None) -> Tuple[dict, list]:
+    """Filtro e pipeline de update que registram o estudo no dia de `now` (UTC)."""
+    now = now or datetime.now(timezone.utc)
+    today = now.strftime("%Y-%m-%d")
+    yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    tomorrow = (now + timedelta(days=1)).strftime("%Y-%m-%d")
+    activity_field, activity_mask = activity_bit(now)
     
-    if last_activity == today:
-        return {
-            "current_streak": current_streak,
-            "longest_streak": longest_streak,
-            "total_study_days": total_study_days,
-            "studied_today": True
-        }
-    
-    yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    if last_activity == yesterday:
-        current_streak += 1
-    elif last_activity is None or last_activity < yesterday:
-        current_streak = 1
+    last = "$last_activity_date"
+    streak = {"$ifNull": ["$current_streak", 0]}
+    prev = {"$ifNull": ["$streak_prev", 0]}
+    bits = {"$ifNull": [f"${activity_field}", 0]}
+    # sem $bitAnd (só no 6.3+): testa o bit com divisão inteira
+    bit_set = {"$eq": [{"$mod": [{"$floor": {"$divide": [bits, activity_mask]}}, 2]}, 1]}
+    # sequência que termina hoje, quando hoje chega depois de amanhã já gravado
+    late_run = {"$cond": [{"$eq": ["$streak_prev_date", yesterday]}, {"$add": [prev, 1]}, 1]}
     
-    if current_streak > longest_streak:
-        longest_streak = current_streak
-    
-    total_study_days += 1
+    def transition(same_day, after_yesterday, late, ahead, new):
+        return {"$switch": {
+            "branches": [
+                {"case": {"$not": ["$_new_day"]}, "then": same_day},
+                {"case": {"$eq": [last, yesterday]}, "then": after_yesterday},
+                {"case": {"$eq": [last, tomorrow]}, "then": late},
+                {"case": {"$gt": [last, today]}, "then": ahead},
+            ],
+            "default": new,
+        }}
     
-    await db.profiles.update_one(
-        {"id": profile_id},
+    pipeline = [
+        {"$set": {"_new_day": {"$and": [{"$ne": [last, today]}, {"$not": [bit_set]}]}}},
         {"$set": {
-            "current_streak": current_streak,
-            "longest_streak": longest_streak,
-            "last_activity_date": today,
-            "total_study_days": total_study_days
-        }}
+            "current_streak": transition(streak, {"$add": [streak, 1]}, {"$add": [late_run, 1]}, streak, 1),
+            "streak_prev": transition(prev, streak, late_run, prev, streak),
+            "streak_prev_date": transition("$streak_prev_date", last, today, "$streak_prev_date", last),
+            "total_study_days": {"$add": [
+                {"$ifNull": ["$total_study_days", 0]}, {"$cond": ["$_new_day", 1, 0]},
+            ]},
+            "last_activity_date": {"$max": [last, today]},
+            activity_field: {"$cond": [bit_set, bits, {"$add": [bits, activity_mask]}]},
+        }},
+        {"$set": {"longest_streak": {"$max": [{"$ifNull": ["$longest_streak", 0]}, "$current_streak"]}}},
+        {"$unset": "_new_day"},
+    ]
+    return {"id": profile_id}, pipeline
+
+async def update_streak(profile_id: str, now: Optional[datetime] = None) -> Optional[dict]:
+    """Registra o estudo de hoje e devolve os valores novos do streak (None se o perfil não existe)."""
+    query, pipeline = streak_update(profile_id, now)
+    profile = await db.profiles.find_one_and_update(
+        query, pipeline, projection=STREAK_FIELDS, return_document=ReturnDocument.AFTER
     )
-    
+    if not profile:
+        return None
     return {
-        "current_streak": current_streak,
-        "longest_streak": longest_streak,
-        "total_study_days": total_study_days,
-        "studied_today": True
+        "current_streak": profile["current_streak"],
+        "longest_streak": profile["longest_streak"],
+        "total_study_days": profile["total_study_days"],
+        "studied_today": True,
+        "streak_calendar": get_streak_calendar(profile, end=now),
     }
 
-async def get_streak_calendar(profile_id: str) -> List[str]:
-    today = datetime.now(timezone.utc)
+def activity_bit(day: datetime) -> Tuple[str, int]:
+    """Campo e bit do dia no bitmap mensal (`activity_months.YYYY-MM`, bit = dia - 1)."""
+    return f"activity_months.{day.strftime('%Y-%m')}", 1 << (day.day - 1)
+
+def get_streak_calendar(profile: dict, days: int = 7, end: Optional[datetime] = None) -> List[str]:
+    """
+    Calendário dos últimos `days` dias até `end` (inclusive), lido do bitmap
+    de atividade do perfil: cada posição é a data (YYYY-MM-DD) ou "" se não estudou.
+    """
+    end = end or datetime.now(timezone.utc)
+    months = profile.get('activity_months') or {}
     calendar = []
     
-    for i in range(6, -1, -1):
-        day = (today - timedelta(days=i)).strftime("%Y-%m-%d")
-        activity = await db.messages.find_one({
-            "profile_id": profile_id,
-            "role": "user",
-            "timestamp": {"$regex": f"^{day}"}
-        })
-        calendar.append(day if activity else "")
+    for i in range(days - 1, -1, -1):
+        day = end - timedelta(days=i)
+        bits = months.get(day.strftime("%Y-%m"), 0)
+        calendar.append(day.strftime("%Y-%m-%d") if bits >> (day.day - 1) & 1 else "")
     
     return calendar
 
-# ------------ Routes ------------
+# ------------ Progress Stats Functions ------------
+# Contadores de /progress mantidos no próprio perfil (campo `stats`), atualizados a cada turno.
+# Os $inc só valem para perfis que já têm `stats`: os anteriores aos contadores são
+# recalculados na primeira leitura (ensure_stats), já contando os turnos do meio tempo.
 
-@api_router.get("/")
-async def root():
-    return {"message": "REVISAHUB API - Tutor de IA com Analogias Personalizadas"}
+def stats_subject_key(subject: str) -> str:
+    # "." e "$" inicial não são aceitos em caminhos de update, nem um trecho vazio
+    return subject.replace(".", "_").replace("\0", "_").lstrip("$") or "geral"
 
-@api_router.post("/profiles", response_model=UserProfile)
-async def create_profile(profile: UserProfileCreate):
-    profile_obj = UserProfile(**profile.model_dump())
-    doc = profile_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.profiles.insert_one(doc)
-    return profile_obj
+def empty_stats() -> dict:
+    # sem last_activity: o primeiro $max cria o campo
+    return {"total_sessions": 0, "total_messages": 0, "subject_counts": {}, "subject_names": {}}
 
-@api_router.get("/profiles/{profile_id}", response_model=UserProfile)
-async def get_profile(profile_id: str):
-    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
-    if not profile:
-        raise HTTPException(status_code=404, detail="Perfil não encontrado")
-    if isinstance(profile.get('created_at'), str):
-        profile['created_at'] = datetime.fromisoformat(profile['created_at'])
-    return profile
+def progress_update(profile_id: str, subject: str, last_activity: datetime, new_session: bool = False) -> UpdateOne:
+    key = stats_subject_key(subject)
+    inc = {
+        "stats.total_messages": 1,
+        f"stats.subject_counts.{key}": 1,
+    }
+    if new_session:
+        inc["stats.total_sessions"] = 1
+    return UpdateOne({"id": profile_id, "stats": {"$exists": True}}, {
+        "$inc": inc,
+        # a chave perde "." e "$"; o nome original vai ao lado para o /progress
+        "$set": {f"stats.subject_names.{key}": subject},
+        "$max": {"stats.last_activity": last_activity},
+    })
+
+async def record_progress(profile_id: str, subject: str, last_activity: datetime, new_session: bool = False):
+    op = progress_update(profile_id, subject, last_activity, new_session)
+    if write_behind:
+        write_behind.add("profiles", op)
+    else:
+        await db.profiles.bulk_write([op])
 
-@api_router.put("/profiles/{profile_id}")
-async def update_profile(profile_id: str, updates: dict):
-    result = await db.profiles.update_one(
-        {"id": profile_id},
-        {"$set": updates}
+async def compute_progress_stats(profile_id: str) -> dict:
+    """Recalcula os contadores de `stats` a partir das mensagens e sessões gravadas."""
+    total_sessions = await db.sessions.count_documents({"profile_id": profile_id})
+    
+    subjects_pipeline = [
+        {"$match": {"profile_id": profile_id, "role": "user", "subject": {"$exists": True, "$ne": None}}},
+        {"$group": {"_id": "$subject", "count": {"$sum": 1}}},
+    ]
+    subject_counts, subject_names = {}, {}
+    async for row in db.messages.aggregate(subjects_pipeline):
+        key = stats_subject_key(row["_id"])
+        subject_counts[key] = subject_counts.get(key, 0) + row["count"]
+        subject_names[key] = row["_id"]
+    
+    total_messages = await db.messages.count_documents({"profile_id": profile_id, "role": "user"})
+    
+    last_msg = await db.messages.find_one(
+        {"profile_id": profile_id},
+        {"_id": 0, "timestamp": 1},
+        sort=[("timestamp", -1)]
     )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Perfil não encontrado")
-    return {"status": "updated"}
+    
+    return {
+        "total_sessions": total_sessions,
+        "total_messages": total_messages,
+        "subject_counts": subject_counts,
+        "subject_names": subject_names,
+        "last_activity": last_msg.get('timestamp') if last_msg else None,
+    }
 
-@api_router.post("/chat")
-async def chat(request: ChatRequest):
-    profile = await db.profiles.find_one({"id": request.profile_id}, {"_id": 0})
-    if not profile:
-        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+async def ensure_stats(profile: dict) -> dict:
+    """Preenche `stats` de um perfil anterior aos contadores, recalculando uma única vez."""
+    if "stats" not in profile:
+        stats = await compute_progress_stats(profile["id"])
+        await db.profiles.update_one({"id": profile["id"], "stats": {"$exists": False}}, {"$set": {"stats": stats}})
+        profile["stats"] = stats
+    return profile
+
+# ------------ Write-behind ------------
+# Com WRITE_BEHIND=1 as gravações que não afetam a resposta (streak e contadores
+# de `stats`) entram numa fila aplicada em lote a cada WRITE_BEHIND_INTERVAL
+# segundos, com um bulk_write por coleção.
+
+class WriteBehind:
+    def __init__(self, interval: float, max_batch: int):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: List[tuple] = []
+        self._full = asyncio.Event()
+        self._cycle = asyncio.Event()  # setado quando o lote pendente for aplicado
+        self._last = asyncio.Event()  # último lote em aplicação
+        self._last.set()
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
     
-    # Update streak
-    await update_streak(request.profile_id)
+    def add(self, collection: str, op: UpdateOne):
+        self._pending.append((collection, op))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
     
-    # Save user message
-    user_msg = ChatMessage(
-        session_id=request.session_id,
-        profile_id=request.profile_id,
-        role="user",
-        content=request.message,
-        subject=request.subject,
-        has_image=bool(request.image_base64)
-    )
-    user_doc = user_msg.model_dump()
-    user_doc['timestamp'] = user_doc['timestamp'].isoformat()
-    await db.messages.insert_one(user_doc)
+    def start(self):
+        self._task = asyncio.create_task(self._run())
     
-    # Build NOVO system prompt otimizado para analogias
-    system_prompt = build_system_prompt(profile, request.subject)
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # shield: o cancelamento no shutdown não interrompe um lote no meio
+            await asyncio.shield(self.flush())
     
-    # Get chat history
-    history = await db.messages.find(
-        {"session_id": request.session_id},
-        {"_id": 0}
-    ).sort("timestamp", -1).limit(6).to_list(6)
-    history.reverse()
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, done = self._pending, self._cycle
+        self._pending, self._cycle, self._last = [], asyncio.Event(), done
+        self._full.clear()
+        try:
+            await self._apply(batch)
+        finally:
+            done.set()
     
-    # Initialize Gemini chat
-    chat_instance = LlmChat(
-        api_key=GOOGLE_AI_API_KEY,
-        session_id=request.session_id,
-        system_message=system_prompt
-    ).with_model("gemini", "gemini-2.0-flash")
+    async def _apply(self, batch: List[tuple]):
+        ops = {}
+        for collection, op in batch:
+            ops.setdefault(collection, []).append(op)
+        # ordered=False: uma falha não impede as demais (cada update é independente)
+        writes = [db[name].bulk_write(items, ordered=False) for name, items in ops.items()]
+        results = await asyncio.gather(*writes, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        for error in errors:
+            logging.error(f"Write-behind batch error: {error}")
+        self.batches += 1
+        self.writes += len(batch)
+        self.failed += len(errors)
     
-    # Build user message with context
-    interesse = profile.get('interesse_cultural', 'cultura pop')
+    async def settled(self):
+        """Espera até que tudo o que já foi enfileirado esteja gravado."""
+        await (self._cycle if self._pending else self._last).wait()
     
-    if request.image_base64:
-        image_data = request.image_base64
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        # Detectar o tipo de imagem
-        content_type = "image/jpeg"
-        if image_data.startswith('/9j/'):
-            content_type = "image/jpeg"
-        elif image_data.startswith('iVBORw'):
-            content_type = "image/png"
-        elif image_data.startswith('R0lGOD'):
-            content_type = "image/gif"
-        elif image_data.startswith('UklGR'):
-            content_type = "image/webp"
-        
-        file_content = FileContent(content_type=content_type, file_content_base64=image_data)
-        
-        user_message = UserMessage(
-            text=f"""[Matéria: {request.subject}]
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        await self._last.wait()
+        await self.flush()
+    
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "batches": self.batches, "writes": self.writes, "failed": self.failed}
+
+write_behind = WriteBehind(
+    interval=float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.05')),
+    max_batch=int(os.environ.get('WRITE_BEHIND_MAX_BATCH', '500')),
+) if os.environ.get('WRITE_BEHIND', '') == '1' else None
+
+async def touch_streak(profile_id: str) -> Optional[StreakInfo]:
+    """Streak novo do perfil; None com write-behind, em que o update ainda não foi aplicado."""
+    if write_behind:
+        write_behind.add("profiles", UpdateOne(*streak_update(profile_id)))
+        return None
+    streak = await update_streak(profile_id)
+    return StreakInfo(**streak) if streak else None
 
-QUESTÃO DO ALUNO: {request.message}
+# ------------ Answer Cache ------------
+# Respostas reaproveitadas entre alunos com o mesmo "formato" de perfil que fazem a
+# mesma pergunta (com a mesma foto, se houver). Só vale para a primeira pergunta da
+# sessão: com histórico a resposta depende do contexto da conversa.
 
-INSTRUÇÃO: 
-1. Analise a imagem cuidadosamente
-2. COMECE com analogia de "{interesse}" nas PRIMEIRAS 2 LINHAS
-3. Use estrutura: [ANALOGIA] → [EXPLICAÇÃO] → [VOLTA AO CONCEITO]
-4. Seja específico e memorável!""",
-            file_contents=[file_content]
-        )
-    else:
-        # Build context from history
-        context = ""
-        for msg in history[:-1]:
-            role_label = "Aluno" if msg['role'] == 'user' else "Tutor"
-            content = msg['content'][:150] + "..." if len(msg['content']) > 150 else msg['content']
-            context += f"{role_label}: {content}\n"
-        
-        full_message = f"""[Matéria: {request.subject}]
+# Campos do perfil que mudam a resposta (o nome é trocado por um marcador)
+ANSWER_CACHE_FIELDS = tuple(field for field in PROMPT_FIELDS if field != 'name')
+ANSWER_NAME_PLACEHOLDER = "{{nome_do_aluno}}"
+NAME_PARTICLES = {"de", "da", "do", "das", "dos", "e"}
 
-{"Contexto da conversa:" + chr(10) + context + chr(10) if context else ""}
-QUESTÃO DO ALUNO: {request.message}
+class MemoryAnswerCache:
+    """Cache local do processo (LRU + TTL)."""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = LRUCache(maxsize, ttl)
+    
+    async def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+    
+    async def set(self, key: str, answer: str):
+        self._cache.set(key, answer)
+    
+    def stats(self) -> dict:
+        return {"backend": "memory", **self._cache.stats()}
 
-INSTRUÇÃO: 
-1. COMECE com analogia de "{interesse}" nas PRIMEIRAS 2 LINHAS
-2. Use estrutura: [ANALOGIA] → [EXPLICAÇÃO] → [VOLTA AO CONCEITO]
-3. Seja específico e memorável!"""
-        
-        user_message = UserMessage(text=full_message)
+class MongoAnswerCache:
+    """Cache compartilhado entre workers na coleção `answer_cache` (expiração pelo índice TTL)."""
     
-    try:
-        response = await chat_instance.send_message(user_message)
-    except Exception as e:
-        logging.error(f"Error calling Gemini: {e}")
-        response = "Desculpe, tive um problema ao processar sua pergunta. Pode tentar novamente?"
+    def __init__(self, collection, ttl: float):
+        self.collection = collection
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
     
-    # Save assistant message
-    assistant_msg = ChatMessage(
-        session_id=request.session_id,
-        profile_id=request.profile_id,
-        role="assistant",
-        content=response,
-        subject=request.subject
-    )
-    assistant_doc = assistant_msg.model_dump()
-    assistant_doc['timestamp'] = assistant_doc['timestamp'].isoformat()
-    await db.messages.insert_one(assistant_doc)
-    
-    # Update or create session
-    session = await db.sessions.find_one({"id": request.session_id})
-    if not session:
-        new_session = ChatSession(
-            id=request.session_id,
-            profile_id=request.profile_id,
-            title=request.message[:50] + "..." if len(request.message) > 50 else request.message,
-            subject=request.subject
+    async def get(self, key: str) -> Optional[str]:
+        doc = await self.collection.find_one(
+            {"key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "answer": 1}
         )
-        session_doc = new_session.model_dump()
-        session_doc['created_at'] = session_doc['created_at'].isoformat()
-        session_doc['updated_at'] = session_doc['updated_at'].isoformat()
-        await db.sessions.insert_one(session_doc)
-    else:
-        await db.sessions.update_one(
-            {"id": request.session_id},
-            {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+        if doc is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return doc["answer"]
+    
+    async def set(self, key: str, answer: str):
+        await self.collection.update_one(
+            {"key": key},
+            {"$set": {"answer": answer, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl)}},
+            upsert=True
         )
     
-    return {
-        "response": response,
-        "message_id": assistant_msg.id,
-        "session_id": request.session_id
-    }
+    def stats(self) -> dict:
+        return {"backend": "mongo", "hits": self.hits, "misses": self.misses}
+
+def make_answer_cache():
+    backend = os.environ.get('ANSWER_CACHE', '').lower()
+    ttl = float(os.environ.get('ANSWER_CACHE_TTL', '86400'))
+    if backend == 'memory':
+        return MemoryAnswerCache(int(os.environ.get('ANSWER_CACHE_SIZE', '2048')), ttl)
+    if backend == 'mongo':
+        return MongoAnswerCache(db.answer_cache, ttl)
+    return None
+
+answer_cache = make_answer_cache()
+
+def normalize_question(text: str) -> str:
+    return " ".join(text.lower().split()).strip(" ?!.")
+
+def answer_cache_key(
+    request: ChatRequest, profile: dict, context: "ChatContext", image: Optional["ChatImage"] = None,
+) -> Optional[str]:
+    """Chave do cache ou None quando a pergunta não pode ser reaproveitada."""
+    if answer_cache is None or not context.is_empty():
+        return None
+    parts = [normalize_question(request.message), request.subject]
+    parts += [profile.get(field) for field in ANSWER_CACHE_FIELDS]
+    if image:
+        # mesma foto (conteúdo normalizado) + mesma pergunta
+        parts.append(image.sha256)
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+def depersonalize(answer: str, profile: dict) -> str:
+    """
+    Troca o nome do aluno pelo marcador: o nome inteiro e depois cada parte dele (o
+    modelo costuma usar só o primeiro nome), sempre como palavra inteira, para "Ana"
+    não virar marcador dentro de "Anatomia". Só a grafia do perfil e a capitalizada:
+    "Clara" é nome, "clara" é adjetivo.
+    """
+    name = " ".join((profile.get('name') or '').split())
+    parts = [name] + [part for part in name.split() if part.lower() not in NAME_PARTICLES]
+    for part in parts:
+        if len(part) < 2:
+            continue
+        for form in {part, part[:1].upper() + part[1:]}:
+            answer = re.sub(rf"\b{re.escape(form)}\b", ANSWER_NAME_PLACEHOLDER, answer)
+    return answer
+
+def personalize(answer: str, profile: dict) -> str:
+    return answer.replace(ANSWER_NAME_PLACEHOLDER, profile.get('name') or 'Estudante')
+
+async def cached_answer(key: Optional[str], profile: dict) -> Optional[str]:
+    if key is None:
+        return None
+    answer = await answer_cache.get(key)
+    ANSWER_CACHE_LOOKUPS.labels("hit" if answer is not None else "miss").inc()
+    return personalize(answer, profile) if answer is not None else None
 
-@api_router.get("/sessions/{profile_id}")
-async def get_sessions(profile_id: str):
-    sessions = await db.sessions.find(
-        {"profile_id": profile_id},
-        {"_id": 0}
-    ).sort("updated_at", -1).limit(20).to_list(20)
+async def store_answer(key: Optional[str], profile: dict, answer: str):
+    if key is not None:
+        await answer_cache.set(key, depersonalize(answer, profile))
+
+# ------------ LLM Client ------------
+
+class GeminiClient:
+    """
+    Cliente de longa duração para a API REST do Gemini. Um único pool httpx
+    (keep-alive) atende todas as requisições; o prompt do sistema vai em cada chamada.
+    """
     
-    for session in sessions:
-        if isinstance(session.get('created_at'), str):
-            session['created_at'] = datetime.fromisoformat(session['created_at'])
-        if isinstance(session.get('updated_at'), str):
-            session['updated_at'] = datetime.fromisoformat(session['updated_at'])
+    def __init__(
+        self,
+        api_key: str,
+        model: str = GEMINI_MODEL,
+        base_url: str = GEMINI_API_BASE,
+        pool_size: int = 20,
+        timeout: float = 60.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.model = model
+        self.timeout = timeout
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self._http = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            # a chave vai no header para não aparecer na URL logada pelo httpx
+            headers={"x-goog-api-key": api_key},
+            transport=transport,
+        )
     
-    return sessions
-
-@api_router.get("/sessions/{profile_id}/{session_id}/messages")
-async def get_session_messages(profile_id: str, session_id: str):
-    messages = await db.messages.find(
-        {"session_id": session_id, "profile_id": profile_id},
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(100)
+    async def _trace(self, event: str, info: dict):
+        # Eventos do httpcore: conta conexões novas para medir o reaproveitamento
+        if event == "connection.connect_tcp.started":
+            self.connections += 1
+        elif event == "connection.start_tls.complete":
+            self.tls_handshakes += 1
     
-    for msg in messages:
-        if isinstance(msg.get('timestamp'), str):
-            msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
+    def _payload(self, system_prompt: str, text: str, image: Optional[Tuple[str, str]]) -> dict:
+        parts = [{"text": text}]
+        if image:
+            content_type, image_data = image
+            parts.append({"inline_data": {"mime_type": content_type, "data": image_data}})
+        return {
+            "systemInstruction": {"parts": [{"text": system_prompt}]},
+            "contents": [{"role": "user", "parts": parts}],
+        }
     
-    return messages
-
-@api_router.get("/streak/{profile_id}")
-async def get_streak(profile_id: str):
-    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
-    if not profile:
-        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    @staticmethod
+    def _texts(data: dict) -> List[str]:
+        texts = []
+        for candidate in data.get("candidates", [])[:1]:
+            for part in candidate.get("content", {}).get("parts", []):
+                if part.get("text"):
+                    texts.append(part["text"])
+        return texts
     
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    last_activity = profile.get('last_activity_date')
+    async def generate(
+        self, system_prompt: str, text: str,
+        image: Optional[Tuple[str, str]] = None, timeout: Optional[float] = None, model: Optional[str] = None,
+    ) -> str:
+        self.requests += 1
+        LLM_PROMPT_CHARS.observe(len(system_prompt) + len(text))
+        started = time.perf_counter()
+        LLM_IN_FLIGHT.inc()
+        try:
+            resp = await self._http.post(
+                f"/models/{model or self.model}:generateContent",
+                json=self._payload(system_prompt, text, image),
+                timeout=timeout or self.timeout,
+                extensions={"trace": self._trace},
+            )
+            resp.raise_for_status()
+            reply = "".join(self._texts(resp.json()))
+            if not reply:
+                raise ValueError("Resposta vazia do Gemini")
+        except Exception as e:
+            LLM_ERRORS.labels("generate", llm_error_reason(e)).inc()
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec()
+            LLM_LATENCY.labels("generate").observe(time.perf_counter() - started)
+        LLM_RESPONSE_CHARS.observe(len(reply))
+        return reply
     
-    calendar = await get_streak_calendar(profile_id)
+    async def stream(
+        self, system_prompt: str, text: str,
+        image: Optional[Tuple[str, str]] = None, timeout: Optional[float] = None, model: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """streamGenerateContent (SSE): devolve os pedaços de texto conforme chegam."""
+        self.requests += 1
+        LLM_PROMPT_CHARS.observe(len(system_prompt) + len(text))
+        started = time.perf_counter()
+        size = 0
+        LLM_IN_FLIGHT.inc()
+        try:
+            async with self._http.stream(
+                "POST",
+                f"/models/{model or self.model}:streamGenerateContent",
+                params={"alt": "sse"},
+                json=self._payload(system_prompt, text, image),
+                timeout=timeout or self.timeout,
+                extensions={"trace": self._trace},
+            ) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if line.startswith("data:"):
+                        for chunk in self._texts(json.loads(line[5:])):
+                            size += len(chunk)
+                            yield chunk
+        except (httpx.HTTPError, ValueError) as e:
+            LLM_ERRORS.labels("stream", llm_error_reason(e)).inc()
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec()
+            LLM_LATENCY.labels("stream").observe(time.perf_counter() - started)
+            LLM_RESPONSE_CHARS.observe(size)
     
-    return StreakInfo(
-        current_streak=profile.get('current_streak', 0),
-        longest_streak=profile.get('longest_streak', 0),
-        total_study_days=profile.get('total_study_days', 0),
-        studied_today=last_activity == today,
-        streak_calendar=calendar
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "tls_handshakes": self.tls_handshakes,
+            "connection_reuse_rate": round(1 - self.connections / self.requests, 4) if self.requests else None,
+        }
+    
+    async def aclose(self):
+        await self._http.aclose()
+
+def llm_error_reason(error: Exception) -> str:
+    """Rótulo curto (e de cardinalidade baixa) para llm_errors_total."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"http_{error.response.status_code}"
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.HTTPError):
+        return "transport"
+    if isinstance(error, ValueError):
+        return "invalid_response"
+    return type(error).__name__
+
+# Criado no startup do app (create_llm_client)
+llm: Optional[GeminiClient] = None
+
+def create_llm_client() -> GeminiClient:
+    return GeminiClient(
+        api_key=GOOGLE_AI_API_KEY,
+        pool_size=int(os.environ.get('LLM_POOL_SIZE', '20')),
+        timeout=float(os.environ.get('LLM_TIMEOUT', '60')),
     )
 
-@api_router.get("/progress/{profile_id}", response_model=ProgressStats)
-async def get_progress(profile_id: str):
-    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
-    if not profile:
-        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+# ------------ LLM Admission Control ------------
+
+class LLMOverloaded(HTTPException):
+    """Recusa rápida quando o limite de chamadas ao LLM (ou da fila) foi atingido."""
     
-    total_sessions = await db.sessions.count_documents({"profile_id": profile_id})
-    total_messages = await db.messages.count_documents({"profile_id": profile_id, "role": "user"})
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+
+class AdmissionTicket:
+    """Vaga ocupada no limitador; release() pode ser chamado mais de uma vez."""
     
-    subjects_pipeline = [
-        {"$match": {"profile_id": profile_id, "subject": {"$exists": True, "$ne": None}}},
-        {"$group": {"_id": "$subject"}},
-    ]
-    subjects_result = await db.messages.aggregate(subjects_pipeline).to_list(100)
-    subjects_studied = [s["_id"] for s in subjects_result if s["_id"]]
+    def __init__(self, admission: "LLMAdmission", profile_id: Optional[str]):
+        self.admission = admission
+        self.profile_id = profile_id
+        self.acquired_at = time.monotonic()
+        self.released = False
     
-    favorite_pipeline = [
-        {"$match": {"profile_id": profile_id, "role": "user", "subject": {"$exists": True, "$ne": None}}},
-        {"$group": {"_id": "$subject", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 1}
-    ]
-    favorite_result = await db.messages.aggregate(favorite_pipeline).to_list(1)
-    favorite_subject = favorite_result[0]["_id"] if favorite_result else None
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission._release(self)
+
+class LLMAdmission:
+    """
+    Limita as chamadas simultâneas ao LLM. Quem não consegue vaga espera numa fila
+    limitada (e por tempo limitado); as vagas liberadas são distribuídas em rodízio
+    entre os perfis, para que a rajada de um aluno não atrase os demais.
+    """
     
-    last_msg = await db.messages.find_one(
-        {"profile_id": profile_id},
-        {"_id": 0, "timestamp": 1},
-        sort=[("timestamp", -1)]
-    )
-    last_activity = None
-    if last_msg:
-        ts = last_msg.get('timestamp')
-        if isinstance(ts, str):
-            last_activity = datetime.fromisoformat(ts)
-        else:
-            last_activity = ts
+    def __init__(self, max_concurrency: int, max_queue: int, max_wait: float, max_per_profile: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_per_profile = max_per_profile
+        self.in_flight = 0
+        self.queued = 0
+        self._waiters = OrderedDict()  # profile_id -> deque de futures (ordem = rodízio)
+        self._per_profile = {}
+        self._avg_hold = 5.0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "profile_limit": 0, "queue_timeout": 0}
+        self.background_skipped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
     
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    last_activity_date = profile.get('last_activity_date')
-    calendar = await get_streak_calendar(profile_id)
+    def retry_after(self) -> int:
+        estimate = self._avg_hold * (self.queued + 1) / self.max_concurrency
+        return max(1, min(60, math.ceil(estimate)))
     
-    streak_info = StreakInfo(
-        current_streak=profile.get('current_streak', 0),
-        longest_streak=profile.get('longest_streak', 0),
-        total_study_days=profile.get('total_study_days', 0),
-        studied_today=last_activity_date == today,
-        streak_calendar=calendar
+    def _reject(self, reason: str, status_code: int, detail: str):
+        self.rejected[reason] += 1
+        raise LLMOverloaded(status_code, detail, self.retry_after())
+    
+    async def acquire(self, profile_id: str) -> AdmissionTicket:
+        # conta chamadas em andamento + na fila de cada perfil
+        if self._per_profile.get(profile_id, 0) >= self.max_per_profile:
+            self._reject("profile_limit", 429, "Muitas perguntas ao mesmo tempo. Aguarde a resposta anterior.")
+        
+        started = time.monotonic()
+        if self.in_flight < self.max_concurrency and not self.queued:
+            self.in_flight += 1
+            self._track(profile_id, 1)
+        elif self.queued >= self.max_queue:
+            self._reject("queue_full", 503, "Muitos alunos estudando agora. Tente novamente em instantes.")
+        else:
+            self._track(profile_id, 1)
+            try:
+                await self._wait_turn(profile_id)
+            except BaseException:
+                self._track(profile_id, -1)
+                raise
+        
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return AdmissionTicket(self, profile_id)
+    
+    def try_acquire(self) -> Optional[AdmissionTicket]:
+        """
+        Vaga para trabalho em segundo plano (resumo, transcrição, hedge): só se houver uma livre
+        agora, sem fila nem limite por perfil. Sem vaga devolve None e o trabalho fica
+        para depois, sem disputar com as perguntas dos alunos.
+        """
+        if self.in_flight >= self.max_concurrency or self.queued:
+            self.background_skipped += 1
+            return None
+        self.in_flight += 1
+        return AdmissionTicket(self, None)
+    
+    def _track(self, profile_id: str, delta: int):
+        count = self._per_profile.get(profile_id, 0) + delta
+        if count > 0:
+            self._per_profile[profile_id] = count
+        else:
+            self._per_profile.pop(profile_id, None)
+    
+    async def _wait_turn(self, profile_id: str):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(profile_id, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # A vaga chegou junto com o timeout/cancelamento: devolve ou usa
+                if isinstance(e, asyncio.CancelledError):
+                    self._hand_off()
+                    raise
+                return
+            self._drop_waiter(profile_id, waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject("queue_timeout", 503, "Muitos alunos estudando agora. Tente novamente em instantes.")
+    
+    def _drop_waiter(self, profile_id: str, waiter: asyncio.Future):
+        waiter.cancel()
+        queue = self._waiters.get(profile_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self._waiters[profile_id]
+    
+    def _hand_off(self):
+        """Passa a vaga liberada para o próximo perfil do rodízio (ou a devolve)."""
+        while self._waiters:
+            profile_id, queue = next(iter(self._waiters.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            del self._waiters[profile_id]
+            if queue:
+                self._waiters[profile_id] = queue  # volta para o fim do rodízio
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+    
+    def _release(self, ticket: AdmissionTicket):
+        held = time.monotonic() - ticket.acquired_at
+        self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+        if ticket.profile_id is not None:
+            self._track(ticket.profile_id, -1)
+        self._hand_off()
+    
+    @asynccontextmanager
+    async def slot(self, profile_id: str):
+        with span("admission"):
+            ticket = await self.acquire(profile_id)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+    
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "background_skipped": self.background_skipped,
+            "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+llm_admission = LLMAdmission(
+    max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', '16')),
+    max_queue=int(os.environ.get('LLM_MAX_QUEUE', '64')),
+    max_wait=float(os.environ.get('LLM_MAX_QUEUE_WAIT', '10')),
+    max_per_profile=int(os.environ.get('LLM_MAX_PER_PROFILE', '2')),
+)
+
+# ------------ Request Coalescing ------------
+
+class SingleFlight:
+    """
+    Junta chamadas idênticas em andamento: a primeira executa, as demais aguardam
+    o mesmo resultado. A chamada roda numa task própria, então o cancelamento de
+    quem a iniciou não derruba quem está esperando; só quando todos desistem
+    (prazo estourado, cliente desconectado) ela é cancelada.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._waiting = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+    
+    async def do(self, key: str, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        self._waiting[task] = self._waiting.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiting[task] -= 1
+            if not self._waiting[task]:
+                del self._waiting[task]
+                if not task.done():
+                    self.abandoned += 1
+                    task.cancel()
+    
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls), "leaders": self.leaders,
+            "coalesced": self.coalesced, "abandoned": self.abandoned,
+        }
+
+llm_flight = SingleFlight()
+
+def flight_key(system_prompt: str, text: str, image: Optional[Tuple[str, str]]) -> str:
+    digest = hashlib.sha256()
+    for part in (system_prompt, text, *(image or ())):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# ------------ LLM Tail Latency ------------
+# Cada turno tem um prazo total (LLM_DEADLINE). Se a chamada passar do percentil
+# LLM_HEDGE_QUANTILE das latências recentes, sai uma segunda chamada igual (hedge) e
+# vale a primeira que responder. Se nenhuma responder até faltar LLM_FALLBACK_RESERVE
+# segundos para o prazo, ou se falharem, o modelo reserva (mais rápido) tenta no que sobrou.
+
+class LatencyWindow:
+    """Latências das últimas chamadas bem-sucedidas, para estimar percentis."""
+    
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+    
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+    
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+class HedgedLLM:
+    """
+    Chamada ao LLM com prazo, hedge e modelo reserva. generate() devolve a resposta
+    e o desfecho ({"path": "primary" | "hedge" | "fallback", "ms": ...}, mais
+    "saved_ms_est" quando o hedge ganha); sem resposta até o prazo, levanta o último
+    erro (ou asyncio.TimeoutError).
+    """
+    
+    HEDGE_TOKENS_MAX = 5.0  # rajada máxima de hedges depois de um período calmo
+    
+    def __init__(self, deadline: float, hedge_quantile: float, hedge_min_delay: float,
+                 hedge_default_delay: float, fallback_model: Optional[str], fallback_reserve: float,
+                 hedge_budget: float = 0.1, admission: Optional[LLMAdmission] = None):
+        self.deadline = deadline
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_budget = hedge_budget
+        self.hedge_tokens = self.HEDGE_TOKENS_MAX
+        self.admission = admission
+        self.fallback_model = fallback_model or None
+        self.fallback_reserve = fallback_reserve if self.fallback_model else 0.0
+        self.window = LatencyWindow()
+        self.paths = {"primary": 0, "hedge": 0, "fallback": 0, "failed": 0}
+        self.hedges_sent = 0
+        self.hedges_skipped = {"budget": 0, "no_slot": 0}
+        self.saved_est_total = 0.0
+    
+    def hedge_delay(self) -> Optional[float]:
+        """Espera antes do hedge: o percentil configurado das latências recentes (None = sem hedge)."""
+        if self.hedge_quantile <= 0:
+            return None
+        estimate = self.window.quantile(self.hedge_quantile)
+        return max(estimate if estimate is not None else self.hedge_default_delay, self.hedge_min_delay)
+    
+    async def generate(
+        self, client: GeminiClient, system_prompt: str, text: str,
+        image: Optional[Tuple[str, str]] = None, kind: str = "chat",
+    ) -> Tuple[str, dict]:
+        started = time.monotonic()
+        deadline = started + min(self.deadline, budget_left() - LLM_BUDGET_MARGIN)
+        primary_until = deadline - self.fallback_reserve
+        attempts = {}  # task -> (path, início)
+        self.hedge_tokens = min(self.hedge_tokens + self.hedge_budget, self.HEDGE_TOKENS_MAX)
+        
+        def launch(path: str, until: float, model: Optional[str] = None) -> asyncio.Task:
+            task = asyncio.create_task(
+                client.generate(system_prompt, text, image, timeout=max(until - time.monotonic(), 0.1), model=model)
+            )
+            attempts[task] = (path, time.monotonic())
+            return task
+        
+        def finish(task: asyncio.Task, saved: Optional[float] = None) -> Tuple[str, dict]:
+            path, launched = attempts[task]
+            now = time.monotonic()
+            if path != "fallback":
+                self.window.add(now - launched)
+            self.paths[path] += 1
+            LLM_PATHS.labels(kind, path).inc()
+            outcome = {"path": path, "ms": round((now - started) * 1000), "attempts": len(attempts)}
+            if saved is not None:
+                outcome["saved_ms_est"] = round(saved * 1000)
+            return task.result(), outcome
+        
+        error: Optional[BaseException] = None
+        pending = {launch("primary", primary_until)}
+        delay = self.hedge_delay()
+        hedge_at = started + delay if delay is not None and started + delay < primary_until else None
+        try:
+            while pending:
+                wake = hedge_at if hedge_at is not None else primary_until
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(wake - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        saved = self._settle_losers(pending, attempts, attempts[task][0], primary_until)
+                        pending = set()
+                        return finish(task, saved)
+                    error = task.exception()
+                if hedge_at is not None and pending and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    release = self._take_hedge()
+                    if release is not None:
+                        # a original continua valendo: quem responder primeiro leva
+                        self.hedges_sent += 1
+                        hedge = launch("hedge", primary_until)
+                        hedge.add_done_callback(lambda _: release())
+                        pending.add(hedge)
+                elif time.monotonic() >= primary_until:
+                    break
+            
+            for task in pending:
+                task.cancel()
+            if self.fallback_model and time.monotonic() < deadline:
+                task = launch("fallback", deadline, self.fallback_model)
+                pending = {task}
+                await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0))
+                if task.done():
+                    pending = set()
+                    if task.exception() is None:
+                        return finish(task)
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        self.paths["failed"] += 1
+        LLM_PATHS.labels(kind, "failed").inc()
+        raise error or asyncio.TimeoutError(f"LLM sem resposta em {self.deadline:.0f}s")
+    
+    async def stream(
+        self, client: GeminiClient, system_prompt: str, text: str,
+        image: Optional[Tuple[str, str]] = None, outcome: Optional[dict] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Streaming com o mesmo prazo e o mesmo modelo reserva, mas sem hedge (dois
+        streams em paralelo dobrariam o custo da resposta inteira). A troca de modelo
+        só acontece antes do primeiro pedaço; `outcome` recebe o desfecho.
+        """
+        started = time.monotonic()
+        deadline = started + min(self.deadline, budget_left() - LLM_BUDGET_MARGIN)
+        attempts = [("primary", None, deadline - self.fallback_reserve)]
+        if self.fallback_model:
+            attempts.append(("fallback", self.fallback_model, deadline))
+        error: Optional[BaseException] = None
+        for path, model, until in attempts:
+            if time.monotonic() >= until:
+                continue
+            chunks = client.stream(system_prompt, text, image, timeout=max(until - time.monotonic(), 0.1), model=model)
+            sent = False
+            try:
+                while True:
+                    # até o primeiro pedaço vale o limite da tentativa; depois, o prazo total
+                    remaining = (deadline if sent else until) - time.monotonic()
+                    try:
+                        # asyncio.timeout e não wait_for: no 3.11 o wait_for pode engolir um
+                        # cancelamento que chega junto com o pedaço, e o stream não para
+                        async with asyncio.timeout(max(remaining, 0)):
+                            chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    sent = True
+                    yield chunk
+                self.paths[path] += 1
+                LLM_PATHS.labels("stream", path).inc()
+                if outcome is not None:
+                    outcome.update(path=path, ms=round((time.monotonic() - started) * 1000))
+                return
+            except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as e:
+                if sent:
+                    raise
+                error = e
+            finally:
+                await chunks.aclose()
+        self.paths["failed"] += 1
+        LLM_PATHS.labels("stream", "failed").inc()
+        raise error or asyncio.TimeoutError(f"LLM sem resposta em {self.deadline:.0f}s")
+    
+    def _take_hedge(self) -> Optional[Callable[[], None]]:
+        """
+        Libera um hedge só com orçamento (em média hedge_budget por chamada) e com vaga
+        livre no limitador: é uma chamada a mais ao provedor, e sem esses limites dobraria
+        a carga justo quando ele está lento. Devolve quem libera a vaga (None = sem hedge).
+        """
+        if self.hedge_tokens < 1:
+            self.hedges_skipped["budget"] += 1
+            return None
+        ticket = self.admission.try_acquire() if self.admission is not None else None
+        if self.admission is not None and ticket is None:
+            self.hedges_skipped["no_slot"] += 1
+            return None
+        self.hedge_tokens -= 1
+        return ticket.release if ticket is not None else (lambda: None)
+    
+    def _settle_losers(self, pending: set, attempts: dict, winner: str, primary_until: float) -> Optional[float]:
+        """
+        Cancela as perdedoras: deixá-las rodando ocuparia o LLM sem vaga na admissão.
+        Quando o hedge ganha, devolve o tempo poupado, estimado (a original cancelada
+        não tem como ser medida): ela terminaria perto do p99 recente, e nunca depois
+        do limite dela.
+        """
+        won_at = time.monotonic()
+        saved = None
+        for task in pending:
+            task.cancel()
+            path, launched = attempts[task]
+            if winner == "hedge" and path == "primary":
+                estimate = self.window.quantile(0.99)
+                finish = min(launched + estimate, primary_until) if estimate is not None else primary_until
+                saved = max(finish - won_at, 0.0)
+                self.saved_est_total += saved
+                LLM_HEDGE_SAVED_EST.observe(saved)
+        return saved
+    
+    def stats(self) -> dict:
+        return {
+            "deadline_s": self.deadline,
+            "hedge_delay_ms": round(d * 1000) if (d := self.hedge_delay()) is not None else None,
+            "hedges_sent": self.hedges_sent,
+            "hedges_skipped": dict(self.hedges_skipped),
+            "paths": dict(self.paths),
+            "hedge_saved_ms_est_total": round(self.saved_est_total * 1000),
+            "fallback_model": self.fallback_model,
+        }
+
+llm_hedge = HedgedLLM(
+    deadline=float(os.environ.get('LLM_DEADLINE', '30')),
+    hedge_quantile=float(os.environ.get('LLM_HEDGE_QUANTILE', '0.95')),
+    hedge_min_delay=float(os.environ.get('LLM_HEDGE_MIN_DELAY', '0.5')),
+    hedge_default_delay=float(os.environ.get('LLM_HEDGE_DELAY', '4')),
+    fallback_model=os.environ.get('LLM_FALLBACK_MODEL', 'gemini-2.0-flash-lite'),
+    fallback_reserve=float(os.environ.get('LLM_FALLBACK_RESERVE', '8')),
+    hedge_budget=float(os.environ.get('LLM_HEDGE_BUDGET', '0.1')),
+    admission=llm_admission,
+)
+
+# ------------ LLM Circuit Breaker ------------
+# Com o provedor fora do ar, cada turno esperaria o erro (ou o prazo) só para
+# gravar o texto de desculpas. Acima de LLM_BREAKER_FAILURE_RATE de falhas (ou de
+# chamadas mais lentas que LLM_BREAKER_SLOW_CALL) na janela, o circuito abre e as
+# perguntas que precisam do LLM recebem 503 na hora, sem gravar nada. Depois de
+# LLM_BREAKER_OPEN_FOR segundos, algumas chamadas de teste (half-open) decidem se fecha.
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+class LLMUnavailable(LLMOverloaded):
+    """Recusa imediata enquanto o circuito do LLM está aberto."""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(503, "O tutor está temporariamente indisponível. Tente novamente em instantes.", retry_after)
+
+class BreakerPermit:
+    """Chamada liberada pelo disjuntor; record() conta o resultado, cancel() desiste sem contar."""
+    
+    def __init__(self, breaker: "CircuitBreaker", probe: bool):
+        self.breaker = breaker
+        self.probe = probe
+        self.started = time.monotonic()
+        self.finished = False
+    
+    def record(self, ok: bool, seconds: Optional[float] = None):
+        """seconds: latência que conta como lenta (padrão: desde a liberação)."""
+        if not self.finished:
+            self.finished = True
+            self.breaker._record(self, ok, time.monotonic() - self.started if seconds is None else seconds)
+    
+    def cancel(self):
+        if not self.finished:
+            self.finished = True
+            self.breaker._cancel(self)
+
+class CircuitBreaker:
+    def __init__(self, failure_rate: float, min_calls: int, window: float, slow_call: float,
+                 open_for: float, probes: int):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_for = open_for
+        self.probes = probes
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._calls = deque()  # (instante, falhou)
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.rejected = 0
+        self.opened = 0
+    
+    @property
+    def available(self) -> bool:
+        return self.state == "closed"
+    
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.opened_at + self.open_for - time.monotonic()))
+    
+    def check(self):
+        """Recusa (LLMUnavailable) se uma chamada agora não seria liberada; não ocupa vaga de teste."""
+        if self.state == "open" and time.monotonic() - self.opened_at < self.open_for:
+            self._reject()
+        if self.state == "half_open" and self._probes_in_flight >= self.probes:
+            self._reject()
+    
+    def acquire(self) -> BreakerPermit:
+        self.check()
+        if self.state == "open":
+            self._probe_successes = 0
+            self._set_state("half_open")
+        if self.state == "half_open":
+            self._probes_in_flight += 1
+            return BreakerPermit(self, probe=True)
+        return BreakerPermit(self, probe=False)
+    
+    def _reject(self):
+        self.rejected += 1
+        LLM_BREAKER_REJECTED.inc()
+        raise LLMUnavailable(self.retry_after())
+    
+    def _record(self, permit: BreakerPermit, ok: bool, seconds: float):
+        failed = not ok or seconds >= self.slow_call
+        if permit.probe:
+            self._probes_in_flight -= 1
+            if self.state != "half_open":
+                return
+            if failed:
+                self._open()
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self.probes:
+                    self._calls.clear()
+                    self._set_state("closed")
+            return
+        if self.state != "closed":
+            return  # chamada iniciada antes de o circuito abrir
+        now = time.monotonic()
+        self._calls.append((now, failed))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        failures = sum(1 for _, call_failed in self._calls if call_failed)
+        if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_rate:
+            self._open()
+    
+    def _cancel(self, permit: BreakerPermit):
+        if permit.probe:
+            self._probes_in_flight -= 1
+    
+    def _open(self):
+        self.opened += 1
+        self.opened_at = time.monotonic()
+        self._calls.clear()
+        self._set_state("open")
+    
+    def _set_state(self, state: str):
+        logger.warning(f"llm circuit breaker {self.state} -> {state}")
+        self.state = state
+        LLM_BREAKER_STATE.set(BREAKER_STATES[state])
+        LLM_BREAKER_TRANSITIONS.labels(state).inc()
+    
+    def stats(self) -> dict:
+        failures = sum(1 for _, call_failed in self._calls if call_failed)
+        return {
+            "state": self.state,
+            "retry_after_s": self.retry_after() if self.state == "open" else None,
+            "window_calls": len(self._calls),
+            "window_failure_rate": round(failures / len(self._calls), 3) if self._calls else 0.0,
+            "probes_in_flight": self._probes_in_flight,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+llm_breaker = CircuitBreaker(
+    failure_rate=float(os.environ.get('LLM_BREAKER_FAILURE_RATE', '0.5')),
+    min_calls=int(os.environ.get('LLM_BREAKER_MIN_CALLS', '10')),
+    window=float(os.environ.get('LLM_BREAKER_WINDOW', '60')),
+    slow_call=float(os.environ.get('LLM_BREAKER_SLOW_CALL', '20')),
+    open_for=float(os.environ.get('LLM_BREAKER_OPEN_FOR', '30')),
+    probes=int(os.environ.get('LLM_BREAKER_PROBES', '2')),
+)
+
+# ------------ Image Processing ------------
+# Imagens chegam como upload multipart (/chat/upload) ou base64 no JSON. A decodificação,
+# a detecção do formato pelos bytes, a redução e a recompressão rodam num pool de
+# threads para não travar o event loop.
+
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', '1536'))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+IMAGE_MAX_UPLOAD_BYTES = int(os.environ.get('IMAGE_MAX_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # campos do formulário e delimitadores do multipart
+
+image_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('IMAGE_WORKERS', '4')),
+    thread_name_prefix="image",
+)
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+class ChatImage(BaseModel):
+    content_type: str
+    data: str  # base64 enviado ao modelo
+    sha256: str  # dos bytes normalizados (chave no image_store e nos caches)
+    original_bytes: int
+    sent_bytes: int
+    width: int
+    height: int
+    
+    def as_part(self) -> Tuple[str, str]:
+        return self.content_type, self.data
+    
+    def report(self) -> dict:
+        return {
+            "original_bytes": self.original_bytes,
+            "sent_bytes": self.sent_bytes,
+            "width": self.width,
+            "height": self.height,
+        }
+
+image_stats = {
+    "processed": 0, "resized": 0, "bytes_in": 0, "bytes_out": 0,
+    "transcript_hits": 0, "transcript_misses": 0, "transcribed": 0,
+}
+
+def sniff_image_type(raw: bytes) -> Optional[str]:
+    for signature, content_type in IMAGE_SIGNATURES:
+        if raw.startswith(signature):
+            return content_type
+    if raw[:4] == b"RIFF" and raw[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def process_image(raw: bytes) -> ChatImage:
+    """Detecta o formato e, se passar de IMAGE_MAX_DIMENSION, reduz e recomprime em JPEG."""
+    content_type = sniff_image_type(raw)
+    if content_type is None:
+        raise ValueError("Formato de imagem não suportado")
+    
+    data = raw
+    with Image.open(io.BytesIO(raw)) as img:
+        width, height = img.size
+        if max(width, height) > IMAGE_MAX_DIMENSION:
+            # JPEG: decodifica já em escala reduzida
+            img.draft("RGB", (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            data, content_type = out.getvalue(), "image/jpeg"
+            width, height = img.size
+    
+    return ChatImage(
+        content_type=content_type,
+        data=base64.b64encode(data).decode(),
+        sha256=hashlib.sha256(data).hexdigest(),
+        original_bytes=len(raw),
+        sent_bytes=len(data),
+        width=width,
+        height=height,
     )
+
+def decode_and_process_image(image_base64: str) -> ChatImage:
+    if ',' in image_base64:
+        image_base64 = image_base64.split(',')[1]
+    return process_image(base64.b64decode(image_base64, validate=True))
+
+async def prepare_image(func, payload) -> ChatImage:
+    try:
+        with span("image_decode"):
+            image = await asyncio.get_running_loop().run_in_executor(image_executor, func, payload)
+    except (ValueError, OSError) as e:
+        # ValueError cobre base64 inválido; OSError, imagem que o Pillow não abre
+        raise HTTPException(status_code=415, detail=f"Imagem inválida: {e}")
+    
+    image_stats["processed"] += 1
+    image_stats["resized"] += image.sent_bytes != image.original_bytes
+    image_stats["bytes_in"] += image.original_bytes
+    image_stats["bytes_out"] += image.sent_bytes
+    logger.info(f"image processed original_bytes={image.original_bytes} sent_bytes={image.sent_bytes}")
+    return image
+
+async def request_image(request: "ChatRequest") -> Optional[ChatImage]:
+    if not request.image_base64:
+        return None
+    return await prepare_image(decode_and_process_image, request.image_base64)
+
+async def read_upload(upload: UploadFile) -> bytes:
+    """
+    Lê o upload, recusando arquivos acima de IMAGE_MAX_UPLOAD_BYTES. O corpo já chega
+    limitado pelo BodyLimitMiddleware; aqui o limite vale para o arquivo em si.
+    """
+    buffer = bytearray()
+    while chunk := await upload.read(64 * 1024):
+        buffer += chunk
+        if len(buffer) > IMAGE_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Imagem muito grande")
+    return bytes(buffer)
+
+# ------------ Image Store ------------
+# Imagens normalizadas guardadas pelo sha256 do conteúdo. Com IMAGE_ANALYSIS_CACHE=1,
+# o enunciado transcrito de cada imagem fica em `image_analysis`: a mesma foto
+# enviada de novo (por outro aluno, por exemplo) vira uma chamada só de texto.
+# Os jobs do chat guardam só o sha256 e o worker lê a imagem daqui (job_image).
+
+class FileImageStore:
+    """Armazena em disco (IMAGE_STORE_DIR/ab/abcdef...), removendo as menos usadas acima de max_bytes."""
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._total = None
+        # _put roda nas threads do image_executor: o total e a remoção passam por aqui
+        self._lock = threading.Lock()
+    
+    def _path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+    
+    @staticmethod
+    def _touch(path: Path) -> bool:
+        # mtime = último uso, usado na remoção; False se o arquivo não existe (ou acabou de sair)
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+    
+    def _put(self, digest: str, data: bytes):
+        path = self._path(digest)
+        if self._touch(path):
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # nome único: dois uploads da mesma foto ao mesmo tempo não dividem o arquivo temporário
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._lock:
+                if self._touch(path):
+                    return  # a outra cópia chegou antes
+                os.replace(tmp, path)
+                tmp = None
+                if self._total is None:
+                    self._total = sum(f.stat().st_size for f in self.root.glob("*/*") if f.suffix != ".tmp")
+                else:
+                    self._total += len(data)
+                if self._total > self.max_bytes:
+                    self._evict()
+        finally:
+            if tmp is not None:
+                Path(tmp).unlink(missing_ok=True)
+    
+    def _evict(self):
+        files = sorted((f for f in self.root.glob("*/*") if f.suffix != ".tmp"), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            if self._total <= self.max_bytes * 0.9:
+                break
+            self._total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+    
+    def _get(self, digest: str) -> Optional[bytes]:
+        try:
+            return self._path(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+    
+    async def put(self, digest: str, data: bytes):
+        await asyncio.get_running_loop().run_in_executor(image_executor, self._put, digest, data)
+    
+    async def get(self, digest: str) -> Optional[bytes]:
+        return await asyncio.get_running_loop().run_in_executor(image_executor, self._get, digest)
+
+class GridFSImageStore:
+    """Armazena no GridFS (bucket `images`, filename = sha256), removendo as mais antigas acima de max_bytes."""
+    
+    def __init__(self, database, max_bytes: int):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="images")
+        self.files = database["images.files"]
+        self.max_bytes = max_bytes
+    
+    async def put(self, digest: str, data: bytes):
+        if await self.files.find_one({"filename": digest}, {"_id": 1}):
+            return
+        await self.bucket.upload_from_stream(digest, data)
+        
+        usage = await self.files.aggregate([{"$group": {"_id": None, "total": {"$sum": "$length"}}}]).to_list(1)
+        total = usage[0]["total"] if usage else 0
+        if total <= self.max_bytes:
+            return
+        async for f in self.files.find({}, {"_id": 1, "length": 1}).sort("uploadDate", 1):
+            if total <= self.max_bytes * 0.9:
+                break
+            await self.bucket.delete(f["_id"])
+            total -= f["length"]
+    
+    async def get(self, digest: str) -> Optional[bytes]:
+        try:
+            stream = await self.bucket.open_download_stream_by_name(digest)
+        except NoFile:
+            return None
+        return await stream.read()
+
+def make_image_store():
+    backend = os.environ.get('IMAGE_STORE', '').lower()
+    max_bytes = int(os.environ.get('IMAGE_STORE_MAX_BYTES', str(2 * 1024 ** 3)))
+    if backend == 'fs':
+        return FileImageStore(Path(os.environ.get('IMAGE_STORE_DIR', str(ROOT_DIR / 'image_store'))), max_bytes)
+    if backend == 'gridfs':
+        return GridFSImageStore(db, max_bytes)
+    return None
+
+image_store = make_image_store()
+IMAGE_ANALYSIS_CACHE = os.environ.get('IMAGE_ANALYSIS_CACHE', '') == '1'
+
+TRANSCRIBE_PROMPT = "Você transcreve questões escolares fotografadas, sem resolvê-las."
+TRANSCRIBE_INSTRUCTION = (
+    "Transcreva fielmente o enunciado da questão desta imagem, incluindo alternativas, "
+    "números e fórmulas. Descreva em uma linha gráficos ou figuras essenciais. "
+    "Responda só com a transcrição."
+)
+
+async def store_image(image: ChatImage) -> bool:
+    """Guarda a imagem no image_store; False se não há store ou a gravação falhou."""
+    if image_store is None:
+        return False
+    try:
+        await image_store.put(image.sha256, base64.b64decode(image.data))
+        return True
+    except (OSError, PyMongoError) as e:
+        # o erro fica no log: quem usa via spawn não lê o resultado da task
+        logging.error(f"Error storing image {image.sha256}: {e}")
+        return False
+
+async def job_image(meta: dict) -> ChatImage:
+    """Remonta a imagem de um job; sem `data` no job, os bytes vêm do image_store."""
+    if "data" in meta:
+        return ChatImage(**meta)
+    data = await image_store.get(meta["sha256"]) if image_store is not None else None
+    if data is None:
+        raise HTTPException(status_code=410, detail="A imagem deste pedido não está mais disponível. Envie a foto de novo.")
+    return ChatImage(**meta, data=base64.b64encode(data).decode())
+
+async def known_transcript(image: ChatImage) -> Optional[str]:
+    if not IMAGE_ANALYSIS_CACHE:
+        return None
+    doc = await db.image_analysis.find_one({"sha256": image.sha256}, {"_id": 0, "question_text": 1})
+    image_stats["transcript_hits" if doc else "transcript_misses"] += 1
+    return doc["question_text"] if doc else None
+
+async def transcribe_image(image: ChatImage):
+    """Extrai o enunciado da imagem (em segundo plano, após a primeira resposta)."""
+    if not llm_breaker.available:
+        return
+    # sem vaga livre agora fica para a próxima vez que a foto chegar
+    ticket = llm_admission.try_acquire()
+    if ticket is None:
+        return
+    try:
+        question_text = await llm.generate(TRANSCRIBE_PROMPT, TRANSCRIBE_INSTRUCTION, image.as_part())
+    except Exception as e:
+        logging.error(f"Error transcribing image {image.sha256}: {e}")
+        return
+    finally:
+        ticket.release()
+    image_stats["transcribed"] += 1
+    await db.image_analysis.update_one(
+        {"sha256": image.sha256},
+        {"$setOnInsert": {"question_text": question_text, "created_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+async def resolve_image(request: ChatRequest, image: Optional[ChatImage]) -> Tuple[ChatRequest, Optional[ChatImage], Optional[str]]:
+    """
+    Decide como a imagem vai ao modelo. Se o enunciado dela já foi transcrito, devolve
+    um pedido só de texto com o enunciado na mensagem; senão mantém a imagem e agenda
+    a transcrição. O terceiro valor indica o reaproveitamento ("transcript" ou None).
+    """
+    if image is None:
+        return request, None, None
+    spawn(store_image(image))
+    transcript = await known_transcript(image)
+    if transcript:
+        message = f"{request.message}\n\nEnunciado da questão (transcrito da foto):\n{transcript}"
+        return request.model_copy(update={"message": message}), None, "transcript"
+    if IMAGE_ANALYSIS_CACHE:
+        spawn(transcribe_image(image))
+    return request, image, None
+
+# ------------ Conversation Context ------------
+# O contexto de cada turno tem tamanho limitado (CONTEXT_CHAR_BUDGET, ~4 caracteres
+# por token): resumo acumulado da sessão + as mensagens mais recentes que couberem.
+# Mensagens que saem da janela recente são incorporadas ao resumo (sessions.summary)
+# em segundo plano, a cada CONTEXT_SUMMARY_EVERY mensagens.
+
+CONTEXT_CHAR_BUDGET = int(os.environ.get('CONTEXT_CHAR_BUDGET', '2400'))
+CONTEXT_RECENT_MESSAGES = int(os.environ.get('CONTEXT_RECENT_MESSAGES', '6'))
+CONTEXT_SUMMARY_EVERY = int(os.environ.get('CONTEXT_SUMMARY_EVERY', '6'))
+CONTEXT_MESSAGE_CHARS = 600  # corte por mensagem, aplicado já no banco
+SUMMARY_MAX_CHARS = 800
+SUMMARY_BATCH = 40
+
+SUMMARY_PROMPT = (
+    "Você resume conversas entre um aluno do ensino médio e um tutor. Escreva em até "
+    f"{SUMMARY_MAX_CHARS} caracteres: dúvidas do aluno, conceitos já explicados, "
+    "analogias usadas e dificuldades que apareceram. Sem introdução."
+)
+
+context_stats = {"turns": 0, "summaries": 0, "context_chars": 0, "history_chars": 0}
+
+class ChatContext(BaseModel):
+    summary: Optional[str] = None
+    messages: List[dict] = []  # da mais antiga para a mais recente, já cortadas
+    
+    def is_empty(self) -> bool:
+        return not self.summary and not self.messages
+    
+    def render(self) -> str:
+        lines = [f"Resumo da conversa até aqui: {self.summary}"] if self.summary else []
+        for msg in self.messages:
+            role_label = "Aluno" if msg['role'] == 'user' else "Tutor"
+            lines.append(f"{role_label}: {msg['content']}")
+        return "\n".join(lines)
+
+def as_datetime(value) -> Optional[datetime]:
+    # documentos ainda não migrados guardam a data como string ISO
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def fit_context(summary: Optional[str], recent: List[dict], budget: int = CONTEXT_CHAR_BUDGET) -> List[dict]:
+    """Mensagens mais recentes (mais novas primeiro em `recent`) que cabem no orçamento."""
+    budget -= len(summary or "")
+    kept = []
+    for msg in recent[:CONTEXT_RECENT_MESSAGES]:
+        content = msg['content']
+        if len(content) > budget:
+            if budget < 80 or kept:
+                break
+            content = content[:budget]  # a última mensagem sempre entra, nem que cortada
+        if len(content) < msg['length']:
+            content = content.rstrip() + "..."
+        kept.append({**msg, "content": content})
+        budget -= len(content)
+    kept.reverse()
+    return kept
+
+def context_pipeline(session_id: str) -> List[dict]:
+    """Mensagens mais recentes da sessão, com o conteúdo já cortado no banco (também no explain-indexes)."""
+    return [
+        {"$match": {"session_id": session_id}},
+        {"$sort": {"timestamp": -1, "id": -1}},
+        {"$limit": CONTEXT_RECENT_MESSAGES + CONTEXT_SUMMARY_EVERY},
+        {"$project": {
+            "_id": 0, "role": 1, "timestamp": 1,
+            "content": {"$substrCP": ["$content", 0, CONTEXT_MESSAGE_CHARS]},
+            "length": {"$strLenCP": "$content"},
+        }},
+    ]
+
+async def fetch_context(session_id: str) -> ChatContext:
+    """Resumo da sessão e mensagens recentes (só role, conteúdo cortado e data) em paralelo."""
+    window = CONTEXT_RECENT_MESSAGES + CONTEXT_SUMMARY_EVERY
+    session, recent = await asyncio.gather(
+        db.sessions.find_one({"id": session_id}, {"_id": 0, "summary": 1, "summary_until": 1}),
+        db.messages.aggregate(context_pipeline(session_id)).to_list(window),
+    )
+    summary = (session or {}).get("summary")
+    summary_until = as_datetime((session or {}).get("summary_until"))
+    if summary_until:
+        recent = [msg for msg in recent if as_datetime(msg["timestamp"]) > summary_until]
+    if len(recent) >= window:
+        # CONTEXT_SUMMARY_EVERY mensagens já saíram da janela sem entrar no resumo
+        spawn(refresh_summary(session_id))
+    
+    context = ChatContext(summary=summary, messages=fit_context(summary, recent))
+    context_stats["turns"] += 1
+    context_stats["context_chars"] += len(context.render())
+    context_stats["history_chars"] += sum(msg["length"] for msg in recent[:CONTEXT_RECENT_MESSAGES])
+    return context
+
+summarizing = set()
+
+async def refresh_summary(session_id: str):
+    """Incorpora ao resumo as mensagens que já saíram da janela recente."""
+    if session_id in summarizing:
+        return
+    summarizing.add(session_id)
+    try:
+        session = await db.sessions.find_one({"id": session_id}, {"_id": 0, "summary": 1, "summary_until": 1})
+        if session is None:
+            return
+        query = {"session_id": session_id}
+        if session.get("summary_until"):
+            query["timestamp"] = {"$gt": session["summary_until"]}
+        # no máximo SUMMARY_BATCH por vez; as recentes continuam indo inteiras no contexto
+        limit = SUMMARY_BATCH + CONTEXT_RECENT_MESSAGES
+        pending = await db.messages.find(query, {"_id": 0, "role": 1, "content": 1, "timestamp": 1}).sort(
+            [("timestamp", ASCENDING), ("id", ASCENDING)]
+        ).limit(limit).to_list(limit)
+        pending = pending[:-CONTEXT_RECENT_MESSAGES]
+        if len(pending) < CONTEXT_SUMMARY_EVERY or not llm_breaker.available:
+            return
+        
+        transcript = ChatContext(summary=session.get("summary"), messages=[
+            {"role": msg["role"], "content": msg["content"][:CONTEXT_MESSAGE_CHARS]} for msg in pending
+        ]).render()
+        # sem vaga livre agora o resumo fica para o próximo turno da sessão
+        ticket = llm_admission.try_acquire()
+        if ticket is None:
+            return
+        try:
+            summary = await llm.generate(SUMMARY_PROMPT, transcript)
+        finally:
+            ticket.release()
+        # filtro no summary_until lido: outra réplica pode ter resumido no meio tempo
+        await db.sessions.update_one(
+            {"id": session_id, "summary_until": session.get("summary_until")},
+            {"$set": {"summary": summary[:SUMMARY_MAX_CHARS], "summary_until": pending[-1]["timestamp"]}}
+        )
+        context_stats["summaries"] += 1
+    except Exception as e:
+        logging.error(f"Error summarizing session {session_id}: {e}")
+    finally:
+        summarizing.discard(session_id)
+
+# ------------ Chat Helpers ------------
+
+def build_user_text(request: ChatRequest, profile: dict, context: ChatContext, has_image: bool = False) -> str:
+    """Monta o texto enviado ao modelo. `context` é o resumo + mensagens anteriores da sessão."""
+    interesse = profile.get('interesse_cultural', 'cultura pop')
+    
+    if has_image:
+        return f"""[Matéria: {request.subject}]
+
+QUESTÃO DO ALUNO: {request.message}
+
+INSTRUÇÃO: 
+1. Analise a imagem cuidadosamente
+2. COMECE com analogia de "{interesse}" nas PRIMEIRAS 2 LINHAS
+3. Use estrutura: [ANALOGIA] → [EXPLICAÇÃO] → [VOLTA AO CONCEITO]
+4. Seja específico e memorável!"""
+    
+    history = context.render()
+    
+    return f"""[Matéria: {request.subject}]
+
+{"Contexto da conversa:" + chr(10) + history + chr(10) + chr(10) if history else ""}
+QUESTÃO DO ALUNO: {request.message}
+
+INSTRUÇÃO: 
+1. COMECE com analogia de "{interesse}" nas PRIMEIRAS 2 LINHAS
+2. Use estrutura: [ANALOGIA] → [EXPLICAÇÃO] → [VOLTA AO CONCEITO]
+3. Seja específico e memorável!"""
+
+def new_user_message(request: ChatRequest, has_image: bool = False) -> ChatMessage:
+    return ChatMessage(
+        session_id=request.session_id,
+        profile_id=request.profile_id,
+        role="user",
+        content=request.message,
+        subject=request.subject,
+        has_image=has_image,
+        request_id=request.request_id
+    )
+
+async def load_turn(request: ChatRequest) -> Tuple[dict, Optional[ChatMessage], ChatContext]:
+    """Perfil, resposta já gravada para o request_id e contexto da conversa, lidos em paralelo."""
+    profile, replay, context = await asyncio.gather(
+        timed("profile", db.profiles.find_one({"id": request.profile_id}, {"_id": 0})),
+        timed("replay", find_reply(request)),
+        timed("context", fetch_context(request.session_id)),
+    )
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    return profile, replay, context
+
+async def find_reply(request: ChatRequest) -> Optional[ChatMessage]:
+    """Resposta já gravada para o request_id (retentativa do cliente)."""
+    if not request.request_id:
+        return None
+    doc = await db.messages.find_one(
+        {"session_id": request.session_id, "request_id": request.request_id, "role": "assistant"},
+        {"_id": 0}
+    )
+    return ChatMessage(**doc) if doc else None
+
+async def persist_turn(
+    request: ChatRequest, user_msg: ChatMessage, response: Optional[str], replayable: bool = True,
+) -> Tuple[Optional[ChatMessage], Optional[StreakInfo]]:
+    """
+    Grava o turno: as duas mensagens numa única inserção ordenada e, em paralelo,
+    streak e sessão + stats. Devolve a resposta gravada e o streak novo (ver
+    touch_streak). Se o request_id já foi gravado (retentativa concorrente), não
+    grava nada de novo. Com replayable=False (desculpa ou resposta interrompida)
+    o turno é gravado sem request_id, e uma retentativa gera a resposta de novo.
+    """
+    if not replayable:
+        request = request.model_copy(update={"request_id": None})
+        user_msg = user_msg.model_copy(update={"request_id": None})
+    assistant_msg = None
+    if response:
+        assistant_msg = ChatMessage(
+            session_id=request.session_id,
+            profile_id=request.profile_id,
+            role="assistant",
+            content=response,
+            subject=request.subject,
+            request_id=request.request_id
+        )
+    try:
+        with span("save_messages"):
+            await db.messages.insert_many([m.model_dump() for m in (user_msg, assistant_msg) if m], ordered=True)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        return await find_reply(request), None
+    
+    # sem resposta (stream cancelado antes do primeiro pedaço) a sessão vem da pergunta
+    streak, _ = await asyncio.gather(
+        timed("streak", touch_streak(request.profile_id)),
+        timed("session", touch_session(request, (assistant_msg or user_msg).timestamp)),
+    )
+    # WebSockets abertos do perfil recebem o que mudou
+    profile_channels.notify(request.profile_id, streak)
+    return assistant_msg, streak
+
+async def touch_session(request: ChatRequest, last_activity: datetime):
+    """Cria ou atualiza a sessão num único upsert e conta o turno em `stats`."""
+    new_session = ChatSession(
+        id=request.session_id,
+        profile_id=request.profile_id,
+        title=request.message[:50] + "..." if len(request.message) > 50 else request.message,
+        subject=request.subject
+    )
+    session_doc = new_session.model_dump()
+    session_doc.pop('updated_at')
+    result = await db.sessions.update_one(
+        {"id": request.session_id},
+        {"$set": {"updated_at": last_activity}, "$setOnInsert": session_doc},
+        upsert=True
+    )
+    await record_progress(
+        request.profile_id, request.subject, last_activity, new_session=result.upserted_id is not None
+    )
+
+async def generate_reply(
+    request: ChatRequest, profile: dict, system_prompt: str, context: ChatContext, image: Optional[ChatImage] = None,
+) -> Tuple[Optional[str], dict]:
+    """
+    Resposta do Gemini para o turno (None se todas as tentativas falharem) e o
+    desfecho da chamada (ver HedgedLLM). Pedidos idênticos (mesmo prompt do sistema
+    + mesma mensagem) em andamento compartilham uma chamada, que ocupa uma única
+    vaga no limitador; o hedge só sai se houver outra vaga livre.
+    """
+    text = build_user_text(request, profile, context, has_image=image is not None)
+    part = image.as_part() if image else None
+    
+    async def call() -> Tuple[Optional[str], dict]:
+        async with llm_admission.slot(request.profile_id):
+            permit = llm_breaker.acquire()
+            try:
+                reply = await llm_hedge.generate(llm, system_prompt, text, part)
+            except asyncio.CancelledError:
+                permit.cancel()  # cancelado no meio: não conta como falha do provedor
+                raise
+            except Exception as e:
+                if budget_left() <= LLM_BUDGET_MARGIN:
+                    # acabou o prazo da requisição, não o do provedor
+                    permit.cancel()
+                    raise DeadlineExceeded("llm") from e
+                permit.record(False)
+                logging.error(f"Error calling Gemini: {e!r}")
+                return None, {"path": "failed", "ms": round((time.monotonic() - permit.started) * 1000)}
+            permit.record(True)
+            return reply
+    
+    # inclui a espera por vaga, que também aparece sozinha como "admission"
+    with span("llm"):
+        return await llm_flight.do(flight_key(system_prompt, text, part), call)
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Tarefas de persistência disparadas pelo streaming (mantém referência até terminarem)
+background_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro, context=detached_context())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# ------------ Pagination ------------
+# Paginação por cursor (keyset): o cursor é o par (campo de ordenação, id) do último
+# item visto, e a próxima página começa logo depois dele via índice. O custo por
+# página é o mesmo em qualquer profundidade do histórico, ao contrário de skip/offset.
+
+class Page(BaseModel):
+    before: Optional[str] = None  # cursor para os itens anteriores (None = não há mais)
+    after: Optional[str] = None  # cursor para os itens seguintes
+
+    def headers(self) -> dict:
+        cursors = {"X-Before-Cursor": self.before, "X-After-Cursor": self.after}
+        return {name: value for name, value in cursors.items() if value}
+
+def encode_cursor(value, doc_id: str) -> str:
+    # um valor ainda em string ISO (dados anteriores ao user-015) leva a marca "str"
+    if isinstance(value, datetime):
+        raw = [value.isoformat(), doc_id]
+    else:
+        raw = [value, doc_id, "str"]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Union[datetime, str], str]:
+    try:
+        value, doc_id, *kind = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if kind == ["str"]:
+            return str(value), str(doc_id)
+        return datetime.fromisoformat(value), str(doc_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Cursor inválido") from e
+
+def keyset_cond(field: str, value, doc_id: str, op: str) -> dict:
+    """
+    Itens antes ($lt) ou depois ($gt) de (value, doc_id) na ordem do índice. O BSON não
+    compara tipos diferentes e ordena strings antes de datas, então, enquanto houver
+    timestamps em string ISO, quem está do outro lado da fronteira de tipo entra inteiro.
+    """
+    cond = [{field: {op: value}}, {field: value, "id": {op: doc_id}}]
+    if op == "$lt" and isinstance(value, datetime):
+        cond.append({field: {"$type": "string"}})
+    elif op == "$gt" and isinstance(value, str):
+        cond.append({field: {"$type": "date"}})
+    return {"$or": cond}
+
+async def keyset_page(
+    collection, query: dict, field: str, limit: int, before: Optional[str] = None, after: Optional[str] = None,
+) -> Tuple[List[dict], Page]:
+    """
+    Página de `collection` em ordem crescente de (field, id). Sem cursor vem a página
+    mais recente; `before`/`after` pegam os itens imediatamente antes/depois do cursor.
+    Busca limit + 1 para saber se há mais itens naquela direção.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use before ou after, não os dois")
+    
+    if after:
+        docs = await collection.find({**query, **keyset_cond(field, *decode_cursor(after), "$gt")}, {"_id": 0}).sort(
+            [(field, ASCENDING), ("id", ASCENDING)]
+        ).limit(limit + 1).to_list(limit + 1)
+        more_before, more_after = True, len(docs) > limit
+        docs = docs[:limit]
+    else:
+        if before:
+            query = {**query, **keyset_cond(field, *decode_cursor(before), "$lt")}
+        docs = await collection.find(query, {"_id": 0}).sort(
+            [(field, DESCENDING), ("id", DESCENDING)]
+        ).limit(limit + 1).to_list(limit + 1)
+        more_before, more_after = len(docs) > limit, before is not None
+        docs = docs[:limit]
+        docs.reverse()
+    
+    page = Page()
+    if docs and more_before:
+        page.before = encode_cursor(docs[0][field], docs[0]["id"])
+    if docs and more_after:
+        page.after = encode_cursor(docs[-1][field], docs[-1]["id"])
+    return docs, page
+
+# ------------ Dashboard Helpers ------------
+
+async def fetch_sessions(profile_id: str, limit: int = 20, before: Optional[str] = None) -> Tuple[List[dict], Page]:
+    """Sessões da mais recente para a mais antiga; `before` continua de onde a página anterior parou."""
+    sessions, page = await keyset_page(db.sessions, {"profile_id": profile_id}, "updated_at", limit, before=before)
+    sessions.reverse()
+    return sessions, page
+
+def build_streak_info(profile: dict) -> StreakInfo:
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    
+    return StreakInfo(
+        current_streak=profile.get('current_streak', 0),
+        longest_streak=profile.get('longest_streak', 0),
+        total_study_days=profile.get('total_study_days', 0),
+        studied_today=profile.get('last_activity_date') == today,
+        streak_calendar=get_streak_calendar(profile)
+    )
+
+def build_progress(profile: dict, streak_info: StreakInfo) -> ProgressStats:
+    stats = profile.get('stats') or {}
+    subject_counts = stats.get('subject_counts') or {}
+    subject_names = stats.get('subject_names') or {}
+    names = {key: subject_names.get(key) or key for key in subject_counts}
+    favorite_subject = names[max(subject_counts, key=subject_counts.get)] if subject_counts else None
     
     return ProgressStats(
-        total_sessions=total_sessions,
-        total_messages=total_messages,
-        subjects_studied=subjects_studied,
+        total_sessions=stats.get('total_sessions', 0),
+        total_messages=stats.get('total_messages', 0),
+        subjects_studied=list(names.values()),
         favorite_subject=favorite_subject,
-        last_activity=last_activity,
+        last_activity=stats.get('last_activity'),
         streak=streak_info
     )
 
+async def load_dashboard(profile_id: str, streak: Optional[StreakInfo] = None) -> Optional[dict]:
+    """
+    Perfil e sessões buscados em paralelo; calendário calculado uma única vez. Com o
+    `streak` devolvido pelo update do turno, do perfil só se lê o `stats`.
+    """
+    projection = {"_id": 0, "id": 1, "stats": 1} if streak else {"_id": 0}
+    profile, (sessions, sessions_page) = await asyncio.gather(
+        timed("profile", db.profiles.find_one({"id": profile_id}, projection)),
+        timed("sessions", fetch_sessions(profile_id)),
+    )
+    if not profile:
+        return None
+    
+    await timed("stats", ensure_stats(profile))
+    streak_info = streak or build_streak_info(profile)
+    return {
+        "sessions": sessions,
+        "sessions_before": sessions_page.before,  # cursor para GET /sessions/{id}?before=
+        "progress": build_progress(profile, streak_info),
+        "streak": streak_info,
+    }
+
+# ------------ Chat Jobs ------------
+# Modo assíncrono do chat: com "job": true, POST /chat grava o turno numa fila no
+# MongoDB (chat_jobs) e responde 202 com o id na hora. Um pool de workers
+# (CHAT_JOB_WORKERS por processo; também `manage.py chat-workers`) pega os jobs com
+# um lease, roda o mesmo run_chat e grava o resultado, que o cliente busca em
+# GET /chat/jobs/{id} (com ?wait= para long polling) ou recebe por SSE em
+# /chat/jobs/{id}/events. A entrega é at-least-once: um job cujo worker caiu volta à
+# fila quando o lease vence, e o request_id do turno evita mensagens duplicadas.
+
+JOB_FINAL = ("done", "failed")
+
+class ChatJobs:
+    def __init__(
+        self, workers: int, poll_interval: float, lease: float, max_attempts: int, max_age: float, retention: float,
+    ):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_age = max_age  # adiamentos por LLM sobrecarregado não passam disso
+        self.retention = retention
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Event()  # trocado a cada job concluído neste processo
+        self._tasks: List[asyncio.Task] = []
+        self._finished = deque(maxlen=10000)  # instantes de conclusão, para a vazão
+        self.running = 0
+        self.counts = {"done": 0, "failed": 0, "retried": 0, "deferred": 0}
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.claimed = 0
+    
+    async def enqueue(self, request: ChatRequest, image: Optional[ChatImage]) -> dict:
+        """Grava o job (uma vez por session_id + request_id) e acorda os workers locais."""
+        if not request.request_id:
+            # o request_id é o que torna a reexecução de um job idempotente
+            request = request.model_copy(update={"request_id": str(uuid.uuid4())})
+        image_doc = None
+        if image is not None:
+            # com image_store o job guarda só os metadados; o worker lê os bytes de lá
+            if await store_image(image):
+                image_doc = image.model_dump(exclude={"data"})
+            else:
+                image_doc = image.model_dump()
+        now = datetime.now(timezone.utc)
+        doc = {
+            "id": str(uuid.uuid4()),
+            "status": "queued",
+            "request": request.model_dump(exclude={"image_base64", "job"}),
+            "image": image_doc,
+            "attempts": 0,
+            "created_at": now,
+            "available_at": now,
+        }
+        job = await db.chat_jobs.find_one_and_update(
+            {"key": f"{request.session_id}:{request.request_id}"},
+            {"$setOnInsert": doc},
+            projection={"_id": 0, "id": 1, "status": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._wakeup.set()
+        return {"job_id": job["id"], "status": job["status"], "request_id": request.request_id}
+    
+    def start(self):
+        for n in range(self.workers):
+            worker_id = f"{os.uname().nodename}-{os.getpid()}-{n}"
+            self._tasks.append(asyncio.create_task(self._run(worker_id)))
+    
+    async def _run(self, worker_id: str):
+        while True:
+            try:
+                job = await self._claim(worker_id)
+            except PyMongoError as e:
+                logging.error(f"Error claiming chat job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    async with asyncio.timeout(self.poll_interval):
+                        await self._wakeup.wait()
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.running += 1
+            try:
+                await self._process(job, worker_id)
+            except PyMongoError as e:
+                # o lease vence e outro worker retoma o job
+                logging.error(f"Error finishing chat job {job['id']}: {e}")
+            finally:
+                self.running -= 1
+    
+    async def _claim(self, worker_id: str) -> Optional[dict]:
+        """Pega o job disponível mais antigo, ou um cujo worker perdeu o lease."""
+        now = datetime.now(timezone.utc)
+        job = await db.chat_jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "available_at": {"$lte": now}},
+                {"status": "running", "lease_until": {"$lt": now}},
+            ]},
+            {
+                "$set": {"status": "running", "worker": worker_id, "started_at": now,
+                         "lease_until": now + timedelta(seconds=self.lease)},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", ASCENDING)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is not None:
+            waited = max((now - as_datetime(job["available_at"])).total_seconds(), 0.0)
+            self.claimed += 1
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+            CHAT_JOB_QUEUE_LATENCY.observe(waited)
+        return job
+    
+    async def _process(self, job: dict, worker_id: str):
+        request = ChatRequest(**job["request"])
+        started = time.perf_counter()
+        # mesmo prazo do /chat síncrono; o lease é maior que ele
+        token = request_deadline.set(time.monotonic() + CHAT_DEADLINE)
+        try:
+            with pymongo.timeout(CHAT_DEADLINE):
+                image = await job_image(job["image"]) if job.get("image") else None
+                result = await run_chat(request, image)
+        except asyncio.CancelledError:
+            # shutdown: devolve o job à fila em vez de esperar o lease vencer
+            await asyncio.shield(self._finish(job, worker_id, "queued", {"available_at": datetime.now(timezone.utc)}))
+            raise
+        except LLMOverloaded as e:
+            # sem vaga no LLM (ou disjuntor aberto): adia sem gastar tentativa, até max_age
+            now = datetime.now(timezone.utc)
+            if (now - as_datetime(job["created_at"])).total_seconds() >= self.max_age:
+                logging.error(f"Chat job {job['id']} failed: deferred for more than {self.max_age:.0f}s")
+                await self._finish(job, worker_id, "failed", {"error": {"status": 503, "detail": e.detail}})
+                self.counts["failed"] += 1
+                CHAT_JOBS.labels("failed").inc()
+                return
+            retry_after = int(e.headers.get("Retry-After", "1"))
+            await self._finish(job, worker_id, "queued", {
+                "available_at": now + timedelta(seconds=retry_after),
+            }, attempts=-1)
+            self.counts["deferred"] += 1
+            CHAT_JOBS.labels("deferred").inc()
+            return
+        except Exception as e:
+            status = e.status_code if isinstance(e, HTTPException) else 500
+            if status < 500 or job["attempts"] >= self.max_attempts:
+                logging.error(f"Chat job {job['id']} failed: {e!r}")
+                await self._finish(job, worker_id, "failed", {
+                    "error": {"status": status, "detail": getattr(e, "detail", None) or repr(e)},
+                })
+                self.counts["failed"] += 1
+                CHAT_JOBS.labels("failed").inc()
+                return
+            backoff = min(2 ** job["attempts"], 60)
+            await self._finish(job, worker_id, "queued", {
+                "available_at": datetime.now(timezone.utc) + timedelta(seconds=backoff),
+            })
+            self.counts["retried"] += 1
+            CHAT_JOBS.labels("retried").inc()
+            return
+        finally:
+            request_deadline.reset(token)
+        
+        await self._finish(job, worker_id, "done", {"result": jsonable_encoder(result)})
+        CHAT_JOB_RUN_LATENCY.observe(time.perf_counter() - started)
+        self.counts["done"] += 1
+        CHAT_JOBS.labels("done").inc()
+    
+    async def _finish(self, job: dict, worker_id: str, status: str, fields: dict, attempts: int = 0):
+        update = {"$set": {"status": status, **fields}, "$unset": {"lease_until": "", "worker": ""}}
+        if status in JOB_FINAL:
+            now = datetime.now(timezone.utc)
+            update["$set"].update(finished_at=now, expires_at=now + timedelta(seconds=self.retention))
+            update["$unset"]["image"] = ""
+            self._finished.append(time.monotonic())
+        if attempts:
+            update["$inc"] = {"attempts": attempts}
+        # só o dono do lease grava: se ele venceu, outro worker já refez o job
+        await db.chat_jobs.update_one({"id": job["id"], "worker": worker_id, "status": "running"}, update)
+        if status in JOB_FINAL:
+            changed, self._changed = self._changed, asyncio.Event()
+            changed.set()
+    
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await db.chat_jobs.find_one(
+            {"id": job_id}, {"_id": 0, "key": 0, "request": 0, "image": 0, "worker": 0, "lease_until": 0},
+        )
+    
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """
+        Devolve o job quando ele terminar ou após `timeout`. Conclusões neste processo
+        acordam na hora; as de outros processos aparecem na próxima leitura.
+        """
+        until = time.monotonic() + timeout
+        while True:
+            changed = self._changed
+            job = await self.get(job_id)
+            remaining = until - time.monotonic()
+            if job is None or job["status"] in JOB_FINAL or remaining <= 0:
+                return job
+            try:
+                async with asyncio.timeout(min(self.poll_interval, remaining)):
+                    await changed.wait()
+            except asyncio.TimeoutError:
+                pass
+    
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def stats(self) -> dict:
+        cutoff = time.monotonic() - 60
+        return {
+            "workers": len(self._tasks),
+            "running": self.running,
+            "queued": await db.chat_jobs.count_documents({"status": "queued"}),
+            **self.counts,
+            "done_last_min": sum(1 for finished in self._finished if finished >= cutoff),
+            "queue_wait_avg_ms": round(self.queue_wait_total / self.claimed * 1000, 1) if self.claimed else 0.0,
+            "queue_wait_max_ms": round(self.queue_wait_max * 1000, 1),
+        }
+
+chat_jobs = ChatJobs(
+    workers=int(os.environ.get('CHAT_JOB_WORKERS', '4')),
+    poll_interval=float(os.environ.get('CHAT_JOB_POLL_INTERVAL', '1')),
+    lease=CHAT_DEADLINE + 30,
+    max_attempts=int(os.environ.get('CHAT_JOB_MAX_ATTEMPTS', '5')),
+    max_age=float(os.environ.get('CHAT_JOB_MAX_AGE', '900')),
+    retention=float(os.environ.get('CHAT_JOB_RETENTION', str(24 * 3600))),
+)
+
+def job_view(job: dict) -> dict:
+    view = {"job_id": job["id"], "status": job["status"], "attempts": job["attempts"], "created_at": job["created_at"]}
+    for field in ("result", "error", "finished_at"):
+        if job.get(field) is not None:
+            view[field] = job[field]
+    return view
+
+# ------------ WebSocket ------------
+# Canal persistente por perfil em /api/ws/{profile_id}. Leva turnos de qualquer sessão
+# ao mesmo tempo (cada um identificado pelo request_id), manda a resposta em trechos
+# e empurra o que mudou em sessões, streak e progresso depois de cada turno gravado,
+# sem o cliente precisar buscar de novo. Protocolo (JSON nos dois sentidos):
+#
+#   cliente: {"type": "chat", "session_id", "subject", "message", "request_id"?, "image_base64"?}
+#            {"type": "cancel", "request_id"} | {"type": "ping"}
+#   servidor: dashboard (na conexão) | chunk | done | error | sessions | streak | progress | pong
+#
+# Cada conexão tem uma fila de saída limitada (WS_SEND_QUEUE): com o cliente lento, o
+# turno espera nela e para de ler o LLM. Um envio parado há mais de WS_SEND_TIMEOUT
+# derruba a conexão. As atualizações de dashboard são agrupadas: vários turnos gravados
+# enquanto o cliente não lê viram um único envio. Os avisos valem para as conexões deste
+# processo; com vários workers, cada um avisa só os seus clientes.
+
+WS_SEND_QUEUE = int(os.environ.get('WS_SEND_QUEUE', '64'))
+WS_SEND_TIMEOUT = float(os.environ.get('WS_SEND_TIMEOUT', '10'))
+WS_MAX_TURNS = int(os.environ.get('WS_MAX_TURNS', '3'))
+
+class SlowConsumer(Exception):
+    pass
+
+class ProfileChannel:
+    """Uma conexão WebSocket: fila de saída, turnos em andamento e o último dashboard enviado."""
+    
+    def __init__(self, websocket: WebSocket, profile_id: str):
+        self.websocket = websocket
+        self.profile_id = profile_id
+        self.outbox: asyncio.Queue = asyncio.Queue(WS_SEND_QUEUE)
+        self.turns: Dict[str, asyncio.Task] = {}
+        self.dirty = asyncio.Event()  # dashboard mudou desde o último envio
+        self.dirty.set()  # o primeiro envio é o dashboard inteiro
+        self.streak: Optional[StreakInfo] = None  # devolvido pelo último turno gravado
+        self.sent: Optional[dict] = None
+    
+    async def serve(self):
+        profile_channels.add(self)
+        reader = asyncio.create_task(self._read())
+        writer = asyncio.create_task(self._write())
+        pusher = asyncio.create_task(self._push_dashboard())
+        try:
+            done, _ = await asyncio.wait([reader, writer, pusher], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = None if task.cancelled() else task.exception()
+                if isinstance(error, SlowConsumer):
+                    WS_SLOW_CLOSED.inc()
+                    logging.warning(f"Closing slow websocket for profile {self.profile_id}")
+                    try:
+                        async with asyncio.timeout(1):
+                            await self.websocket.close(code=1013)
+                    except Exception:
+                        pass  # quem não lê os dados também não lê o close
+                elif error and task is not writer and not isinstance(error, WebSocketDisconnect):
+                    # falha de envio no writer é só o cliente que já fechou
+                    logging.error(f"Websocket for profile {self.profile_id} failed: {error!r}")
+        finally:
+            # desconexão: cancela os turnos (o que já foi gerado é gravado) e libera as vagas do LLM
+            profile_channels.remove(self)
+            tasks = [reader, writer, pusher, *self.turns.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def send(self, message: dict):
+        # fila cheia = cliente lento: quem manda espera aqui
+        await self.outbox.put(message)
+    
+    async def _write(self):
+        while True:
+            message = await self.outbox.get()
+            try:
+                async with asyncio.timeout(WS_SEND_TIMEOUT):
+                    await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+            except asyncio.TimeoutError:
+                raise SlowConsumer() from None
+    
+    async def _read(self):
+        while True:
+            raw = await self.websocket.receive_text()
+            try:
+                message = json.loads(raw)
+                kind = message.pop("type")
+            except (ValueError, AttributeError, KeyError, TypeError):
+                await self.send({"type": "error", "status": 400, "detail": "Mensagem inválida"})
+                continue
+            if kind == "chat":
+                await self._start_turn(message)
+            elif kind == "cancel":
+                task = self.turns.get(message.get("request_id"))
+                if task:
+                    task.cancel()
+            elif kind == "ping":
+                await self.send({"type": "pong"})
+            else:
+                await self.send({"type": "error", "status": 400, "detail": f"Tipo desconhecido: {kind}"})
+    
+    async def _start_turn(self, message: dict):
+        try:
+            # o dashboard chega pelos avisos; job não se aplica ao canal
+            request = ChatRequest(**{
+                **message, "request_id": message.get("request_id") or str(uuid.uuid4()),
+                "profile_id": self.profile_id, "include_dashboard": False, "job": False,
+            })
+        except ValidationError as e:
+            await self.send({"type": "error", "request_id": message.get("request_id"), "status": 422,
+                             "detail": jsonable_encoder(e.errors(include_url=False))})
+            return
+        if request.request_id in self.turns:
+            await self.send({"type": "error", "request_id": request.request_id, "status": 409,
+                             "detail": "Turno já em andamento"})
+        elif len(self.turns) >= WS_MAX_TURNS:
+            await self.send({"type": "error", "request_id": request.request_id, "status": 429,
+                             "detail": "Aguarde as respostas em andamento"})
+        else:
+            self.turns[request.request_id] = asyncio.create_task(self._run_turn(request))
+    
+    async def _run_turn(self, request: ChatRequest):
+        ids = {"session_id": request.session_id, "request_id": request.request_id}
+        release_llm = None
+        token = request_deadline.set(time.monotonic() + STREAM_DEADLINE)
+        try:
+            with pymongo.timeout(STREAM_DEADLINE):
+                events, release_llm = await open_chat_stream(request, await request_image(request))
+                async with aclosing(events):
+                    async for event, data in events:
+                        await self.send({"type": event or "chunk", **ids, **data})
+        except HTTPException as e:
+            error = {"type": "error", **ids, "status": e.status_code, "detail": e.detail}
+            if e.headers and "Retry-After" in e.headers:
+                error["retry_after"] = int(e.headers["Retry-After"])
+            await self.send(error)
+        except Exception as e:
+            if isinstance(e, PyMongoError) and e.timeout:
+                REQUEST_DEADLINE_EXCEEDED.labels(request_route.get(), "mongo").inc()
+                await self.send({"type": "error", **ids, "status": 504,
+                                 "detail": {"error": "deadline_exceeded", "stage": "mongo"}})
+            else:
+                logging.exception(f"Websocket turn {request.request_id} failed")
+                await self.send({"type": "error", **ids, "status": 500, "detail": "Erro interno"})
+        finally:
+            if release_llm:
+                release_llm()
+            request_deadline.reset(token)
+            self.turns.pop(request.request_id, None)
+    
+    async def _push_dashboard(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            streak, self.streak = self.streak, None
+            if write_behind:
+                await write_behind.settled()
+            with pymongo.timeout(REQUEST_DEADLINE):
+                dashboard = await load_dashboard(self.profile_id, streak)
+            if dashboard is None:
+                return
+            dashboard = jsonable_encoder(dashboard)
+            for message in self._deltas(dashboard):
+                await self.send(message)
+            self.sent = dashboard
+    
+    def _deltas(self, dashboard: dict) -> List[dict]:
+        if self.sent is None:
+            return [{"type": "dashboard", **dashboard}]
+        messages = []
+        # só as sessões novas ou alteradas; o cliente junta pelo id
+        previous = {session["id"]: session for session in self.sent["sessions"]}
+        changed = [session for session in dashboard["sessions"] if previous.get(session["id"]) != session]
+        if changed:
+            messages.append({"type": "sessions", "sessions": changed})
+        for key in ("streak", "progress"):
+            if dashboard[key] != self.sent[key]:
+                messages.append({"type": key, key: dashboard[key]})
+        return messages
+
+class ProfileChannels:
+    """Conexões abertas neste processo, por perfil."""
+    
+    def __init__(self):
+        self._channels: Dict[str, set] = {}
+    
+    def add(self, channel: ProfileChannel):
+        self._channels.setdefault(channel.profile_id, set()).add(channel)
+        WS_CONNECTIONS.inc()
+    
+    def remove(self, channel: ProfileChannel):
+        channels = self._channels.get(channel.profile_id)
+        if channels and channel in channels:
+            channels.discard(channel)
+            if not channels:
+                del self._channels[channel.profile_id]
+            WS_CONNECTIONS.dec()
+    
+    def notify(self, profile_id: str, streak: Optional[StreakInfo] = None):
+        for channel in self._channels.get(profile_id, ()):
+            channel.streak = streak
+            channel.dirty.set()
+    
+    def stats(self) -> dict:
+        return {
+            "profiles": len(self._channels),
+            "connections": sum(len(channels) for channels in self._channels.values()),
+            "turns": sum(len(channel.turns) for channels in self._channels.values() for channel in channels),
+        }
+
+profile_channels = ProfileChannels()
+
+# ------------ Routes ------------
+
+@api_router.get("/")
+async def root():
+    return {"message": "REVISAHUB API - Tutor de IA com Analogias Personalizadas"}
+
+@api_router.post("/profiles", response_model=UserProfile)
+async def create_profile(profile: UserProfileCreate):
+    profile_obj = UserProfile(**profile.model_dump())
+    await db.profiles.insert_one({**profile_obj.model_dump(), "stats": empty_stats()})
+    return profile_obj
+
+@api_router.get("/profiles/{profile_id}", response_model=UserProfile)
+async def get_profile(profile_id: str):
+    profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    return profile
+
+@api_router.put("/profiles/{profile_id}")
+async def update_profile(profile_id: str, updates: dict):
+    # Devolve os valores anteriores para descartar os prompts em cache
+    previous = await db.profiles.find_one_and_update(
+        {"id": profile_id},
+        {"$set": updates},
+        projection={"_id": 0, **{field: 1 for field in PROMPT_FIELDS}},
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    if any(field in updates for field in PROMPT_FIELDS):
+        invalidate_system_prompts(previous)
+    return {"status": "updated"}
+
+@api_router.post("/chat")
+async def chat(request: ChatRequest, response: Response):
+    image = await request_image(request)
+    if request.job:
+        response.status_code = 202
+        return await chat_jobs.enqueue(request, image)
+    return await run_chat(request, image)
+
+@api_router.post("/chat/upload")
+async def chat_upload(
+    session_id: str = Form(...),
+    profile_id: str = Form(...),
+    subject: str = Form(...),
+    message: str = Form("Por favor, analise esta imagem e me ajude a entender."),
+    request_id: Optional[str] = Form(None),
+    include_dashboard: bool = Form(False),
+    stream: bool = Form(False),
+    job: bool = Form(False),
+    image: Optional[UploadFile] = File(None),
+):
+    """
+    Variante multipart de /chat (e de /chat/stream com stream=true): a imagem vem
+    como arquivo, sem o base64 no JSON, e é reduzida antes de ir ao modelo.
+    """
+    request = ChatRequest(
+        session_id=session_id,
+        profile_id=profile_id,
+        message=message,
+        subject=subject,
+        request_id=request_id,
+        include_dashboard=include_dashboard,
+    )
+    chat_image = await prepare_image(process_image, await timed("upload", read_upload(image))) if image else None
+    if stream:
+        return await run_chat_stream(request, chat_image)
+    if job:
+        return JSONResponse(jsonable_encoder(await chat_jobs.enqueue(request, chat_image)), status_code=202)
+    with restrict_deadline(CHAT_DEADLINE):
+        return await run_chat(request, chat_image)
+
+async def run_chat(request: ChatRequest, image: Optional[ChatImage]) -> dict:
+    profile, replay, context = await load_turn(request)
+    
+    # Retentativa de um turno já respondido: devolve a mesma resposta
+    if replay:
+        return {
+            "response": replay.content,
+            "message_id": replay.id,
+            "session_id": request.session_id,
+            "cached": False,
+            "replayed": True
+        }
+    
+    # Criada agora para o timestamp ficar antes da resposta
+    user_msg = new_user_message(request, has_image=image is not None)
+    
+    # Build NOVO system prompt otimizado para analogias
+    with span("prompt"):
+        system_prompt = build_system_prompt(profile, request.subject)
+    
+    cache_key = answer_cache_key(request, profile, context, image)
+    response = await timed("answer_cache", cached_answer(cache_key, profile))
+    cached = response is not None
+    image_reuse = llm_outcome = None
+    replayable = True
+    if not cached:
+        # circuito aberto: 503 na hora, sem gravar a mensagem de desculpas
+        llm_breaker.check()
+        llm_request, llm_image, image_reuse = await timed("image", resolve_image(request, image))
+        # Sem vaga no LLM a recusa (429/503) acontece antes de qualquer gravação
+        response, llm_outcome = await generate_reply(llm_request, profile, system_prompt, context, llm_image)
+        logger.info(
+            f"chat session={request.session_id} request_id={request.request_id} llm_path={llm_outcome['path']} "
+            f"llm_ms={llm_outcome['ms']} llm_saved_ms_est={llm_outcome.get('saved_ms_est', 0)}"
+        )
+        if response is None:
+            LLM_FALLBACKS.labels("chat").inc()
+            response = LLM_FALLBACK_RESPONSE
+            replayable = False  # a retentativa tenta o LLM de novo em vez de repetir a desculpa
+        else:
+            spawn(store_answer(cache_key, profile, response))
+    
+    # shield: prazo estourado ou cliente desconectado não deixam o turno gravado pela metade
+    assistant_msg, streak = await asyncio.shield(spawn(timed("persist", persist_turn(request, user_msg, response, replayable))))
+    if assistant_msg is None:
+        # retentativa concorrente ainda gravando a resposta
+        assistant_msg = ChatMessage(session_id=request.session_id, profile_id=request.profile_id,
+                                    role="assistant", content=response, request_id=request.request_id)
+    
+    result = {
+        "response": response,
+        "message_id": assistant_msg.id,
+        "session_id": request.session_id,
+        "cached": cached
+    }
+    if llm_outcome:
+        result["llm"] = llm_outcome  # qual tentativa respondeu (primary, hedge, fallback) e em quanto tempo
+    if image:
+        result["image"] = image.report()
+        result["image_reuse"] = image_reuse
+    if request.include_dashboard:
+        if write_behind:
+            await timed("write_behind", write_behind.settled())
+        result["dashboard"] = await timed("dashboard", load_dashboard(request.profile_id, streak))
+    return result
+
+@api_router.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Variante de /chat com Server-Sent Events: eventos `data` com {"delta": ...}
+    conforme o modelo gera, e um evento final `done` com ids e tempos
+    (ttfb_ms = até o primeiro pedaço, total_ms = geração completa). Se o prazo
+    acabar durante a geração, o fim é um evento `error` (deadline_exceeded).
+    A persistência (streak, mensagens, sessão) acontece ao fim do stream,
+    inclusive se o cliente desconectar no meio.
+    """
+    return await run_chat_stream(request, await request_image(request))
+
+async def open_chat_stream(
+    request: ChatRequest, image: Optional[ChatImage],
+) -> Tuple[AsyncIterator[Tuple[Optional[str], dict]], Optional[Callable[[], None]]]:
+    """
+    Prepara um turno em streaming (usado pelo SSE e pelo WebSocket). Devolve os eventos
+    (None + {"delta"} a cada trecho, "done" no fim ou "error" se o prazo acabar) e a função que libera a vaga do LLM
+    (None quando não há chamada), para quem chama garantir a liberação.
+    """
+    started = time.perf_counter()
+    # replay != None: retentativa de um turno já respondido, reenvia a resposta gravada
+    profile, replay, context = await load_turn(request)
+    
+    # Criada agora para o timestamp ficar antes da resposta
+    user_msg = new_user_message(request, has_image=image is not None)
+    with span("prompt"):
+        system_prompt = build_system_prompt(profile, request.subject)
+    
+    cache_key = answer_cache_key(request, profile, context, image)
+    hit = replay.content if replay else await timed("answer_cache", cached_answer(cache_key, profile))
+    image_reuse = None
+    if hit is None:
+        llm_breaker.check()
+        llm_request, llm_image, image_reuse = await timed("image", resolve_image(request, image))
+        text = build_user_text(llm_request, profile, context, has_image=llm_image is not None)
+    # Reservadas antes de responder, para a recusa sair como 429/503 e não no meio do stream
+    ticket = permit = None
+    if hit is None:
+        ticket = await timed("admission", llm_admission.acquire(request.profile_id))
+        try:
+            permit = llm_breaker.acquire()
+        except LLMUnavailable:
+            ticket.release()
+            raise
+    
+    def release_llm():
+        ticket.release()
+        permit.cancel()
+    
+    async def events():
+        chunks = []
+        llm_outcome = {}
+        ttfb = first_chunk = None
+        failed = False
+        persisted = False
+        try:
+            if hit is not None:
+                ttfb = time.perf_counter() - started
+                chunks.append(hit)
+                yield None, {"delta": hit}
+            else:
+                try:
+                    with span("llm_stream"):
+                        async for chunk in llm_hedge.stream(
+                            llm, system_prompt, text, llm_image.as_part() if llm_image else None, llm_outcome,
+                        ):
+                            if ttfb is None:
+                                ttfb = time.perf_counter() - started
+                                # para o disjuntor, lento é demorar a começar, não gerar uma resposta longa
+                                first_chunk = time.monotonic() - permit.started
+                            chunks.append(chunk)
+                            yield None, {"delta": chunk}
+                except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as e:
+                    if budget_left() <= LLM_BUDGET_MARGIN:
+                        # acabou o prazo da requisição, não o do provedor: como no /chat, o
+                        # disjuntor não conta, nada é gravado e o cliente recebe o erro do prazo
+                        permit.cancel()
+                        persisted = True
+                        exceeded = DeadlineExceeded("llm")
+                        yield "error", {"status": exceeded.status_code, "detail": exceeded.detail}
+                        return
+                    permit.record(False)
+                    logging.error(f"Error streaming from Gemini: {e!r}")
+                    failed = True
+                    if not chunks:
+                        LLM_FALLBACKS.labels("stream").inc()
+                        chunks.append(LLM_FALLBACK_RESPONSE)
+                        yield None, {"delta": LLM_FALLBACK_RESPONSE}
+                else:
+                    permit.record(True, first_chunk)
+                finally:
+                    release_llm()
+                if not failed and chunks:
+                    spawn(store_answer(cache_key, profile, "".join(chunks)))
+            
+            # shield: se o cliente cair agora, a gravação continua em segundo plano
+            persisted = True
+            assistant_msg, streak = await asyncio.shield(spawn(timed("persist", persist_turn(
+                request, user_msg, "".join(chunks), replayable=not failed,
+            ))))
+            total = time.perf_counter() - started
+            logger.info(
+                f"chat_stream session={request.session_id} ttfb_ms={(ttfb or total) * 1000:.0f} total_ms={total * 1000:.0f}"
+            )
+            done = {
+                "message_id": assistant_msg.id if assistant_msg else None,
+                "session_id": request.session_id,
+                "error": failed,
+                "cached": hit is not None and not replay,
+                "replayed": bool(replay),
+                "ttfb_ms": round((ttfb or total) * 1000),
+                "total_ms": round(total * 1000),
+            }
+            if llm_outcome:
+                done["llm"] = llm_outcome
+            if image:
+                done["image"] = image.report()
+                done["image_reuse"] = image_reuse
+            if request.include_dashboard:
+                if write_behind:
+                    await timed("write_behind", write_behind.settled())
+                done["dashboard"] = jsonable_encoder(await timed("dashboard", load_dashboard(request.profile_id, streak)))
+            yield "done", done
+        finally:
+            if not persisted:
+                # Cliente desconectou: salva o que já foi gerado fora da task cancelada
+                spawn(persist_turn(request, user_msg, "".join(chunks), replayable=False))
+    
+    return events(), release_llm if ticket else None
+
+async def run_chat_stream(request: ChatRequest, image: Optional[ChatImage]) -> StreamingResponse:
+    events, release_llm = await open_chat_stream(request, image)
+    
+    async def body():
+        async with aclosing(events):
+            async for event, data in events:
+                yield sse_event(data, event=event)
+    
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # garante a liberação da vaga mesmo se o stream nem chegar a começar
+        background=BackgroundTask(release_llm) if release_llm else None,
+    )
+
+@api_router.get("/sessions/{profile_id}")
+async def get_sessions(
+    profile_id: str,
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[str] = None,
+):
+    """
+    Sessões da mais recente para a mais antiga. Se houver mais, o cabeçalho
+    X-Before-Cursor traz o cursor da próxima página (?before=...).
+    """
+    sessions, page = await timed("sessions", fetch_sessions(profile_id, limit, before))
+    response.headers.update(page.headers())
+    return sessions
+
+@api_router.get("/sessions/{profile_id}/{session_id}/messages")
+async def get_session_messages(
+    profile_id: str,
+    session_id: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    """
+    Mensagens em ordem cronológica, começando pelas mais recentes. X-Before-Cursor
+    (mensagens mais antigas, ?before=...) e X-After-Cursor (mais novas, ?after=...)
+    só vêm quando há mais mensagens naquela direção.
+    """
+    messages, page = await timed("messages", keyset_page(
+        db.messages, {"session_id": session_id, "profile_id": profile_id}, "timestamp", limit, before, after
+    ))
+    response.headers.update(page.headers())
+    return messages
+
+@api_router.get("/streak/{profile_id}")
+async def get_streak(profile_id: str):
+    profile = await timed("profile", db.profiles.find_one({"id": profile_id}, {"_id": 0}))
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    with span("build"):
+        return build_streak_info(profile)
+
+@api_router.get("/streak/{profile_id}/calendar")
+async def get_streak_heatmap(profile_id: str, days: int = Query(365, ge=1, le=MAX_CALENDAR_DAYS)):
+    profile = await timed("profile", db.profiles.find_one({"id": profile_id}, {"_id": 0, "activity_months": 1}))
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    with span("build"):
+        return {"days": get_streak_calendar(profile, days)}
+
+@api_router.get("/progress/{profile_id}", response_model=ProgressStats)
+async def get_progress(profile_id: str):
+    profile = await timed("profile", db.profiles.find_one({"id": profile_id}, {"_id": 0}))
+    if not profile:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    await timed("stats", ensure_stats(profile))
+    with span("build"):
+        return build_progress(profile, build_streak_info(profile))
+
+@api_router.get("/health")
+async def health(response: Response):
+    """
+    503 só se o MongoDB não responder. Com o disjuntor do LLM aberto o app segue
+    de pé (histórico, progresso, respostas em cache) e o status vira "degraded".
+    """
+    try:
+        await asyncio.wait_for(db.command("ping"), 2)
+        mongo = "ok"
+    except (PyMongoError, asyncio.TimeoutError):
+        mongo = "unavailable"
+    if mongo != "ok":
+        status = "down"
+        response.status_code = 503
+    else:
+        status = "ok" if llm_breaker.available else "degraded"
+    return {"status": status, "mongo": mongo, "llm": llm_breaker.stats()}
+
+@api_router.get("/chat/jobs/{job_id}")
+async def get_chat_job(job_id: str, wait: float = Query(0, ge=0, le=30)):
+    """Estado de um job do chat; com wait > 0 segura a resposta até ele terminar (long polling)."""
+    job = await chat_jobs.wait(job_id, min(wait, budget_left() - 1)) if wait else await chat_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job_view(job)
+
+@api_router.get("/chat/jobs/{job_id}/events")
+async def chat_job_events(job_id: str):
+    """Push do resultado por SSE: um evento status a cada mudança e done (ou failed) no fim."""
+    job = await chat_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    
+    async def events() -> AsyncIterator[str]:
+        current = job
+        status = None
+        while True:
+            if current["status"] != status:
+                status = current["status"]
+                event = status if status in JOB_FINAL else "status"
+                yield sse_event(jsonable_encoder(job_view(current)), event=event)
+                if status in JOB_FINAL:
+                    return
+            remaining = min(15, budget_left() - 1)
+            if remaining <= 0:
+                return  # prazo do stream: o cliente reconecta ou passa a consultar
+            current = await chat_jobs.wait(job_id, remaining) or current
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@api_router.websocket("/ws/{profile_id}")
+async def chat_socket(websocket: WebSocket, profile_id: str):
+    """Canal do chat por perfil (ver WebSocket); perfil inexistente recusa o handshake."""
+    # o DeadlineMiddleware só cuida de HTTP: cada turno do canal ganha seu próprio prazo
+    request_route.set("/api/ws/{profile_id}")
+    with pymongo.timeout(REQUEST_DEADLINE):
+        profile = await db.profiles.find_one({"id": profile_id}, {"_id": 0, "id": 1})
+    if not profile:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    await ProfileChannel(websocket, profile_id).serve()
+
+@api_router.get("/stats")
+async def get_runtime_stats():
+    """Contadores internos deste worker (caches e pool do LLM)."""
+    return {
+        "prompt_cache": prompt_cache.stats(),
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "llm": llm.stats(),
+        "llm_admission": llm_admission.stats(),
+        "llm_coalescing": llm_flight.stats(),
+        "llm_tail": llm_hedge.stats(),
+        "llm_breaker": llm_breaker.stats(),
+        "images": dict(image_stats),
+        "write_behind": write_behind.stats() if write_behind else None,
+        "chat_jobs": await chat_jobs.stats(),
+        "websocket": profile_channels.stats(),
+        "context": {
+            **context_stats,
+            # em relação a mandar as mesmas mensagens inteiras (~4 caracteres por token)
+            "saved_tokens_est": max(context_stats["history_chars"] - context_stats["context_chars"], 0) // 4,
+        },
+        "image_store": os.environ.get('IMAGE_STORE') or None,
+    }
+
+@api_router.get("/dashboard/{profile_id}")
+async def get_dashboard(profile_id: str):
+    """Sessões, progresso e streak numa só chamada (o que a ChatPage carrega ao abrir)."""
+    dashboard = await load_dashboard(profile_id)
+    if dashboard is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    return dashboard
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # sem ADMIN_TOKEN configurado as rotas de depuração ficam fechadas
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Acesso negado")
+
+@api_router.post("/debug/profiler", dependencies=[Depends(require_admin)])
+async def toggle_profiler(enabled: bool, interval_ms: float = Query(5, gt=0, le=1000)):
+    """Liga (zerando as amostras) ou desliga o profiler por amostragem deste worker."""
+    if enabled:
+        profiler.start(interval_ms / 1000)
+    else:
+        profiler.stop()
+    return {"running": profiler.running, "interval_ms": profiler.interval * 1000, "stacks": len(profiler.samples)}
+
+@api_router.get("/debug/profiler", dependencies=[Depends(require_admin)])
+async def get_profile_samples(limit: int = Query(200, ge=1, le=5000)):
+    """Pilhas amostradas no formato collapsed (funciona com o profiler ligado ou depois de desligar)."""
+    return Response(profiler.collapsed(limit), media_type="text/plain")
+
+@app.exception_handler(PyMongoError)
+async def mongo_timeout_handler(request, exc: PyMongoError):
+    # com pymongo.timeout ativo, estouro do maxTimeMS/socket/seleção de servidor = prazo da requisição
+    if not exc.timeout:
+        raise exc
+    REQUEST_DEADLINE_EXCEEDED.labels(request_route.get(), "mongo").inc()
+    return JSONResponse(status_code=504, content={"detail": {"error": "deadline_exceeded", "stage": "mongo"}})
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    # síncrona de propósito: o FastAPI roda no threadpool (lê arquivos no modo multiprocess)
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
 app.include_router(api_router)
 
+# antes do CORS = mais internos: o 413 e o 504 deles também levam os cabeçalhos do CORS
+app.add_middleware(BodyLimitMiddleware, limits={"/api/chat/upload": IMAGE_MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD})
+app.add_middleware(DeadlineMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor", "Server-Timing"],
 )
+app.add_middleware(TimingMiddleware)
+# adicionado por último = mais externo: mede também o tempo do CORS
+app.add_middleware(MetricsMiddleware)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -655,6 +3734,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_llm_client():
+    global llm
+    llm = create_llm_client()
+
+@app.on_event("startup")
+async def startup_write_behind():
+    if write_behind:
+        write_behind.start()
+
+@app.on_event("startup")
+async def startup_chat_jobs():
+    chat_jobs.start()
+
+@app.on_event("startup")
+async def startup_loop_monitor():
+    spawn(monitor_event_loop())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # antes do write-behind: os jobs em andamento voltam à fila
+    await chat_jobs.close()
+    if write_behind:
+        # grava o que ainda está na fila antes de fechar a conexão
+        await write_behind.close()
+    await llm.aclose()
+    image_executor.shutdown(wait=False)
+    profiler.stop()
     client.close()
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
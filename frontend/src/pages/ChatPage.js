@@ -1,4 +1,4 @@
-import { useState, useRef, useEffect, useCallback } from "react";
+import { useState, useRef, useEffect, useLayoutEffect, useCallback } from "react";
 import { motion, AnimatePresence } from "framer-motion";
 import axios from "axios";
 import { Send, Image as ImageIcon, X, Zap, MessageSquare, Loader2, Menu, Flame } from "lucide-react";
@@ -7,6 +7,11 @@ import MessageBubble from "../components/MessageBubble";
 import ChatSidebar from "../components/ChatSidebar";
 import StatsModal from "../components/StatsModal";
 
+// Mensagens por página do histórico (as mais antigas carregam ao rolar para cima)
+const HISTORY_PAGE_SIZE = 30;
+
+const toMessage = (msg) => ({ ...msg, timestamp: new Date(msg.timestamp) });
+
 const SUBJECTS = [
   { id: "matematica", label: "Matemática", color: "#3b82f6", emoji: "📐" },
   { id: "fisica", label: "Física", color: "#a855f7", emoji: "⚡" },
@@ -18,6 +23,76 @@ const SUBJECTS = [
   { id: "filosofia", label: "Filosofia", color: "#d946ef", emoji: "💭" },
 ];
 
+async function streamChat(payload, imageFile, onDelta) {
+  let response;
+  if (imageFile) {
+    // Foto vai como arquivo (multipart), sem inflar o JSON com base64
+    const form = new FormData();
+    Object.entries(payload).forEach(([key, value]) => form.append(key, value));
+    form.append("stream", "true");
+    form.append("image", imageFile);
+    response = await fetch(`${API}/chat/upload`, { method: "POST", body: form });
+  } else {
+    response = await fetch(`${API}/chat/stream`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(payload)
+    });
+  }
+  if (!response.ok || !response.body) {
+    const error = new Error(`HTTP ${response.status}`);
+    // 429/503 do limitador trazem uma mensagem pronta para o aluno
+    error.detail = (await response.json().catch(() => null))?.detail;
+    throw error;
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let done = null;
+  while (true) {
+    const { value, done: finished } = await reader.read();
+    if (finished) break;
+    buffer += decoder.decode(value, { stream: true });
+    const events = buffer.split("\n\n");
+    buffer = events.pop();
+    for (const raw of events) {
+      const lines = raw.split("\n");
+      const event = lines.find(l => l.startsWith("event:"))?.slice(6).trim();
+      const data = lines.filter(l => l.startsWith("data:")).map(l => l.slice(5)).join("\n");
+      if (!data) continue;
+      const parsed = JSON.parse(data);
+      if (event === "done") done = parsed;
+      else if (event === "error") throw Object.assign(new Error(`HTTP ${parsed.status}`), { detail: parsed.detail });
+      else if (parsed.delta) onDelta(parsed.delta);
+    }
+  }
+  return done;
+}
+
+// Turno pelo WebSocket do perfil: os trechos chegam em "chunk" e o fim em "done" ou "error"
+function socketChat(socket, turns, payload, onDelta) {
+  return new Promise((resolve, reject) => {
+    turns.set(payload.request_id, (msg) => {
+      if (msg.type === "chunk") {
+        onDelta(msg.delta);
+        return;
+      }
+      turns.delete(payload.request_id);
+      if (msg.type === "done") resolve(msg);
+      else reject(Object.assign(new Error(`WS ${msg.status}`), { detail: msg.detail }));
+    });
+    socket.send(JSON.stringify({ type: "chat", ...payload }));
+  });
+}
+
+// Sessões alteradas (aviso do WebSocket) entram por id, mantendo a ordem por atividade
+const mergeSessions = (current, changed) => {
+  const ids = new Set(changed.map(s => s.id));
+  return [...changed, ...current.filter(s => !ids.has(s.id))]
+    .sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at));
+};
+
 export default function ChatPage({ profile, onLogout }) {
   const [messages, setMessages] = useState([]);
   const [inputValue, setInputValue] = useState("");
@@ -26,23 +101,34 @@ export default function ChatPage({ profile, onLogout }) {
   const [showSubjectSelector, setShowSubjectSelector] = useState(false);
   const [pendingMessage, setPendingMessage] = useState(null);
   const [imagePreview, setImagePreview] = useState(null);
-  const [imageBase64, setImageBase64] = useState(null);
+  const [imageFile, setImageFile] = useState(null);
   const [sessions, setSessions] = useState([]);
   const [currentSessionId, setCurrentSessionId] = useState(null);
   const [stats, setStats] = useState(null);
   const [streak, setStreak] = useState(null);
   const [showStats, setShowStats] = useState(false);
   const [sidebarOpen, setSidebarOpen] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   
   const messagesEndRef = useRef(null);
+  const scrollRef = useRef(null);
+  const olderCursorRef = useRef(null);
+  const loadingOlderRef = useRef(false);
+  const scrollRestoreRef = useRef(null);
+  const skipAutoScrollRef = useRef(false);
+  const lastScrollTopRef = useRef(0);
   const fileInputRef = useRef(null);
+  const socketRef = useRef(null);
+  const socketTurnsRef = useRef(new Map());
 
   const generateSessionId = () => `session-${Date.now()}-${Math.random().toString(36).substr(2, 9)}`;
+  const generateRequestId = () => `req-${Date.now()}-${Math.random().toString(36).substr(2, 9)}`;
 
   const culturalRef = profile.interesse_cultural || profile.cultural_interest || "cultura pop";
 
   const startNewChat = useCallback(() => {
     const newSessionId = generateSessionId();
+    olderCursorRef.current = null;
     setCurrentSessionId(newSessionId);
     setMessages([{
       id: "welcome",
@@ -54,36 +140,84 @@ export default function ChatPage({ profile, onLogout }) {
     setSidebarOpen(false);
   }, [profile.name, culturalRef]);
 
+  const applyDashboard = useCallback((dashboard) => {
+    setSessions(dashboard.sessions);
+    setStats(dashboard.progress);
+    setStreak(dashboard.streak);
+  }, []);
+
   useEffect(() => {
     async function loadData() {
       try {
-        const [sessionsRes, statsRes, streakRes] = await Promise.all([
-          axios.get(`${API}/sessions/${profile.id}`),
-          axios.get(`${API}/progress/${profile.id}`),
-          axios.get(`${API}/streak/${profile.id}`)
-        ]);
-        setSessions(sessionsRes.data);
-        setStats(statsRes.data);
-        setStreak(streakRes.data);
+        const response = await axios.get(`${API}/dashboard/${profile.id}`);
+        applyDashboard(response.data);
       } catch (error) {
         console.error("Error loading data:", error);
       }
     }
     loadData();
-  }, [profile.id]);
+  }, [profile.id, applyDashboard]);
+
+  // Canal do perfil: turnos sem foto vão por ele, e sessões/streak/progresso chegam sozinhos
+  useEffect(() => {
+    let stopped = false;
+    let retries = 0;
+    let timer;
+    const turns = socketTurnsRef.current;
+    function connect() {
+      const socket = new WebSocket(`${API.replace(/^http/, "ws")}/ws/${profile.id}`);
+      socketRef.current = socket;
+      socket.onopen = () => { retries = 0; };
+      socket.onmessage = (event) => {
+        const msg = JSON.parse(event.data);
+        if (msg.type === "dashboard") applyDashboard(msg);
+        else if (msg.type === "sessions") setSessions(prev => mergeSessions(prev, msg.sessions));
+        else if (msg.type === "streak") setStreak(msg.streak);
+        else if (msg.type === "progress") setStats(msg.progress);
+        else if (msg.request_id) turns.get(msg.request_id)?.(msg);
+      };
+      socket.onclose = () => {
+        if (socketRef.current === socket) socketRef.current = null;
+        turns.forEach(handler => handler({ type: "error", status: 0 }));
+        turns.clear();
+        // enquanto reconecta, os envios usam HTTP
+        if (!stopped) timer = setTimeout(connect, Math.min(1000 * 2 ** retries++, 30000));
+      };
+    }
+    connect();
+    return () => {
+      stopped = true;
+      clearTimeout(timer);
+      socketRef.current?.close();
+    };
+  }, [profile.id, applyDashboard]);
 
   useEffect(() => {
     if (!currentSessionId) startNewChat();
   }, [currentSessionId, startNewChat]);
 
+  // Mensagens antigas entram no topo: mantém na tela o que o usuário estava lendo
+  useLayoutEffect(() => {
+    const restore = scrollRestoreRef.current;
+    if (!restore || !scrollRef.current) return;
+    scrollRestoreRef.current = null;
+    skipAutoScrollRef.current = true;
+    scrollRef.current.scrollTop = scrollRef.current.scrollHeight - restore.height + restore.top;
+  }, [messages]);
+
   useEffect(() => {
+    if (skipAutoScrollRef.current) {
+      skipAutoScrollRef.current = false;
+      return;
+    }
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [messages, isLoading]);
 
   async function loadSession(sessionId, subject) {
     try {
-      const response = await axios.get(`${API}/sessions/${profile.id}/${sessionId}/messages`);
-      setMessages(response.data.map(msg => ({ ...msg, timestamp: new Date(msg.timestamp) })));
+      const response = await axios.get(`${API}/sessions/${profile.id}/${sessionId}/messages`, { params: { limit: HISTORY_PAGE_SIZE } });
+      olderCursorRef.current = response.headers["x-before-cursor"] || null;
+      setMessages(response.data.map(toMessage));
       setCurrentSessionId(sessionId);
       setSelectedSubject(subject);
       setSidebarOpen(false);
@@ -92,30 +226,55 @@ export default function ChatPage({ profile, onLogout }) {
     }
   }
 
+  async function loadOlderMessages() {
+    const cursor = olderCursorRef.current;
+    if (!cursor || loadingOlderRef.current) return;
+    loadingOlderRef.current = true;
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`${API}/sessions/${profile.id}/${currentSessionId}/messages`, { params: { limit: HISTORY_PAGE_SIZE, before: cursor } });
+      if (olderCursorRef.current !== cursor) return; // trocou de sessão no meio
+      olderCursorRef.current = response.headers["x-before-cursor"] || null;
+      const el = scrollRef.current;
+      scrollRestoreRef.current = { height: el.scrollHeight, top: el.scrollTop };
+      setMessages(prev => [...response.data.map(toMessage), ...prev]);
+    } catch (error) {
+      console.error("Error loading older messages:", error);
+    } finally {
+      loadingOlderRef.current = false;
+      setLoadingOlder(false);
+    }
+  }
+
+  function handleMessagesScroll(e) {
+    const { scrollTop } = e.currentTarget;
+    // só quando o usuário sobe (a rolagem automática até o fim desce a partir do topo)
+    if (scrollTop < 120 && scrollTop < lastScrollTopRef.current) loadOlderMessages();
+    lastScrollTopRef.current = scrollTop;
+  }
+
   function handleImageUpload(e) {
     const file = e.target.files?.[0];
     if (!file || !file.type.startsWith("image/")) return;
     const reader = new FileReader();
-    reader.onload = (event) => {
-      setImagePreview(event.target.result);
-      setImageBase64(event.target.result);
-    };
+    reader.onload = (event) => setImagePreview(event.target.result);
+    setImageFile(file);
     reader.readAsDataURL(file);
   }
 
   function removeImage() {
     setImagePreview(null);
-    setImageBase64(null);
+    setImageFile(null);
     if (fileInputRef.current) fileInputRef.current.value = "";
   }
 
   function initiateSend() {
-    if (!inputValue.trim() && !imageBase64) return;
+    if (!inputValue.trim() && !imageFile) return;
     if (!selectedSubject) {
-      setPendingMessage({ text: inputValue, image: imageBase64 });
+      setPendingMessage({ text: inputValue, image: imageFile });
       setShowSubjectSelector(true);
     } else {
-      sendMessage(inputValue, imageBase64, selectedSubject);
+      sendMessage(inputValue, imageFile, selectedSubject);
     }
   }
 
@@ -138,25 +297,35 @@ export default function ChatPage({ profile, onLogout }) {
     setIsLoading(true);
 
     try {
-      const response = await axios.post(`${API}/chat`, {
+      const assistantId = `stream-${Date.now()}`;
+      let started = false;
+      const payload = {
         session_id: currentSessionId,
         profile_id: profile.id,
         message: text || "Por favor, analise esta imagem e me ajude a entender.",
         subject: subject.label,
-        image_base64: image
-      });
-
-      setMessages(prev => [...prev, { id: response.data.message_id, role: "assistant", content: response.data.response, timestamp: new Date() }]);
-      
-      // Refresh data
-      const [sessionsRes, streakRes] = await Promise.all([
-        axios.get(`${API}/sessions/${profile.id}`),
-        axios.get(`${API}/streak/${profile.id}`)
-      ]);
-      setSessions(sessionsRes.data);
-      setStreak(streakRes.data);
+        request_id: generateRequestId()
+      };
+      const onDelta = (delta) => {
+        if (!started) {
+          started = true;
+          setIsLoading(false);
+          setMessages(prev => [...prev, { id: assistantId, role: "assistant", content: delta, timestamp: new Date() }]);
+        } else {
+          setMessages(prev => prev.map(m => m.id === assistantId ? { ...m, content: m.content + delta } : m));
+        }
+      };
+      // Foto continua indo por multipart; sem o canal aberto, o dashboard vem junto com a resposta
+      const socket = socketRef.current;
+      const done = socket?.readyState === WebSocket.OPEN && !image
+        ? await socketChat(socket, socketTurnsRef.current, payload, onDelta)
+        : await streamChat({ ...payload, include_dashboard: true }, image, onDelta);
+      if (done?.message_id) {
+        setMessages(prev => prev.map(m => m.id === assistantId ? { ...m, id: done.message_id } : m));
+      }
+      if (done?.dashboard) applyDashboard(done.dashboard);
     } catch (error) {
-      setMessages(prev => [...prev, { id: `error-${Date.now()}`, role: "assistant", content: "Desculpe, tive um problema. Pode tentar novamente?", timestamp: new Date() }]);
+      setMessages(prev => [...prev, { id: `error-${Date.now()}`, role: "assistant", content: (typeof error.detail === "string" && error.detail) || "Desculpe, tive um problema. Pode tentar novamente?", timestamp: new Date() }]);
     } finally {
       setIsLoading(false);
     }
@@ -220,7 +389,12 @@ export default function ChatPage({ profile, onLogout }) {
         </header>
 
         {/* Messages */}
-        <div className="flex-1 overflow-y-auto p-4 md:p-6 space-y-6">
+        <div ref={scrollRef} onScroll={handleMessagesScroll} className="flex-1 overflow-y-auto p-4 md:p-6 space-y-6">
+          {loadingOlder && (
+            <div className="flex justify-center">
+              <Loader2 className="w-4 h-4 text-slate-500 animate-spin" />
+            </div>
+          )}
           {messages.map((msg) => <MessageBubble key={msg.id} msg={msg} />)}
           {isLoading && (
             <motion.div initial={{ opacity: 0 }} animate={{ opacity: 1 }} className="flex items-center gap-3">
@@ -268,7 +442,7 @@ export default function ChatPage({ profile, onLogout }) {
             <input type="file" ref={fileInputRef} onChange={handleImageUpload} accept="image/*" className="hidden" />
             <button onClick={() => fileInputRef.current?.click()} data-testid="upload-image-btn" className="p-2 text-slate-500 hover:text-white hover:bg-[#1e293b] rounded-lg transition-colors"><ImageIcon className="w-5 h-5" /></button>
             <textarea value={inputValue} onChange={(e) => setInputValue(e.target.value)} onKeyDown={handleKeyDown} placeholder="Digite sua dúvida ou mande uma foto..." data-testid="chat-input" className="flex-1 bg-transparent border-none text-white resize-none max-h-32 py-2 min-h-[44px] placeholder-slate-500 focus:outline-none" rows={1} />
-            <button onClick={initiateSend} disabled={(!inputValue.trim() && !imageBase64) || isLoading} data-testid="send-message-btn" className="p-2 bg-blue-500 text-white rounded-xl hover:bg-blue-400 disabled:opacity-50 disabled:cursor-not-allowed transition-colors"><Send className="w-5 h-5" /></button>
+            <button onClick={initiateSend} disabled={(!inputValue.trim() && !imageFile) || isLoading} data-testid="send-message-btn" className="p-2 bg-blue-500 text-white rounded-xl hover:bg-blue-400 disabled:opacity-50 disabled:cursor-not-allowed transition-colors"><Send className="w-5 h-5" /></button>
           </div>
           <p className="text-center text-xs text-slate-600 mt-2">Explicações adaptadas ao seu perfil {profile.canal_sensorial || profile.vark_primary} usando analogias de {culturalRef}</p>
         </div>
@@ -0,0 +1,139 @@
+"""
+Bootstrap comum dos testes: ambiente de teste, backend no sys.path e as fixtures
+compartilhadas (módulo `server`, MongoDB real quando disponível e um Gemini falso).
+"""
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+import httpx
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "revisahub_test")
+# nenhum worker de job disputando a fila com o teste
+os.environ.setdefault("CHAT_JOB_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server as server_module  # noqa: E402
+
+FALLBACK_MODEL = "gemini-fallback"
+PROFILE = {
+    "name": "Ana", "canal_sensorial": "visual", "formato_explicacao": "analogias_historias", "abordagem": "pratica",
+    "interacao_social": "sozinho", "estrutura_estudo": "equilibrado", "duracao_sessao": "30_60",
+    "ambiente_estudo": "silencio", "motivador_principal": "desafios_metas", "estrategia_dificuldade": "busca_exemplos",
+    "planejamento_estudos": "semanal", "interesse_cultural": "Anime",
+}
+
+
+@lru_cache(maxsize=1)
+def mongo_available() -> bool:
+    try:
+        MongoClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+@pytest.fixture
+def server():
+    return server_module
+
+
+@pytest.fixture
+def mongo_server(monkeypatch):
+    """`server` com um banco de teste limpo; sem MongoDB em MONGO_URL o teste é pulado."""
+    if not mongo_available():
+        pytest.skip("MongoDB indisponível em MONGO_URL")
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    # cliente novo por teste: o do módulo fica preso ao loop em que foi usado primeiro
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], tz_aware=True)
+    monkeypatch.setattr(server_module, "client", client)
+    monkeypatch.setattr(server_module, "db", client[os.environ["DB_NAME"]])
+    yield server_module
+    MongoClient(os.environ["MONGO_URL"]).drop_database(os.environ["DB_NAME"])
+    client.close()
+
+
+@pytest.fixture
+def api(mongo_server, monkeypatch):
+    """
+    with api(llm) as client: TestClient do app (startup e shutdown incluídos) com `llm`
+    no lugar do Gemini e um perfil novo em client.profile_id.
+    """
+    from fastapi.testclient import TestClient
+
+    @contextmanager
+    def start(llm):
+        monkeypatch.setattr(mongo_server, "create_llm_client", lambda: llm)
+        # o shutdown do app encerra o executor de imagens: cada app de teste ganha um novo
+        monkeypatch.setattr(mongo_server, "image_executor", ThreadPoolExecutor(max_workers=2))
+        with TestClient(mongo_server.app) as client:
+            client.profile_id = client.post("/api/profiles", json=PROFILE).json()["id"]
+            yield client
+
+    return start
+
+
+@pytest.fixture
+def fake_gemini():
+    """
+    fake_gemini(latency, chunks=None) -> GeminiClient contra um Gemini falso.
+    latency(model, call_number) dá os segundos até responder, ou None para falhar com 503;
+    a resposta é `chunks` (um evento SSE por pedaço) ou, sem eles, o nome do modelo.
+    """
+
+    def make(latency, chunks=None) -> server_module.GeminiClient:
+        calls = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            model = request.url.path.split("/models/")[1].split(":")[0]
+            calls.append(model)
+            delay = latency(model, len(calls))
+            if delay is None:
+                return httpx.Response(503, json={"error": {"code": 503}})
+            await asyncio.sleep(delay)
+            parts = chunks or [model]
+            if "streamGenerateContent" in request.url.path:
+                return httpx.Response(200, text="".join(
+                    f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': part}]}}]})}\r\n\r\n"
+                    for part in parts
+                ))
+            return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": "".join(parts)}]}}]})
+
+        client = server_module.GeminiClient("fake", transport=httpx.MockTransport(handler))
+        client.calls = calls
+        return client
+
+    return make
+
+
+@pytest.fixture
+def hedged():
+    """hedged(**overrides) -> HedgedLLM com prazos curtos, em décimos de segundo."""
+
+    def make(**overrides) -> server_module.HedgedLLM:
+        config = dict(deadline=1.0, hedge_quantile=0.95, hedge_min_delay=0.05, hedge_default_delay=0.1,
+                      fallback_model=FALLBACK_MODEL, fallback_reserve=0.3)
+        return server_module.HedgedLLM(**{**config, **overrides})
+
+    return make
+
+
+@pytest.fixture
+def breaker():
+    """breaker(**overrides) -> CircuitBreaker que abre com 4 chamadas e reabre em 50 ms."""
+
+    def make(**overrides) -> server_module.CircuitBreaker:
+        config = dict(failure_rate=0.5, min_calls=4, window=60, slow_call=1.0, open_for=0.05, probes=2)
+        return server_module.CircuitBreaker(**{**config, **overrides})
+
+    return make
@@ -0,0 +1,21 @@
+"""
+Nome do aluno nas respostas em cache: vira marcador só como palavra inteira e em
+qualquer parte do nome, para que a resposta de um aluno sirva a outro sem vazar nada.
+"""
+
+
+def test_name_inside_another_word_is_kept(server):
+    answer = server.depersonalize("Ana, a Anatomia estuda o corpo.", {"name": "Ana"})
+
+    assert answer == "{{nome_do_aluno}}, a Anatomia estuda o corpo."
+    assert server.personalize(answer, {"name": "Pedro"}) == "Pedro, a Anatomia estuda o corpo."
+
+
+def test_each_part_of_the_full_name_is_replaced(server):
+    profile = {"name": "Ana Clara de Souza"}
+
+    answer = server.depersonalize("Ana Clara de Souza, pense assim: Clara, a luz é clara. Certo, Ana? Vem de Souza.", profile)
+
+    # "clara" minúsculo é adjetivo e "de" é partícula, não nome
+    assert answer == ("{{nome_do_aluno}}, pense assim: {{nome_do_aluno}}, a luz é clara. "
+                      "Certo, {{nome_do_aluno}}? Vem de {{nome_do_aluno}}.")
@@ -0,0 +1,57 @@
+"""
+Jobs do chat com image_store: o job guarda só os metadados da foto e o worker lê
+os bytes do armazenamento; se a foto saiu dele, o job falha com 410.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import io
+
+import pytest
+from PIL import Image
+
+
+def photo() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def store(mongo_server, tmp_path, monkeypatch):
+    image_store = mongo_server.FileImageStore(tmp_path, 10 ** 7)
+    monkeypatch.setattr(mongo_server, "image_store", image_store)
+    return image_store
+
+
+def run_job(server, client, request_id: str, before_work=None) -> dict:
+    data = {"session_id": "sessao", "profile_id": client.profile_id, "subject": "Física",
+            "message": "O que diz a questão?", "request_id": request_id, "job": "true"}
+    job_id = client.post("/api/chat/upload", data=data, files={"image": ("q.png", photo(), "image/png")}).json()["job_id"]
+
+    async def work():
+        job = await server.db.chat_jobs.find_one({"id": job_id}, {"_id": 0})
+        if before_work:
+            before_work(job)
+        claimed = await server.chat_jobs._claim("worker")
+        await server.chat_jobs._process(claimed, "worker")
+        return job
+
+    queued = client.portal.call(work)
+    assert "data" not in queued["image"]
+    return client.get(f"/api/chat/jobs/{job_id}").json()
+
+
+def test_worker_reads_the_photo_from_the_store(server, api, fake_gemini, store):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        job = run_job(server, client, "r1")
+
+    assert job["status"] == "done"
+    assert job["result"]["response"]
+
+
+def test_photo_gone_from_the_store_fails_the_job(server, api, fake_gemini, store):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        job = run_job(server, client, "r1", before_work=lambda job: store._path(job["image"]["sha256"]).unlink())
+
+    assert job["status"] == "failed"
+    assert job["error"]["status"] == 410
@@ -0,0 +1,82 @@
+"""
+Fila de jobs do chat: um job cujo worker caiu volta à fila quando o lease vence, e
+com o LLM sobrecarregado o job é adiado sem gastar tentativa, mas só até
+CHAT_JOB_MAX_AGE; depois disso falha com 503.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def overloaded(mongo_server, monkeypatch):
+    async def run_chat(request, image):
+        raise mongo_server.LLMOverloaded(503, "LLM ocupado", retry_after=7)
+
+    monkeypatch.setattr(mongo_server, "run_chat", run_chat)
+
+
+def enqueue(client) -> str:
+    response = client.post("/api/chat", json={"session_id": "s", "profile_id": client.profile_id, "subject": "Física",
+                                              "message": "Oi", "job": True})
+    assert response.status_code == 202
+    return response.json()["job_id"]
+
+
+def work(server, client, job_id: str, **fields) -> dict:
+    async def run():
+        if fields:
+            await server.db.chat_jobs.update_one({"id": job_id}, {"$set": fields})
+        claimed = await server.chat_jobs._claim("worker")
+        await server.chat_jobs._process(claimed, "worker")
+        return await server.db.chat_jobs.find_one({"id": job_id}, {"_id": 0})
+
+    return client.portal.call(run)
+
+
+def test_overloaded_job_is_deferred_without_spending_an_attempt(server, api, fake_gemini, overloaded):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        job = work(server, client, enqueue(client))
+
+    assert (job["status"], job["attempts"]) == ("queued", 0)
+    delay = server.as_datetime(job["available_at"]) - datetime.now(timezone.utc)
+    assert timedelta(seconds=5) < delay <= timedelta(seconds=7)
+
+
+def test_overloaded_job_fails_past_the_max_age(server, api, fake_gemini, overloaded):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        job_id = enqueue(client)
+        old = datetime.now(timezone.utc) - timedelta(seconds=server.chat_jobs.max_age + 1)
+        work(server, client, job_id, created_at=old)
+        view = client.get(f"/api/chat/jobs/{job_id}").json()
+
+    assert view["status"] == "failed"
+    assert view["error"] == {"status": 503, "detail": "LLM ocupado"}
+
+
+def test_job_whose_lease_expired_is_reclaimed_and_finished_once(server, api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        job_id = enqueue(client)
+
+        async def crash_after_claim():
+            # worker pegou o job e caiu: o lease vence sem ninguém gravar o resultado
+            job = await server.chat_jobs._claim("crashed")
+            leased = await server.chat_jobs._claim("other")  # com o lease valendo, ninguém mais pega
+            expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+            await server.db.chat_jobs.update_one({"id": job["id"]}, {"$set": {"lease_until": expired}})
+            return job, leased
+
+        crashed, leased = client.portal.call(crash_after_claim)
+        job = work(server, client, job_id)
+        late = client.portal.call(server.chat_jobs._finish, crashed, "crashed", "failed", {})
+        view = client.get(f"/api/chat/jobs/{job_id}").json()
+        messages = client.get(f"/api/sessions/{client.profile_id}/s/messages").json()
+
+    assert leased is None and late is None
+    assert (job["status"], job["attempts"]) == ("done", 2)
+    assert "lease_until" not in job and "worker" not in job
+    # o worker que perdeu o lease não sobrescreve o resultado
+    assert view["status"] == "done" and "error" not in view
+    assert [message["role"] for message in messages] == ["user", "assistant"]
@@ -0,0 +1,44 @@
+"""
+Idempotência do /chat: a retentativa com o mesmo request_id repete a resposta
+gravada, mas nunca a mensagem de desculpas de uma falha do LLM.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+
+
+def turn(client, request_id: str, message: str = "O que é fotossíntese?") -> dict:
+    response = client.post("/api/chat", json={
+        "session_id": "sessao", "profile_id": client.profile_id, "subject": "Biologia",
+        "message": message, "request_id": request_id,
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_retry_replays_the_stored_answer(api, fake_gemini):
+    llm = fake_gemini(lambda model, n: 0, chunks=["Luz vira ", "açúcar."])
+    with api(llm) as client:
+        first = turn(client, "r1")
+        retry = turn(client, "r1")
+
+    assert first["response"] == "Luz vira açúcar."
+    assert retry["replayed"] and (retry["response"], retry["message_id"]) == (first["response"], first["message_id"])
+    assert len(llm.calls) == 1
+
+
+def test_retry_after_llm_failure_asks_again(server, api, fake_gemini):
+    upstream = {"up": False}
+    llm = fake_gemini(lambda model, n: 0 if upstream["up"] else None, chunks=["Luz vira açúcar."])
+    with api(llm) as client:
+        failed = turn(client, "r1")
+        upstream["up"] = True
+        retry = turn(client, "r1")
+        again = turn(client, "r1")
+        messages = client.get(f"/api/sessions/{client.profile_id}/sessao/messages").json()
+
+    assert failed["response"] == server.LLM_FALLBACK_RESPONSE
+    assert retry["response"] == "Luz vira açúcar." and not retry.get("replayed")
+    assert again["replayed"] and again["message_id"] == retry["message_id"]
+    assert [m["content"] for m in messages if m["role"] == "assistant"] == [
+        server.LLM_FALLBACK_RESPONSE, "Luz vira açúcar.",
+    ]
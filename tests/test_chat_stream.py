@@ -0,0 +1,46 @@
+"""
+Chat por SSE (/api/chat/stream): trechos em eventos `data` e um evento `done` no fim
+com os ids e os tempos (ttfb_ms até o primeiro trecho, total_ms do turno inteiro).
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import json
+
+
+def parse_sse(text: str) -> list:
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields.get("event"), json.loads(fields["data"])))
+    return events
+
+
+def stream(client, **overrides) -> list:
+    body = {"session_id": "s", "profile_id": client.profile_id, "subject": "Física", "message": "O que é inércia?",
+            "request_id": "r1", **overrides}
+    response = client.post("/api/chat/stream", json=body)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    return parse_sse(response.text)
+
+
+def test_done_event_carries_the_ids_and_timings(api, fake_gemini):
+    llm = fake_gemini(lambda model, n: 0.2, chunks=["Pense ", "num ", "ônibus freando."])
+    with api(llm) as client:
+        events = stream(client)
+        replayed = stream(client)
+        messages = client.get(f"/api/sessions/{client.profile_id}/s/messages").json()
+
+    *deltas, (event, done) = events
+    assert [data["delta"] for _, data in deltas] == ["Pense ", "num ", "ônibus freando."]
+    assert event == "done"
+    assert [message["id"] for message in messages if message["role"] == "assistant"] == [done["message_id"]]
+    assert done["session_id"] == "s"
+    assert (done["error"], done["cached"], done["replayed"]) == (False, False, False)
+    assert 200 <= done["ttfb_ms"] <= done["total_ms"]
+
+    # retentativa do mesmo request_id: a resposta gravada volta sem chamar o LLM de novo
+    *_, (_, again) = replayed
+    assert again["replayed"] is True and again["message_id"] == done["message_id"]
+    assert again["ttfb_ms"] < 200
+    assert len(llm.calls) == 1
@@ -0,0 +1,69 @@
+"""
+Contexto da conversa: resumo da sessão + as mensagens recentes que cabem no
+orçamento, e o resumo que incorpora as mensagens que saíram da janela recente.
+
+Os testes com banco precisam de um MongoDB em MONGO_URL; sem ele são pulados.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+
+def recent(*contents: str) -> list:
+    """Mensagens como vêm do banco: mais novas primeiro."""
+    return [{"role": "user", "content": content, "length": len(content)} for content in contents]
+
+
+def test_context_keeps_the_newest_messages_within_the_budget(server):
+    kept = server.fit_context("r" * 100, recent("c" * 150, "b" * 150, "a" * 150), budget=450)
+
+    # o resumo come 100 do orçamento: cabem só as duas mais novas, na ordem da conversa
+    assert [msg["content"][0] for msg in kept] == ["b", "c"]
+
+
+def test_newest_message_is_cut_to_fit_instead_of_dropped(server):
+    kept = server.fit_context(None, recent("x" * 500, "y" * 10), budget=200)
+
+    assert len(kept) == 1
+    assert kept[0]["content"] == "x" * 200 + "..."
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.transcripts = []
+
+    async def generate(self, system_prompt: str, text: str) -> str:
+        self.transcripts.append(text)
+        return "Resumo: frações e porcentagem."
+
+
+def test_messages_out_of_the_window_are_summarized(mongo_server, monkeypatch):
+    server = mongo_server
+    summarizer = FakeSummarizer()
+    monkeypatch.setattr(server, "llm", summarizer)
+    window = server.CONTEXT_RECENT_MESSAGES + server.CONTEXT_SUMMARY_EVERY
+    start = datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
+    messages = [
+        {"id": f"m{i:02}", "session_id": "s", "role": "user" if i % 2 == 0 else "assistant",
+         "content": f"mensagem {i}", "timestamp": start + timedelta(minutes=i)}
+        for i in range(window)
+    ]
+
+    async def run():
+        await server.db.sessions.insert_one({"id": "s", "profile_id": "p"})
+        await server.db.messages.insert_many([dict(message) for message in messages])
+        await server.refresh_summary("s")
+        session = await server.db.sessions.find_one({"id": "s"}, {"_id": 0})
+        return session, await server.fetch_context("s")
+
+    session, context = asyncio.run(run())
+
+    summarized = messages[:server.CONTEXT_SUMMARY_EVERY]
+    assert session["summary"] == "Resumo: frações e porcentagem."
+    assert server.as_datetime(session["summary_until"]) == summarized[-1]["timestamp"]
+    assert all(message["content"] in summarizer.transcripts[0] for message in summarized)
+    assert messages[server.CONTEXT_SUMMARY_EVERY]["content"] not in summarizer.transcripts[0]
+    # o turno seguinte leva o resumo e só as mensagens depois dele
+    assert context.summary == session["summary"]
+    assert [msg["content"] for msg in context.messages] == [
+        message["content"] for message in messages[server.CONTEXT_SUMMARY_EVERY:]
+    ]
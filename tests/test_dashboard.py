@@ -0,0 +1,29 @@
+"""
+/api/dashboard: sessões, progresso e streak numa chamada, com o mesmo conteúdo das
+rotas separadas.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+
+
+def test_dashboard_matches_the_separate_routes(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        for session_id, subject in (("s1", "Física"), ("s2", "Química"), ("s2", "Química")):
+            client.post("/api/chat", json={"session_id": session_id, "profile_id": client.profile_id,
+                                           "subject": subject, "message": f"Dúvida de {subject}"})
+        dashboard = client.get(f"/api/dashboard/{client.profile_id}").json()
+        sessions = client.get(f"/api/sessions/{client.profile_id}").json()
+        progress = client.get(f"/api/progress/{client.profile_id}").json()
+        streak = client.get(f"/api/streak/{client.profile_id}").json()
+
+    assert dashboard["sessions"] == sessions
+    assert dashboard["progress"] == progress
+    assert dashboard["streak"] == streak
+    assert (progress["total_sessions"], progress["total_messages"]) == (2, 3)
+
+
+def test_dashboard_of_an_unknown_profile_is_404(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        response = client.get("/api/dashboard/nao-existe")
+
+    assert response.status_code == 404
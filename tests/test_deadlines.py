@@ -0,0 +1,96 @@
+"""
+Prazo da requisição durante a chamada ao LLM: vira um erro deadline_exceeded
+contado (504 no /chat, evento `error` no stream e no WebSocket), não grava o
+turno e não conta como falha do provedor no disjuntor.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import asyncio
+import json
+
+import pytest
+
+BUDGET = 1.5  # sobra 0.5 s para o LLM depois da margem de 1 s
+
+
+@pytest.fixture
+def slow_llm(mongo_server, fake_gemini, breaker, monkeypatch):
+    for route in ("/api/chat", "/api/chat/stream"):
+        monkeypatch.setitem(mongo_server.ROUTE_DEADLINES, route, BUDGET)
+    monkeypatch.setattr(mongo_server, "STREAM_DEADLINE", BUDGET)
+    monkeypatch.setattr(mongo_server, "llm_breaker", breaker())
+    return fake_gemini(lambda model, n: 5)
+
+
+def body(client) -> dict:
+    return {"session_id": "sessao", "profile_id": client.profile_id, "subject": "Física", "message": "Por que o céu é azul?"}
+
+
+def exceeded(server, route: str) -> float:
+    return server.REQUEST_DEADLINE_EXCEEDED.labels(route, "llm")._value.get()
+
+
+def assert_nothing_stored(server, client):
+    assert client.get(f"/api/sessions/{client.profile_id}/sessao/messages").json() == []
+    assert server.llm_breaker.stats()["window_calls"] == 0
+
+
+def test_chat_answers_504(server, api, slow_llm):
+    before = exceeded(server, "/api/chat")
+    with api(slow_llm) as client:
+        response = client.post("/api/chat", json=body(client))
+
+        assert response.status_code == 504
+        assert response.json()["detail"] == {"error": "deadline_exceeded", "stage": "llm"}
+        assert_nothing_stored(server, client)
+    assert exceeded(server, "/api/chat") == before + 1
+
+
+def test_stream_ends_with_error_event(server, api, slow_llm):
+    before = exceeded(server, "/api/chat/stream")
+    with api(slow_llm) as client:
+        response = client.post("/api/chat/stream", json=body(client))
+
+        assert response.status_code == 200
+        assert "event: error" in response.text and "event: done" not in response.text
+        assert '"deadline_exceeded"' in response.text
+        assert_nothing_stored(server, client)
+    assert exceeded(server, "/api/chat/stream") == before + 1
+
+
+def test_websocket_turn_ends_with_error(server, api, slow_llm):
+    with api(slow_llm) as client:
+        with client.websocket_connect(f"/api/ws/{client.profile_id}") as socket:
+            assert socket.receive_json()["type"] == "dashboard"
+            socket.send_text(json.dumps({"type": "chat", **body(client), "request_id": "r1"}))
+            error = socket.receive_json()
+
+        assert error["type"] == "error" and error["request_id"] == "r1"
+        assert (error["status"], error["detail"]["error"]) == (504, "deadline_exceeded")
+        assert_nothing_stored(server, client)
+
+
+def test_upload_deadline_follows_the_stream_flag(server, api, fake_gemini, monkeypatch):
+    # 1 s de LLM: cabe no prazo do stream (3 s), não no do /chat (1.5 s)
+    monkeypatch.setitem(server.ROUTE_DEADLINES, "/api/chat/upload", 3.0)
+    monkeypatch.setattr(server, "CHAT_DEADLINE", BUDGET)
+    with api(fake_gemini(lambda model, n: 1)) as client:
+        streamed = client.post("/api/chat/upload", data={**body(client), "stream": "true"})
+        answered = client.post("/api/chat/upload", data=body(client))
+
+    assert "event: done" in streamed.text and "event: error" not in streamed.text
+    assert answered.status_code == 504
+
+
+def test_middleware_504_carries_the_cors_headers(server, api, fake_gemini, monkeypatch):
+    async def stalled(profile):
+        await asyncio.sleep(5)
+
+    monkeypatch.setitem(server.ROUTE_DEADLINES, "/api/progress/{profile_id}", 0.3)
+    monkeypatch.setattr(server, "ensure_stats", stalled)
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        response = client.get(f"/api/progress/{client.profile_id}", headers={"Origin": "https://app.example"})
+
+    assert response.status_code == 504
+    assert response.json()["detail"] == {"error": "deadline_exceeded", "stage": "request"}
+    assert response.headers["access-control-allow-origin"]
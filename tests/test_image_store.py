@@ -0,0 +1,45 @@
+"""
+FileImageStore com várias threads gravando: a mesma foto ao mesmo tempo vira um
+arquivo só, e o total usado na remoção continua certo (não precisa de MongoDB).
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+def put_all(store, items, threads=8):
+    with ThreadPoolExecutor(threads) as executor:
+        # list(): as exceções das threads sobem aqui
+        list(executor.map(lambda item: store._put(*item), items))
+
+
+def test_same_photo_from_many_threads(server, tmp_path):
+    store = server.FileImageStore(tmp_path, 10 ** 6)
+
+    put_all(store, [("ab" + "0" * 62, b"foto" * 100)] * 32)
+
+    assert [f.name for f in tmp_path.glob("*/*")] == ["ab" + "0" * 62]
+    assert store._get("ab" + "0" * 62) == b"foto" * 100
+    assert store._total == 400
+
+
+def test_total_stays_under_the_limit(server, tmp_path):
+    store = server.FileImageStore(tmp_path, 10_000)
+
+    put_all(store, [(f"{n:064x}", bytes(1000)) for n in range(40)])
+
+    on_disk = sum(f.stat().st_size for f in tmp_path.glob("*/*"))
+    assert store._total == on_disk <= 10_000
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+
+def test_store_failure_is_logged_not_lost(server, monkeypatch, caplog):
+    class FullDisk:
+        async def put(self, digest, data):
+            raise OSError("No space left on device")
+
+    image = server.ChatImage(content_type="image/png", data="Zm90bw==", sha256="ab" * 32,
+                             original_bytes=4, sent_bytes=4, width=1, height=1)
+    monkeypatch.setattr(server, "image_store", FullDisk())
+
+    assert asyncio.run(server.store_image(image)) is False
+    assert "No space left on device" in caplog.text
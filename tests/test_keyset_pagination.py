@@ -0,0 +1,47 @@
+"""
+Paginação por cursor com timestamps mistos: durante a leitura dupla do user-015
+parte das mensagens ainda tem o timestamp em string ISO. Andar para trás (before)
+e para frente (after) precisa passar por todas, uma única vez e em ordem.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+START = datetime(2026, 3, 1, 12, tzinfo=timezone.utc)
+
+
+def messages() -> list:
+    docs = []
+    for n in range(7):
+        timestamp = START + timedelta(minutes=n // 2)  # pares com o mesmo timestamp: desempate pelo id
+        # as antigas, ainda em string como antes do user-015; as novas em datetime
+        docs.append({"id": f"m{n}", "session_id": "s", "timestamp": timestamp.isoformat() if n < 4 else timestamp})
+    return docs
+
+
+async def walk(server, direction: str, cursor=None) -> list:
+    seen = []
+    while True:
+        docs, page = await server.keyset_page(server.db.messages, {"session_id": "s"}, "timestamp", 2,
+                                              **({direction: cursor} if cursor else {}))
+        seen = [*seen, *docs] if direction == "after" else [*docs, *seen]
+        cursor = getattr(page, direction)
+        if not cursor:
+            return [doc["id"] for doc in seen]
+
+
+def test_before_and_after_cross_string_and_date_timestamps(mongo_server):
+    docs = messages()
+
+    async def run():
+        await mongo_server.db.messages.insert_many([dict(doc) for doc in docs])
+        # para frente, a partir da mais antiga (ainda em string)
+        oldest = mongo_server.encode_cursor(docs[0]["timestamp"], docs[0]["id"])
+        return await walk(mongo_server, "before"), await walk(mongo_server, "after", oldest)
+
+    newest_first, forward = asyncio.run(run())
+
+    expected = [doc["id"] for doc in docs]
+    assert newest_first == expected
+    assert forward == expected[1:]
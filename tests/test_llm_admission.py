@@ -0,0 +1,78 @@
+"""
+Limitador do LLM: vagas liberadas passam em rodízio entre os perfis da fila, cada
+perfil tem um teto de chamadas, e o trabalho em segundo plano usa só vaga livre,
+sem fila e sem contar no limite por perfil.
+"""
+import asyncio
+
+import pytest
+
+
+def admission(server, **overrides):
+    config = dict(max_concurrency=2, max_queue=4, max_wait=1.0, max_per_profile=1)
+    return server.LLMAdmission(**{**config, **overrides})
+
+
+def test_background_slot_leaves_the_profile_limit_alone(server):
+    async def run():
+        limiter = admission(server)
+        background = limiter.try_acquire()
+        ticket = await limiter.acquire("p")  # a vaga do aluno continua lá
+        assert limiter.try_acquire() is None  # as duas vagas ocupadas
+        background.release()
+        ticket.release()
+        return limiter
+
+    limiter = asyncio.run(run())
+
+    assert limiter.in_flight == 0 and limiter.background_skipped == 1
+    assert limiter.stats()["rejected"] == {"queue_full": 0, "profile_limit": 0, "queue_timeout": 0}
+
+
+def test_freed_slots_rotate_between_profiles(server):
+    async def run():
+        limiter = admission(server, max_concurrency=1, max_per_profile=2)
+        holder = await limiter.acquire("x")
+        served = []
+
+        async def ask(profile_id: str, name: str):
+            ticket = await limiter.acquire(profile_id)
+            served.append(name)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        # "a" chega com duas perguntas antes de "b"
+        arrivals = [("a", "a1"), ("a", "a2"), ("b", "b1")]
+        tasks = [asyncio.create_task(ask(profile_id, name)) for profile_id, name in arrivals]
+        await asyncio.sleep(0)
+        assert limiter.queued == 3
+        holder.release()
+        await asyncio.gather(*tasks)
+        return limiter, served
+
+    limiter, served = asyncio.run(run())
+
+    assert served == ["a1", "b1", "a2"]
+    assert (limiter.in_flight, limiter.queued) == (0, 0)
+
+
+def test_profile_over_its_cap_is_refused_while_others_queue(server):
+    async def run():
+        limiter = admission(server, max_concurrency=1, max_per_profile=2)
+        holder = await limiter.acquire("a")
+        waiting = asyncio.create_task(limiter.acquire("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(server.LLMOverloaded) as refused:
+            await limiter.acquire("a")
+        other = asyncio.create_task(limiter.acquire("b"))
+        await asyncio.sleep(0)
+        holder.release()
+        (await waiting).release()
+        (await other).release()
+        return limiter, refused.value
+
+    limiter, refused = asyncio.run(run())
+
+    assert refused.status_code == 429 and "Retry-After" in refused.headers
+    assert limiter.rejected["profile_limit"] == 1
+    assert limiter.admitted == 3 and limiter.in_flight == 0
@@ -0,0 +1,53 @@
+"""
+Disjuntor do LLM: abre com falhas (ou lentidão) acima do limite, recusa na hora
+enquanto aberto e fecha (ou reabre) conforme as chamadas de teste do half-open.
+"""
+import time
+
+import pytest
+
+
+def calls(cb, *results: bool, seconds: float = 0.01):
+    for ok in results:
+        cb.acquire().record(ok, seconds)
+
+
+def test_opens_on_failure_rate_and_fails_fast(server, breaker):
+    cb = breaker()
+    calls(cb, True, False, True)
+    assert cb.state == "closed"  # abaixo de min_calls
+
+    calls(cb, False)
+
+    assert cb.state == "open"
+    with pytest.raises(server.LLMUnavailable) as rejected:
+        cb.check()
+    assert rejected.value.status_code == 503
+    assert rejected.value.headers["Retry-After"] == "1"
+
+
+def test_slow_calls_count_as_failures(breaker):
+    cb = breaker()
+
+    calls(cb, True, True, True, True, seconds=2.0)
+
+    assert cb.state == "open"
+
+
+def test_half_open_probes_close_or_reopen(server, breaker):
+    cb = breaker()
+    calls(cb, False, False, False, False)
+    time.sleep(0.06)
+
+    first, second = cb.acquire(), cb.acquire()
+    assert cb.state == "half_open"
+    with pytest.raises(server.LLMUnavailable):
+        cb.acquire()  # só `probes` chamadas de teste ao mesmo tempo
+    first.record(True)
+    second.record(True)
+    assert cb.state == "closed"
+
+    calls(cb, False, False, False, False)
+    time.sleep(0.06)
+    cb.acquire().record(False)
+    assert cb.state == "open"
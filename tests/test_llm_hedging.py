@@ -0,0 +1,124 @@
+"""
+Hedge, modelo reserva e prazo da chamada ao LLM contra um Gemini falso com
+lentidão injetada (não precisa de rede nem de MongoDB).
+"""
+import asyncio
+import time
+
+import pytest
+
+
+def test_hedge_answers_when_first_call_stalls(server, hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 0.6 if n == 1 else 0.02)
+
+    started = time.monotonic()
+    reply, outcome = asyncio.run(llm.generate(client, "sistema", "pergunta"))
+
+    assert reply == server.GEMINI_MODEL
+    assert outcome["path"] == "hedge"
+    assert outcome["attempts"] == 2
+    assert time.monotonic() - started < 0.4
+
+
+def test_hedge_win_cancels_the_primary(hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 0.6 if n == 1 else 0.02)
+
+    async def run():
+        reply, outcome = await llm.generate(client, "sistema", "pergunta")
+        await asyncio.sleep(0.05)
+        # nada da chamada original sobrando no loop, ocupando o LLM sem vaga
+        return outcome, asyncio.all_tasks() - {asyncio.current_task()}
+
+    outcome, leftover = asyncio.run(run())
+
+    assert outcome["path"] == "hedge"
+    assert leftover == set()
+    # estimado, no máximo até o limite da original, e no desfecho deste pedido
+    assert 0 < outcome["saved_ms_est"] <= 700
+    assert llm.saved_est_total == pytest.approx(outcome["saved_ms_est"] / 1000, abs=0.001)
+
+
+def test_hedges_stay_within_the_budget(hedged, fake_gemini):
+    llm = hedged(hedge_budget=0.5)
+    llm.hedge_tokens = 0  # orçamento gasto: meio hedge por chamada daqui em diante
+    client = fake_gemini(lambda model, n: 0.3 if n < 3 else 0.02)  # a 3ª é o hedge
+
+    paths = [asyncio.run(llm.generate(client, "sistema", "pergunta"))[1]["path"] for _ in range(2)]
+
+    assert paths == ["primary", "hedge"]
+    assert llm.hedges_skipped == {"budget": 1, "no_slot": 0}
+
+
+def test_hedge_needs_a_free_admission_slot(server, hedged, fake_gemini):
+    admission = server.LLMAdmission(max_concurrency=2, max_queue=0, max_wait=1.0, max_per_profile=2)
+    llm = hedged(admission=admission)
+    client = fake_gemini(lambda model, n: 0.3 if n in (1, 3) else 0.02)
+
+    async def run():
+        primary = admission.try_acquire()  # a vaga que a chamada original ocupa
+        with_slot = await llm.generate(client, "sistema", "pergunta")
+        blocker = admission.try_acquire()  # limitador cheio
+        without_slot = await llm.generate(client, "sistema", "pergunta")
+        for ticket in (primary, blocker):
+            ticket.release()
+        return with_slot[1]["path"], without_slot[1]["path"]
+
+    assert asyncio.run(run()) == ("hedge", "primary")
+    assert llm.hedges_skipped == {"budget": 0, "no_slot": 1}
+    assert admission.in_flight == 0  # a vaga do hedge voltou
+
+
+def test_fast_primary_sends_no_hedge(hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 0.01)
+
+    reply, outcome = asyncio.run(llm.generate(client, "sistema", "pergunta"))
+
+    assert outcome == {"path": "primary", "ms": outcome["ms"], "attempts": 1}
+    assert llm.hedges_sent == 0
+
+
+def test_error_falls_back_to_faster_model(hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 0.01 if model == llm.fallback_model else None)
+
+    reply, outcome = asyncio.run(llm.generate(client, "sistema", "pergunta"))
+
+    assert (reply, outcome["path"]) == (llm.fallback_model, "fallback")
+
+
+def test_slow_primary_falls_back_before_deadline(hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 0.01 if model == llm.fallback_model else 5)
+
+    started = time.monotonic()
+    reply, outcome = asyncio.run(llm.generate(client, "sistema", "pergunta"))
+
+    assert outcome["path"] == "fallback"
+    assert 0.6 <= time.monotonic() - started < 1.0
+
+
+def test_deadline_bounds_the_whole_call(hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 5)
+
+    started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(llm.generate(client, "sistema", "pergunta"))
+
+    assert time.monotonic() - started < 1.2
+    assert llm.paths["failed"] == 1
+
+
+def test_stream_falls_back_before_first_chunk(hedged, fake_gemini):
+    llm = hedged()
+    client = fake_gemini(lambda model, n: 0.01 if model == llm.fallback_model else None)
+    outcome = {}
+
+    async def collect():
+        return [chunk async for chunk in llm.stream(client, "sistema", "pergunta", outcome=outcome)]
+
+    assert asyncio.run(collect()) == [llm.fallback_model]
+    assert outcome["path"] == "fallback"
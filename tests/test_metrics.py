@@ -0,0 +1,45 @@
+"""
+Métricas Prometheus: consultas ao cache de respostas e o modo multiprocesso, que o
+prometheus_client escolhe no import a partir do PROMETHEUS_MULTIPROC_DIR.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from prometheus_client import REGISTRY
+
+BACKEND = Path(__file__).resolve().parent.parent / "backend"
+
+
+def lookups(result: str) -> float:
+    return REGISTRY.get_sample_value("answer_cache_lookups_total", {"result": result}) or 0.0
+
+
+def test_answer_cache_lookups_are_counted(server, monkeypatch):
+    monkeypatch.setattr(server, "answer_cache", server.MemoryAnswerCache(16, 60))
+    before = lookups("hit"), lookups("miss")
+
+    async def run():
+        assert await server.cached_answer("k", {"name": "Ana"}) is None
+        await server.store_answer("k", {"name": "Ana"}, "Oi, Ana")
+        assert await server.cached_answer("k", {"name": "Bia"}) == "Oi, Bia"
+
+    asyncio.run(run())
+
+    assert (lookups("hit") - before[0], lookups("miss") - before[1]) == (1, 1)
+
+
+def test_multiprocess_dir_set_after_prometheus_import_fails_loudly(tmp_path):
+    code = (
+        "import os, prometheus_client\n"
+        f"os.environ['PROMETHEUS_MULTIPROC_DIR'] = {str(tmp_path)!r}\n"
+        "import server\n"
+    )
+    env = {k: v for k, v in os.environ.items() if k.lower() != "prometheus_multiproc_dir"}
+    result = subprocess.run([sys.executable, "-c", code], cwd=BACKEND, env=env, capture_output=True, text=True,
+                            timeout=60)
+
+    assert result.returncode != 0
+    assert "PROMETHEUS_MULTIPROC_DIR" in result.stderr.splitlines()[-1]
@@ -0,0 +1,46 @@
+"""
+manage.py migrate-timestamps: converte as datas string ISO em lotes e retoma do
+checkpoint salvo em `migrations`, sem refazer o que já foi convertido.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+
+@pytest.fixture
+def manage(mongo_server, monkeypatch):
+    import manage as manage_module
+
+    # manage.py importa o `db` do server: aponta para o banco de teste
+    monkeypatch.setattr(manage_module, "db", mongo_server.db)
+    return manage_module
+
+
+def test_migration_resumes_from_the_checkpoint(mongo_server, manage):
+    stamps = [f"2024-03-0{day}T10:00:00+00:00" for day in range(1, 6)]
+
+    async def run():
+        db = mongo_server.db
+        result = await db.messages.insert_many([{"id": str(i), "timestamp": stamp} for i, stamp in enumerate(stamps)])
+        ids = result.inserted_ids
+        # execução interrompida depois do primeiro lote (os dois _id mais novos); o mais
+        # novo fica string de propósito: quem retoma do checkpoint não passa mais por ele
+        fourth = datetime(2024, 3, 4, 10, tzinfo=timezone.utc)
+        await db.messages.update_one({"_id": ids[3]}, {"$set": {"timestamp": fourth}})
+        await db.migrations.insert_one({"_id": "timestamps:messages.timestamp", "last_id": ids[3], "converted": 1})
+
+        converted = await manage.migrate_field("messages", "timestamp", batch_size=2, pause=0)
+        again = await manage.migrate_field("messages", "timestamp", batch_size=2, pause=0)
+        docs = await db.messages.find({}, {"_id": 0}).sort("id", 1).to_list(None)
+        state = await db.migrations.find_one({"_id": "timestamps:messages.timestamp"})
+        return converted, again, docs, state
+
+    converted, again, docs, state = asyncio.run(run())
+
+    assert converted == again == 4
+    assert state["done"] is True
+    assert [isinstance(doc["timestamp"], datetime) for doc in docs] == [True, True, True, True, False]
+    assert docs[0]["timestamp"] == datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
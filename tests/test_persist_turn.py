@@ -0,0 +1,43 @@
+"""
+Gravação do turno sem resposta (stream cancelado antes do primeiro pedaço): a
+pergunta fica gravada e a sessão aparece na lista e conta no progresso. O streak
+devolvido pela gravação é o que vai para o dashboard.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+
+
+def test_turn_without_reply_still_creates_the_session(server, api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        request = server.ChatRequest(session_id="s", profile_id=client.profile_id, subject="Física",
+                                     message="Por que o céu é azul?")
+        user_msg = server.new_user_message(request)
+
+        async def persist():
+            return await server.persist_turn(request, user_msg, None, replayable=False)
+
+        assistant_msg, streak = client.portal.call(persist)
+        sessions = client.get(f"/api/sessions/{client.profile_id}").json()
+        progress = client.get(f"/api/progress/{client.profile_id}").json()
+
+    assert assistant_msg is None
+    assert (streak.current_streak, streak.studied_today) == (1, True)
+    assert [session["id"] for session in sessions] == ["s"]
+    assert sessions[0]["title"] == "Por que o céu é azul?"
+    assert (progress["total_sessions"], progress["total_messages"]) == (1, 1)
+
+
+def test_dashboard_streak_comes_from_the_turn_update(server, api, fake_gemini, monkeypatch):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        def reread(profile):
+            raise AssertionError("streak relido do perfil")
+
+        monkeypatch.setattr(server, "build_streak_info", reread)
+        response = client.post("/api/chat", json={"session_id": "s", "profile_id": client.profile_id,
+                                                  "subject": "Física", "message": "Oi",
+                                                  "include_dashboard": True})
+
+    assert response.status_code == 200
+    streak = response.json()["dashboard"]["streak"]
+    assert (streak["current_streak"], streak["studied_today"]) == (1, True)
+    assert streak["streak_calendar"][-1] != ""
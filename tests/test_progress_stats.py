@@ -0,0 +1,55 @@
+"""
+Contadores de progresso no perfil (`stats`): matérias com nomes que não servem
+de caminho no MongoDB e perfis criados antes dos contadores existirem.
+
+Os testes com API precisam de um MongoDB em MONGO_URL; sem ele são pulados.
+"""
+import pytest
+
+
+@pytest.mark.parametrize("subject, key", [
+    ("Física", "Física"), ("Cálculo 1.2", "Cálculo 1_2"), ("$ref", "ref"), ("", "geral"), ("$", "geral"),
+])
+def test_subject_key_is_always_a_valid_path(server, subject, key):
+    assert server.stats_subject_key(subject) == key
+
+
+def test_turn_with_an_empty_subject_is_counted(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        response = client.post("/api/chat", json={"session_id": "s", "profile_id": client.profile_id,
+                                                  "subject": "", "message": "Oi"})
+        progress = client.get(f"/api/progress/{client.profile_id}").json()
+
+    assert response.status_code == 200
+    assert progress["total_messages"] == 1
+
+
+def ask(client, subject: str, session_id: str = "s"):
+    response = client.post("/api/chat", json={"session_id": session_id, "profile_id": client.profile_id,
+                                              "subject": subject, "message": f"Dúvida de {subject}"})
+    assert response.status_code == 200
+
+
+def test_progress_lists_the_original_subject_names(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        for subject in ("Cálculo 1.2", "Cálculo 1.2", "$Química"):
+            ask(client, subject)
+        progress = client.get(f"/api/progress/{client.profile_id}").json()
+
+    assert progress["subjects_studied"] == ["Cálculo 1.2", "$Química"]
+    assert progress["favorite_subject"] == "Cálculo 1.2"
+
+
+def test_profile_from_before_the_counters_is_recomputed(server, api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        ask(client, "Física")
+
+        async def drop_stats():
+            await server.db.profiles.update_one({"id": client.profile_id}, {"$unset": {"stats": ""}})
+
+        client.portal.call(drop_stats)
+        ask(client, "História", session_id="s2")  # o $inc não recria `stats` do zero
+        progress = client.get(f"/api/progress/{client.profile_id}").json()
+
+    assert (progress["total_sessions"], progress["total_messages"]) == (2, 2)
+    assert sorted(progress["subjects_studied"]) == ["Física", "História"]
@@ -0,0 +1,44 @@
+"""
+Prompts do sistema memorizados por (formato do perfil, matéria) num LRU limitado e
+descartados quando o perfil muda.
+"""
+import pytest
+
+PROFILE = {"name": "Ana", "interesse_cultural": "Anime", "canal_sensorial": "visual", "abordagem": "pratica"}
+
+
+@pytest.fixture
+def cache(server, monkeypatch):
+    prompts = server.LRUCache(3)
+    monkeypatch.setattr(server, "prompt_cache", prompts)
+    return prompts
+
+
+def test_same_shape_and_subject_reuse_the_prompt(server, cache):
+    first = server.build_system_prompt(PROFILE, "Física")
+    again = server.build_system_prompt(dict(PROFILE), "Física")
+    other = server.build_system_prompt(PROFILE, "Química")
+
+    assert again is first and other is not first
+    assert cache.stats() == {"size": 2, "maxsize": 3, "hits": 1, "misses": 2}
+
+
+def test_profile_update_discards_only_its_prompts(server, cache):
+    other_profile = {**PROFILE, "interesse_cultural": "Futebol"}
+    old = server.build_system_prompt(PROFILE, "Física")
+    server.build_system_prompt(PROFILE, "Química")
+    kept = server.build_system_prompt(other_profile, "Física")
+
+    assert server.invalidate_system_prompts(PROFILE) == 2
+    assert server.build_system_prompt(other_profile, "Física") is kept
+    assert server.build_system_prompt(PROFILE, "Física") is not old
+
+
+def test_least_recently_used_prompt_is_evicted(server, cache):
+    subjects = ["Física", "Química", "Biologia"]
+    for subject in subjects:
+        server.build_system_prompt(PROFILE, subject)
+    server.build_system_prompt(PROFILE, "Física")  # volta a ser o mais recente
+    server.build_system_prompt(PROFILE, "História")
+
+    assert [key[-1] for key in cache._data] == ["Biologia", "Física", "História"]
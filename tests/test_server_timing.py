@@ -0,0 +1,45 @@
+"""
+Etapas de cada requisição: o cabeçalho Server-Timing traz as concluídas até a
+resposta, e uma requisição acima de SLOW_REQUEST_MS gera a linha de log JSON
+slow_request com todas elas.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import json
+import logging
+
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for entry in header.split(", "):
+        name, duration = entry.split(";dur=")
+        stages[name] = float(duration)
+    return stages
+
+
+def ask(client):
+    return client.post("/api/chat", json={"session_id": "s", "profile_id": client.profile_id, "subject": "Física",
+                                          "message": "O que é inércia?"})
+
+
+def test_chat_response_lists_its_stages(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0.1)) as client:
+        response = ask(client)
+
+    stages = parse_server_timing(response.headers["server-timing"])
+    assert {"profile", "context", "prompt", "admission", "persist", "total"} <= set(stages)
+    assert stages["total"] >= 100
+    assert stages["total"] >= max(duration for name, duration in stages.items() if name != "total")
+
+
+def test_slow_request_is_logged_with_its_stages(server, api, fake_gemini, monkeypatch, caplog):
+    monkeypatch.setattr(server, "SLOW_REQUEST_MS", 200)
+    with api(fake_gemini(lambda model, n: 0.3)) as client:
+        with caplog.at_level(logging.WARNING, logger="server"):
+            ask(client)
+            client.get(f"/api/progress/{client.profile_id}")  # rápida: não entra no log
+
+    slow = [json.loads(record.getMessage()) for record in caplog.records if "slow_request" in record.getMessage()]
+    assert [(entry["method"], entry["route"], entry["status"]) for entry in slow] == [("POST", "/api/chat", 200)]
+    assert slow[0]["total_ms"] >= 300
+    assert "persist" in [stage["name"] for stage in slow[0]["stages"]]
@@ -0,0 +1,31 @@
+"""
+Calendário do streak lido do bitmap de atividade (`activity_months.YYYY-MM`, um bit
+por dia), inclusive quando a semana atravessa a virada do mês.
+"""
+from datetime import datetime, timezone
+
+
+def profile_with(server, *days: datetime) -> dict:
+    months = {}
+    for day in days:
+        field, bit = server.activity_bit(day)
+        month = field.split(".", 1)[1]
+        months[month] = months.get(month, 0) | bit
+    return {"activity_months": months}
+
+
+def test_bit_is_the_day_of_the_month(server):
+    assert server.activity_bit(datetime(2026, 3, 1)) == ("activity_months.2026-03", 1)
+    assert server.activity_bit(datetime(2026, 3, 31)) == ("activity_months.2026-03", 1 << 30)
+
+
+def test_calendar_crosses_the_month_boundary(server):
+    profile = profile_with(server, datetime(2026, 2, 26), datetime(2026, 2, 28), datetime(2026, 3, 3))
+
+    calendar = server.get_streak_calendar(profile, end=datetime(2026, 3, 3, 12, tzinfo=timezone.utc))
+
+    assert calendar == ["", "2026-02-26", "", "2026-02-28", "", "", "2026-03-03"]
+
+
+def test_profile_without_activity_has_an_empty_week(server):
+    assert server.get_streak_calendar({}, days=3) == ["", "", ""]
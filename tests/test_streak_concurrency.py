@@ -0,0 +1,67 @@
+"""
+Streak sob concorrência: mensagens em paralelo dos dois lados da meia-noite
+(e da virada do mês) precisam contar cada dia uma única vez e deixar o mesmo
+streak, em qualquer ordem de chegada.
+
+Precisa de um MongoDB (4.2+) em MONGO_URL; sem ele o teste é pulado.
+"""
+import asyncio
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+BEFORE_MIDNIGHT = datetime(2026, 3, 31, 23, 59, 59, tzinfo=timezone.utc)
+AFTER_MIDNIGHT = BEFORE_MIDNIGHT + timedelta(seconds=2)
+
+
+async def run_parallel(server, profile: dict, moments: list) -> dict:
+    profile_id = f"test-streak-{uuid.uuid4()}"
+    await server.db.profiles.insert_one({"id": profile_id, **profile})
+    try:
+        results = await asyncio.gather(*(server.update_streak(profile_id, now) for now in moments))
+        assert all(result["studied_today"] for result in results)
+        return await server.db.profiles.find_one({"id": profile_id}, {"_id": 0, "id": 0})
+    finally:
+        await server.db.profiles.delete_one({"id": profile_id})
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_parallel_messages_across_midnight(mongo_server, seed):
+    moments = [BEFORE_MIDNIGHT] * 10 + [AFTER_MIDNIGHT] * 10
+    random.Random(seed).shuffle(moments)
+    profile = {
+        "current_streak": 3,
+        "longest_streak": 3,
+        "total_study_days": 5,
+        "last_activity_date": "2026-03-30",
+        "activity_months": {"2026-03": 1 << 29},
+    }
+
+    result = asyncio.run(run_parallel(mongo_server, profile, moments))
+
+    assert result["current_streak"] == 5
+    assert result["longest_streak"] == 5
+    assert result["total_study_days"] == 7
+    assert result["last_activity_date"] == "2026-04-01"
+    assert result["activity_months"] == {"2026-03": (1 << 29) | (1 << 30), "2026-04": 1}
+
+
+def test_parallel_messages_same_day_count_once(mongo_server):
+    result = asyncio.run(run_parallel(mongo_server, {}, [AFTER_MIDNIGHT] * 20))
+
+    assert result["current_streak"] == 1
+    assert result["longest_streak"] == 1
+    assert result["total_study_days"] == 1
+    assert result["activity_months"] == {"2026-04": 1}
+
+
+def test_gap_resets_streak(mongo_server):
+    profile = {"current_streak": 7, "longest_streak": 9, "total_study_days": 9, "last_activity_date": "2026-03-20"}
+
+    result = asyncio.run(run_parallel(mongo_server, profile, [AFTER_MIDNIGHT]))
+
+    assert result["current_streak"] == 1
+    assert result["longest_streak"] == 9
+    assert result["total_study_days"] == 10
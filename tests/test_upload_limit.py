@@ -0,0 +1,37 @@
+"""
+Limite do upload de /chat/upload aplicado antes do parser de multipart: pelo
+Content-Length e, sem ele, contando os bytes do corpo (não precisa de MongoDB).
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client(server):
+    # sem `with`: nada de startup, o corpo é recusado antes de chegar à rota
+    return TestClient(server.app)
+
+
+def oversized(server) -> bytes:
+    return b"x" * (server.IMAGE_MAX_UPLOAD_BYTES + server.UPLOAD_FORM_OVERHEAD + 1)
+
+
+def test_content_length_over_the_limit_is_refused_up_front(server, client):
+    response = client.post("/api/chat/upload", content=oversized(server),
+                           headers={"Content-Type": "multipart/form-data; boundary=x"})
+
+    assert response.status_code == 413
+
+
+def test_chunked_body_is_cut_off_at_the_limit(server, client):
+    body = oversized(server)
+
+    def chunks():
+        for start in range(0, len(body), 1024 * 1024):
+            yield body[start:start + 1024 * 1024]
+
+    response = client.post("/api/chat/upload", content=chunks(),
+                           headers={"Content-Type": "multipart/form-data; boundary=x"})
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Imagem muito grande"}
@@ -0,0 +1,62 @@
+"""
+Turnos de chat pelo WebSocket do perfil: pedaços, done e depois os avisos do
+dashboard; frame inválido não derruba a conexão; desconectar no meio do turno
+libera a vaga do LLM.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import json
+import time
+
+
+def chat(client, request_id: str) -> str:
+    return json.dumps({"type": "chat", "session_id": "sessao", "subject": "Física",
+                       "message": "Por que o céu é azul?", "request_id": request_id})
+
+
+def test_turn_streams_then_pushes_the_dashboard(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0, chunks=["Luz ", "espalhada"])) as client:
+        with client.websocket_connect(f"/api/ws/{client.profile_id}") as socket:
+            first = socket.receive_json()
+            assert first["type"] == "dashboard" and first["sessions"] == []
+            socket.send_text(chat(client, "r1"))
+
+            turn = []
+            while not turn or turn[-1]["type"] != "done":
+                turn.append(socket.receive_json())
+            pushes = {socket.receive_json()["type"] for _ in range(3)}
+
+    assert all(message["request_id"] == "r1" for message in turn)
+    assert "".join(message["delta"] for message in turn if message["type"] == "chunk") == "Luz espalhada"
+    assert pushes == {"sessions", "streak", "progress"}
+
+
+def test_malformed_frame_answers_an_error_and_keeps_the_connection(api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        with client.websocket_connect(f"/api/ws/{client.profile_id}") as socket:
+            socket.receive_json()
+            socket.send_text("{não é json")
+            error = socket.receive_json()
+            socket.send_text(json.dumps({"type": "ping"}))
+            pong = socket.receive_json()
+
+    assert (error["type"], error["status"]) == ("error", 400)
+    assert pong == {"type": "pong"}
+
+
+def test_disconnect_mid_turn_releases_the_llm_slot(server, api, fake_gemini):
+    with api(fake_gemini(lambda model, n: 5)) as client:
+        with client.websocket_connect(f"/api/ws/{client.profile_id}") as socket:
+            socket.receive_json()
+            socket.send_text(chat(client, "r1"))
+            until = time.monotonic() + 2
+            while server.llm_admission.in_flight == 0 and time.monotonic() < until:
+                time.sleep(0.01)
+            assert server.llm_admission.in_flight == 1
+
+        until = time.monotonic() + 2
+        while server.profile_channels.stats()["connections"] and time.monotonic() < until:
+            time.sleep(0.01)
+
+        assert server.llm_admission.in_flight == 0
+        assert server.profile_channels.stats() == {"profiles": 0, "connections": 0, "turns": 0}
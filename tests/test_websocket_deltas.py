@@ -0,0 +1,33 @@
+"""
+Avisos do WebSocket: o primeiro envio é o dashboard inteiro e os seguintes trazem
+só as sessões, o streak e o progresso que mudaram.
+"""
+
+
+def dashboard(sessions, streak=1, messages=2) -> dict:
+    return {
+        "sessions": [{"id": id, "updated_at": updated_at} for id, updated_at in sessions],
+        "sessions_before": None,
+        "progress": {"total_messages": messages},
+        "streak": {"current_streak": streak},
+    }
+
+
+def test_first_push_is_the_full_dashboard(server):
+    channel = server.ProfileChannel(websocket=None, profile_id="p")
+
+    assert channel._deltas(dashboard([("a", "t1")])) == [{"type": "dashboard", **dashboard([("a", "t1")])}]
+
+
+def test_later_pushes_carry_only_what_changed(server):
+    channel = server.ProfileChannel(websocket=None, profile_id="p")
+    channel.sent = dashboard([("a", "t1"), ("b", "t0")])
+
+    deltas = channel._deltas(dashboard([("c", "t3"), ("a", "t2"), ("b", "t0")], messages=4))
+
+    assert deltas == [
+        {"type": "sessions", "sessions": [{"id": "c", "updated_at": "t3"}, {"id": "a", "updated_at": "t2"}]},
+        {"type": "progress", "progress": {"total_messages": 4}},
+    ]
+    channel.sent = dashboard([("a", "t1")])
+    assert channel._deltas(dashboard([("a", "t1")])) == []
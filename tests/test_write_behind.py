@@ -0,0 +1,32 @@
+"""
+Write-behind (WRITE_BEHIND=1): streak e progresso do turno ficam numa fila em
+memória e são gravados em lote; no shutdown o que ainda está na fila é gravado
+antes de a conexão fechar.
+
+Precisa de um MongoDB em MONGO_URL; sem ele o teste é pulado.
+"""
+import pytest
+
+
+@pytest.fixture
+def write_behind(mongo_server, monkeypatch):
+    # intervalo longo: nada é gravado sozinho durante o teste
+    queue = mongo_server.WriteBehind(interval=60, max_batch=1000)
+    monkeypatch.setattr(mongo_server, "write_behind", queue)
+    return queue
+
+
+def test_pending_writes_are_flushed_on_close(server, api, fake_gemini, write_behind):
+    with api(fake_gemini(lambda model, n: 0)) as client:
+        response = client.post("/api/chat", json={"session_id": "s", "profile_id": client.profile_id,
+                                                  "subject": "Física", "message": "Oi"})
+        before = client.get(f"/api/streak/{client.profile_id}").json()
+        pending = write_behind.stats()["pending"]
+        # o mesmo passo do shutdown do app, com o event loop ainda de pé para ler o banco
+        client.portal.call(write_behind.close)
+        after = client.get(f"/api/streak/{client.profile_id}").json()
+
+    assert response.status_code == 200
+    assert pending > 0 and before["current_streak"] == 0
+    assert (after["current_streak"], after["studied_today"]) == (1, True)
+    assert write_behind.stats() == {"pending": 0, "batches": 1, "writes": pending, "failed": 0}